@@ -0,0 +1,581 @@
+"""Micro-benchmarks for the ingest and search code. Run them with
+
+    python manage.py benchmark [name name ...]
+
+Each benchmark returns a list of (label, value, unit) tuples.
+
+"""
+import multiprocessing
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import time
+from array import array
+from itertools import count, izip, takewhile
+from random import Random
+from timeit import Timer
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from pubmed_search.cache import TermCache
+from pubmed_search.db import configure_sqlite
+from pubmed_search.index import InvertedIndex, MappedIndex, write_snapshot
+from pubmed_search.matrix import MatrixScorer, numpy
+from pubmed_search.nlp import SCORING_MODELS, Tokenizer, clean_term
+from pubmed_search.shards import ShardedSearcher
+from pubmed_search.utils import STOP_WORDS, BulkLoader, iter_records
+
+
+SAMPLE_ARTICLES = os.path.join(os.path.dirname(__file__), 'pubmed-articles.json')
+
+
+def _best_time(function, repeat):
+    return min(Timer(function).repeat(repeat, 1))
+
+
+def _sample_texts(copies=10):
+    texts = [' '.join((record['title'], record['abstract']))
+             for record in iter_records(SAMPLE_ARTICLES)]
+    return texts * copies
+
+
+def synthetic_index(vocabulary=50000, documents=100000, seed=0):
+    """Return an InvertedIndex of random postings whose document frequencies
+    follow Zipf's law, as word frequencies in abstracts roughly do."""
+    random = Random(seed)
+    ranks = range(vocabulary)
+    random.shuffle(ranks)
+    terms = ['term%07d' % i for i in xrange(vocabulary)]
+    offsets = array('I', [0])
+    doc_ids = array('I')
+    frequencies = array('I')
+    for rank in ranks:
+        document_frequency = max(1, documents // (rank + 1))
+        doc_ids.extend(sorted(random.sample(xrange(1, documents + 1),
+                                            document_frequency)))
+        frequencies.extend(1 + int(random.expovariate(1.0))
+                           for i in xrange(document_frequency))
+        offsets.append(len(doc_ids))
+    return InvertedIndex(terms, offsets, doc_ids, frequencies, documents)
+
+
+def numpy_synthetic_index(vocabulary=20000, documents=1000000, seed=0):
+    """Like synthetic_index, but generated with NumPy, which is fast enough
+    for corpora of millions of documents."""
+    random = numpy.random.RandomState(seed)
+    ranks = random.permutation(vocabulary)
+    offsets = array('I', [0])
+    doc_ids = array('I')
+    frequencies = array('I')
+    for rank in ranks:
+        sample = random.randint(1, documents + 1, max(1, documents // (rank + 2)))
+        term_doc_ids = numpy.unique(sample).astype(numpy.uint32)
+        doc_ids.fromstring(term_doc_ids.tostring())
+        frequencies.fromstring(random.geometric(0.5, len(term_doc_ids))
+                               .astype(numpy.uint32).tostring())
+        offsets.append(len(doc_ids))
+    terms = ['term%07d' % i for i in xrange(vocabulary)]
+    return InvertedIndex(terms, offsets, doc_ids, frequencies, documents)
+
+
+def bench_tokenizer(repeat=5):
+    """Tokens per second for clean_term with a stop word tuple, against
+    Tokenizer, over the sample articles."""
+    texts = _sample_texts()
+    tokens = sum(len(text.split()) for text in texts)
+
+    def per_character():
+        for text in texts:
+            terms = [clean_term(term) for term in text.split()]
+            terms = [term for term in terms if term not in STOP_WORDS]
+
+    tokenizer = Tokenizer(settings.ACCEPTABLE_CHARACTERS, STOP_WORDS)
+    def precompiled():
+        for text in texts:
+            tokenizer.tokenize(text)
+
+    return [('clean_term', tokens / _best_time(per_character, repeat), 'tokens/s'),
+            ('Tokenizer', tokens / _best_time(precompiled, repeat), 'tokens/s')]
+
+
+def bench_index(repeat=5, lookups=10000):
+    """Time to look a term up and slice out its postings, and the size of the
+    posting arrays, for a synthetic index."""
+    index = synthetic_index()
+    random = Random(1)
+    terms = [random.choice(index.terms) for i in xrange(lookups)]
+
+    def lookup():
+        for term in terms:
+            index.postings(index.lookup(term))
+
+    postings = len(index.doc_ids)
+    posting_bytes = sum(column.itemsize * len(column) for column in
+                        (index.offsets, index.doc_ids, index.frequencies))
+    return [('lookup', 1e6 * _best_time(lookup, repeat) / lookups, 'us/term'),
+            ('postings', postings, 'postings'),
+            ('size', float(posting_bytes) / postings, 'bytes/posting')]
+
+
+def bench_term_cache(repeat=5, lookups=10000, cache_bytes=1024 * 1024):
+    """Time to find the id, document frequency and IDF of query terms drawn
+    by Zipf's law from the vocabulary of a snapshot, without and with a
+    TermCache of cache_bytes, and the cache's hit ratio and size."""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'index')
+        write_snapshot(synthetic_index(), path)
+        mapped = MappedIndex(path)
+        random = Random(5)
+        terms = [mapped.terms[min(len(mapped) - 1, int(random.paretovariate(1.0)) - 1)]
+                 for i in xrange(lookups)]
+        random.shuffle(terms)
+
+        def statistics():
+            for term in terms:
+                mapped.term_statistics(term)
+
+        results = [('uncached', 1e6 * _best_time(statistics, repeat) / lookups, 'us/term')]
+        mapped.term_cache = TermCache(cache_bytes)
+        results.append(('cached', 1e6 * _best_time(statistics, repeat) / lookups, 'us/term'))
+        cache_statistics = mapped.term_cache.statistics()
+        mapped.close()
+        return results + [('hit ratio', cache_statistics['hit_ratio'], ''),
+                          ('cache size', cache_statistics['bytes'], 'bytes')]
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_snapshot(repeat=5):
+    """Time to open index snapshots of two sizes and look up one term."""
+    directory = tempfile.mkdtemp()
+    try:
+        results = []
+        for documents in (10000, 100000):
+            index = synthetic_index(vocabulary=documents // 2, documents=documents)
+            path = os.path.join(directory, 'index%d' % documents)
+            write_snapshot(index, path)
+            term = index.terms[len(index) // 2]
+
+            def open_snapshot():
+                mapped = MappedIndex(path)
+                mapped.postings(mapped.lookup(term))
+                mapped.close()
+
+            results.append(('open %d postings' % len(index.doc_ids),
+                            1e3 * _best_time(open_snapshot, repeat), 'ms'))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_matrix(repeat=3, documents=1000000):
+    """Time to rank three-term queries, one common term and two rarer ones,
+    with the inverted index and with the sparse matrix backend, over a
+    synthetic corpus of a million articles."""
+    if numpy is None:
+        return [('skipped', 0, 'NumPy and SciPy are not installed')]
+    index = numpy_synthetic_index(documents=documents)
+    scorer = MatrixScorer(index)
+    random = Random(2)
+    by_frequency = sorted(xrange(len(index)), key=index.document_frequency, reverse=True)
+    queries = [[index.terms[by_frequency[random.randrange(10)]],
+                index.terms[by_frequency[random.randrange(100, 1000)]],
+                index.terms[by_frequency[random.randrange(1000, len(index))]]]
+               for i in xrange(5)]
+    for query in queries:
+        expected, ranking = index.rank(query), scorer.rank(query)
+        assert [doc_id for score, doc_id in expected] == [doc_id for score, doc_id in ranking]
+        assert numpy.allclose([score for score, doc_id in expected],
+                              [score for score, doc_id in ranking])
+
+    def rank_with(backend):
+        return lambda: [backend.rank(query) for query in queries]
+
+    postings = sum(index.document_frequency(index.lookup(term))
+                   for query in queries for term in query) / len(queries)
+    return [('postings per query', postings, 'postings'),
+            ('index', 1e3 * _best_time(rank_with(index), repeat) / len(queries), 'ms/query'),
+            ('matrix', 1e3 * _best_time(rank_with(scorer), repeat) / len(queries), 'ms/query')]
+
+
+def bench_topk(repeat=3, k=10, depth=1000):
+    """Time to find the best k articles for two-term queries of common terms,
+    ranking every match against top_k, and to find the k following the
+    depth-th best with top_k, as the corpus grows. The impact ordered
+    postings are computed before timing."""
+    results = []
+    for documents in (10000, 100000, 1000000):
+        index = synthetic_index(vocabulary=2000, documents=documents)
+        random = Random(3)
+        by_frequency = sorted(xrange(len(index)), key=index.document_frequency,
+                              reverse=True)
+        queries = [[index.terms[by_frequency[random.randrange(2, 50)]]
+                    for j in xrange(2)] for i in xrange(5)]
+        for query in queries:
+            assert index.top_k(query, k) == index.rank(query)[:k]
+
+        def rank():
+            return [index.rank(query)[:k] for query in queries]
+
+        def top_k():
+            return [index.top_k(query, k) for query in queries]
+
+        cursors = [index.top_k(query, depth)[-1] for query in queries]
+        def deep_page():
+            return [index.top_k(query, k, cursor)
+                    for query, cursor in izip(queries, cursors)]
+
+        results.extend([
+            ('rank %d articles' % documents,
+             1e3 * _best_time(rank, repeat) / len(queries), 'ms/query'),
+            ('top_k %d articles' % documents,
+             1e6 * _best_time(top_k, repeat) / len(queries), 'us/query'),
+            ('top_k after %d, %d articles' % (depth, documents),
+             1e6 * _best_time(deep_page, repeat) / len(queries), 'us/query')])
+    return results
+
+
+def bench_scoring(repeat=3, k=10, documents=100000):
+    """Time to rank two-term queries of common terms in full and to find
+    their best k articles with top_k by each scoring model, the impact
+    ordered postings of each being computed before timing."""
+    index = synthetic_index(vocabulary=2000, documents=documents)
+    random = Random(4)
+    by_frequency = sorted(xrange(len(index)), key=index.document_frequency, reverse=True)
+    queries = [[index.terms[by_frequency[random.randrange(2, 50)]] for j in xrange(2)]
+               for i in xrange(5)]
+    results = []
+    for name, model in sorted(SCORING_MODELS.iteritems()):
+        for query in queries:
+            assert index.top_k(query, k, model=model) == index.rank(query, model)[:k]
+
+        def rank():
+            return [index.rank(query, model) for query in queries]
+
+        def top_k():
+            return [index.top_k(query, k, model=model) for query in queries]
+
+        results.extend([
+            ('rank by %s' % name, 1e3 * _best_time(rank, repeat) / len(queries), 'ms/query'),
+            ('top_k by %s' % name, 1e6 * _best_time(top_k, repeat) / len(queries),
+             'us/query')])
+    return results
+
+
+def bench_shards(repeat=3, k=10, documents=200000, shard_counts=(1, 2, 4)):
+    """Time to score the articles matching two common terms and keep the best
+    k, as for a query needing both, on the index and on ShardedSearchers of
+    each number of shards, and the speedup of each over the index. The
+    speedup is bounded by the number of CPUs, which is reported too."""
+    index = synthetic_index(vocabulary=2000, documents=documents)
+    random = Random(6)
+    by_frequency = sorted(xrange(len(index)), key=index.document_frequency, reverse=True)
+    queries = [[index.terms[by_frequency[random.randrange(10)]] for j in xrange(2)]
+               for i in xrange(3)]
+    matches = [index.find(query) for query in queries]
+
+    def top_k_of(backend):
+        return lambda: [backend.top_k_of(query, doc_ids, k)
+                        for query, doc_ids in izip(queries, matches)]
+
+    unsharded = _best_time(top_k_of(index), repeat) / len(queries)
+    results = [('CPUs', multiprocessing.cpu_count(), 'CPUs'),
+               ('matches per query', sum(map(len, matches)) / len(queries), 'articles'),
+               ('index', 1e3 * unsharded, 'ms/query')]
+    for shard_count in shard_counts:
+        searcher = ShardedSearcher(index, shard_count)
+        try:
+            for query, doc_ids in izip(queries, matches):
+                assert searcher.top_k_of(query, doc_ids, k) == index.top_k_of(query, doc_ids, k)
+            sharded = _best_time(top_k_of(searcher), repeat) / len(queries)
+        finally:
+            searcher.close()
+        results.extend([('%d shards' % shard_count, 1e3 * sharded, 'ms/query'),
+                        ('%d shards speedup' % shard_count, unsharded / sharded, 'x')])
+    return results
+
+
+def _read_frequencies(path, pragmas, seconds, terms, reads):
+    # count the lookups of a term's postings made in seconds
+    connection = sqlite3.connect(path, timeout=20)
+    configure_sqlite(connection, pragmas)
+    random = Random(os.getpid())
+    lookups = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection.execute('SELECT article, frequency FROM frequency WHERE term = ?',
+                           (random.randrange(terms),)).fetchall()
+        lookups += 1
+    connection.close()
+    reads.put(lookups)
+
+
+def _write_frequencies(path, pragmas, seconds, terms, batch, writes):
+    # insert batches of rows, a transaction each, as a bulk load does, for
+    # seconds, and count the rows
+    connection = sqlite3.connect(path, timeout=20)
+    configure_sqlite(connection, pragmas)
+    random = Random(1)
+    inserted = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection.executemany('INSERT INTO frequency VALUES (?, ?, ?)',
+                               [(random.randrange(terms), inserted + i, 1)
+                                for i in xrange(batch)])
+        connection.commit()
+        inserted += batch
+    connection.close()
+    writes.put(inserted)
+
+
+def bench_concurrency(seconds=3, readers=2, terms=10000, rows=200000, batch=20000):
+    """Throughput of processes looking up term frequencies in a SQLite file,
+    alone and while another process inserts rows in transactions of batch
+    rows, as loadarticles does, with a rollback journal and with the
+    settings.PUBMED_SQLITE_PRAGMAS profile, in which readers are read-only,
+    as search views are."""
+    tuned = list(getattr(settings, 'PUBMED_SQLITE_PRAGMAS', ()))
+    profiles = [('rollback journal', [('journal_mode', 'DELETE')], []),
+                ('tuned', tuned, [('query_only', 'ON')])]
+    results = [('CPUs', multiprocessing.cpu_count(), 'CPUs')]
+    for name, pragmas, reader_pragmas in profiles:
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bench.db')
+            connection = sqlite3.connect(path)
+            configure_sqlite(connection, pragmas)
+            connection.execute('CREATE TABLE frequency (term INTEGER, article INTEGER, '
+                               'frequency INTEGER)')
+            connection.execute('CREATE INDEX frequency_term ON frequency (term)')
+            random = Random(0)
+            connection.executemany('INSERT INTO frequency VALUES (?, ?, ?)',
+                                   ((random.randrange(terms), i, 1) for i in xrange(rows)))
+            connection.commit()
+            connection.close()
+
+            for loading in (False, True):
+                reads = multiprocessing.Queue()
+                writes = multiprocessing.Queue()
+                processes = [multiprocessing.Process(
+                    target=_read_frequencies,
+                    args=(path, pragmas + reader_pragmas, seconds, terms, reads))
+                    for i in xrange(readers)]
+                if loading:
+                    processes.append(multiprocessing.Process(
+                        target=_write_frequencies,
+                        args=(path, pragmas, seconds, terms, batch, writes)))
+                for process in processes:
+                    process.start()
+                read_count = sum(reads.get() for i in xrange(readers))
+                write_count = writes.get() if loading else 0
+                for process in processes:
+                    process.join()
+                if loading:
+                    results.extend([
+                        ('%s reads while loading' % name, read_count / float(seconds),
+                         'reads/s'),
+                        ('%s rows loaded' % name, write_count / float(seconds), 'rows/s')])
+                else:
+                    results.append(('%s reads' % name, read_count / float(seconds),
+                                    'reads/s'))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def _sample_copies(copy_numbers):
+    # copies of the sample articles with PubMed URLs of their own
+    records = list(iter_records(SAMPLE_ARTICLES))
+    for copy in copy_numbers:
+        for record in records:
+            yield dict(record, pubmedUrl=u'%s?copy=%d' % (record['pubmedUrl'], copy))
+
+
+def _search(seconds, queries, searches):
+    # search through the API view for seconds, after one search to load the
+    # index, and count the searches made
+    for connection in connections.all():
+        connection.close()
+    client = Client()
+    random = Random(os.getpid())
+    client.get('/api/search/', {'q': queries[0]})
+    made = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        client.get('/api/search/', {'q': random.choice(queries)})
+        made += 1
+    searches.put(made)
+
+
+def _load(seconds, first_copy, batch, loaded):
+    # load new copies of the sample articles in bulk for seconds
+    for connection in connections.all():
+        connection.close()
+    end = time.time() + seconds
+    records = takewhile(lambda record: time.time() < end,
+                        _sample_copies(count(first_copy)))
+    loader = BulkLoader(batch_size=batch)
+    loader.load(records)
+    loaded.put(loader.records_read)
+
+
+def bench_search_during_load(seconds=3, copies=25, readers=2, batch=50):
+    """Searches per second through the search API view, by processes reading
+    a temporary database of copies of the sample articles set up as in
+    settings, alone and while another process loads more copies in bulk,
+    with the index rebuilt on the first search after each batch and with
+    settings.PUBMED_INDEX_REBUILD_INTERVAL. Results are not cached."""
+    interval = getattr(settings, 'PUBMED_INDEX_REBUILD_INTERVAL', 0)
+    directory = tempfile.mkdtemp()
+    names = {}
+    try:
+        path = os.path.join(directory, 'bench.db')
+        for alias in connections:
+            connections[alias].close()
+            names[alias] = connections[alias].settings_dict['NAME']
+            connections[alias].settings_dict['NAME'] = path
+        call_command('syncdb', interactive=False, verbosity=0)
+        BulkLoader().load(_sample_copies(xrange(copies)))
+        records = list(iter_records(SAMPLE_ARTICLES))
+        tokenizer = Tokenizer(settings.ACCEPTABLE_CHARACTERS, STOP_WORDS)
+        queries = [' '.join(tokenizer.tokenize(record['title'])[:3]) for record in records]
+
+        results = [('CPUs', multiprocessing.cpu_count(), 'CPUs'),
+                   ('articles', copies * len(records), 'articles')]
+        first_copy = copies
+        for label, rebuild_interval, loading in (
+                ('searches', interval, False),
+                ('searches while loading, rebuilt after each batch', 0, True),
+                ('searches while loading, rebuilt every %ds' % interval, interval, True)):
+            with override_settings(PUBMED_INDEX_SNAPSHOT=None, PUBMED_SEARCH_CACHE=None,
+                                   PUBMED_INDEX_REBUILD_INTERVAL=rebuild_interval,
+                                   DEBUG=False):
+                searches = multiprocessing.Queue()
+                loaded = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=_search,
+                                                     args=(seconds, queries, searches))
+                             for i in xrange(readers)]
+                if loading:
+                    processes.append(multiprocessing.Process(
+                        target=_load, args=(seconds, first_copy, batch, loaded)))
+                for process in processes:
+                    process.start()
+                search_count = sum(searches.get() for i in xrange(readers))
+                results.append((label, search_count / float(seconds), 'searches/s'))
+                if loading:
+                    loaded_count = loaded.get()
+                    first_copy += loaded_count // len(records) + 1
+                    results.append(('articles loaded, %s' % label.split(', ')[1],
+                                    loaded_count / float(seconds), 'articles/s'))
+                for process in processes:
+                    process.join()
+        return results
+    finally:
+        for alias, name in names.iteritems():
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = name
+        shutil.rmtree(directory)
+
+
+def bench_intersection(repeat=5, rare=100):
+    """Time to match articles containing both a rare term and a term in half
+    of all articles, by galloping through the posting lists and by
+    intersecting sets of their article ids, over corpora of 100k and 1M
+    documents."""
+    random = Random(5)
+    results = []
+    for documents in (100000, 1000000):
+        common_doc_ids = array('I', xrange(1, documents + 1, 2))
+        rare_doc_ids = array('I', sorted(random.sample(xrange(1, documents + 1), rare)))
+        index = InvertedIndex(
+            ['common', 'rare'],
+            array('I', [0, len(common_doc_ids), len(common_doc_ids) + rare]),
+            common_doc_ids + rare_doc_ids,
+            array('I', [1]) * (len(common_doc_ids) + rare), documents)
+        runs = [index.term_run('common'), index.term_run('rare')]
+        expected = sorted(set(common_doc_ids) & set(rare_doc_ids))
+        assert index.match_all(runs) == expected
+
+        def sets():
+            doc_ids = [set(sequence[start:end]) for sequence, start, end in runs]
+            return sorted(doc_ids[0] & doc_ids[1])
+
+        def gallop():
+            return index.match_all(runs)
+
+        results.extend([
+            ('sets, %d articles' % documents, 1e3 * _best_time(sets, repeat), 'ms'),
+            ('galloping, %d articles' % documents, 1e3 * _best_time(gallop, repeat), 'ms')])
+    return results
+
+
+def bench_related(repeat=3, articles=100, terms=20, related=10):
+    """Time to compute the truncated document vectors of every article of a
+    synthetic index of 100k articles, and to find the articles most similar
+    to a sample of them from their vectors, as buildrelated does, comparing
+    them on every term and only on terms in at most 10% of articles."""
+    index = synthetic_index()
+    index.norm(1)
+    sample = Random(6).sample(xrange(1, index.total_documents + 1), articles)
+    results = []
+    for label, max_document_frequency in (('all terms', None),
+                                          ('terms in <= 10%', index.total_documents // 10)):
+        vectors = index.document_vectors(terms, max_document_frequency)
+
+        def similar():
+            for doc_id in sample:
+                index.similar(vectors.get(doc_id, []), related, doc_id)
+
+        results.extend([
+            ('document vectors, %s' % label,
+             _best_time(lambda: index.document_vectors(terms, max_document_frequency), 1),
+             's'),
+            ('similar articles, %s' % label,
+             1e3 * _best_time(similar, repeat) / articles, 'ms/article')])
+    return results
+
+
+def bench_autosearch(vocabulary=5000000, queries=1000, terms=20, results=10):
+    """Latency of expanding partly typed words to terms and ranking the
+    articles containing them, as autosearch does, over a synthetic vocabulary
+    of five million terms."""
+    random = Random(4)
+    vocabulary = sorted(set('%010x' % random.getrandbits(40) for i in xrange(vocabulary)))
+    documents = len(vocabulary) // 2
+    index = InvertedIndex(
+        vocabulary, array('I', xrange(len(vocabulary) + 1)),
+        array('I', (random.randint(1, documents) for term in vocabulary)),
+        array('I', (1 + int(random.expovariate(1.0)) for term in vocabulary)),
+        documents)
+    prefixes = [random.choice(vocabulary)[:random.randint(1, 6)] for i in xrange(queries)]
+
+    def autosearch(prefix):
+        index.top_k(index.expand_prefix(prefix, terms), results)
+
+    latencies = sorted(_best_time(lambda: autosearch(prefix), 3) for prefix in prefixes)
+    return [('vocabulary', len(vocabulary), 'terms'),
+            ('median', 1e3 * latencies[len(latencies) // 2], 'ms'),
+            ('p99', 1e3 * latencies[int(len(latencies) * 0.99)], 'ms')]
+
+
+BENCHMARKS = {
+    'autosearch': bench_autosearch,
+    'concurrency': bench_concurrency,
+    'index': bench_index,
+    'intersection': bench_intersection,
+    'matrix': bench_matrix,
+    'related': bench_related,
+    'scoring': bench_scoring,
+    'searchload': bench_search_during_load,
+    'shards': bench_shards,
+    'snapshot': bench_snapshot,
+    'termcache': bench_term_cache,
+    'tokenizer': bench_tokenizer,
+    'topk': bench_topk,
+}
@@ -0,0 +1,250 @@
+"""Caching of search results and of the corpus version.
+
+Results are cached on the Django cache named by settings.PUBMED_SEARCH_CACHE,
+keyed by the kind of query, the corpus generation and the normalized query,
+so loading or deleting articles invalidates them without any cache being
+cleared: entries of older generations are no longer read and are evicted in
+time. The number of hits and misses of each kind is counted in the same
+cache and reported by cache_statistics.
+
+The corpus generation, and the time it changed, are cached for a few seconds
+too, for HTTP validators that are checked without a database query.
+
+What the current index knows of each query term is cached in the process
+by a TermCache, which is emptied whenever get_index replaces the index, and
+each index keeps the postings it has put in impact order in an ImpactCache.
+
+"""
+from __future__ import with_statement
+
+import hashlib
+import heapq
+import struct
+import sys
+import threading
+from itertools import count
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+# how long hit and miss counters live; the longest relative timeout memcached
+# accepts
+COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+
+# how long the corpus version is cached; a change made by another process,
+# such as loadarticles, is seen by web processes after at most this long
+CORPUS_VERSION_TIMEOUT = 5
+CORPUS_VERSION_KEY = 'pubmed_search:corpus-version'
+
+# bytes a TermCache entry takes besides its key: the tuple with its float,
+# an int for its last use, and a slot of hash, key and value in each of two
+# dicts, which are at most two-thirds full
+_TERM_ENTRY_BYTES = (sys.getsizeof((0, 0, 0.0)) + sys.getsizeof(0.0) + sys.getsizeof(0) +
+                     2 * 3 * struct.calcsize('P') * 3 // 2)
+
+# time of last use of each key of each LRUCache, by cache name
+_used = {}
+_clock = count()
+
+
+class LRUCache(LocMemCache):
+    """A LocMemCache that, when MAX_ENTRIES is reached, evicts the entries
+    least recently read or written, rather than arbitrary ones."""
+    def __init__(self, name, params):
+        super(LRUCache, self).__init__(name, params)
+        self._used = _used.setdefault(name, {})
+
+    def get(self, key, default=None, version=None):
+        missing = object()
+        value = super(LRUCache, self).get(key, missing, version)
+        if value is missing:
+            return default
+        self._used[self.make_key(key, version=version)] = next(_clock)
+        return value
+
+    def _set(self, key, value, timeout=None):
+        super(LRUCache, self)._set(key, value, timeout)
+        self._used[key] = next(_clock)
+
+    def _cull(self):
+        if self._cull_frequency == 0:
+            self.clear()
+        else:
+            doomed = heapq.nsmallest(max(1, len(self._cache) // self._cull_frequency),
+                                     self._cache, key=self._used.get)
+            for key in doomed:
+                self._delete(key)
+
+    def _delete(self, key):
+        super(LRUCache, self)._delete(key)
+        self._used.pop(key, None)
+
+    def clear(self):
+        super(LRUCache, self).clear()
+        self._used.clear()
+
+
+class TermCache(object):
+    """A process-local cache mapping the (generation, term) of an index's
+    terms to what the index knows of them, (term id, document frequency,
+    IDF), or None for terms it does not have. Its size is estimated as
+    entries are added, and when it passes max_bytes the least recently used
+    of every cull_frequency entries are evicted, as LRUCache does. Hits and
+    misses are counted. It may be used by several threads at once."""
+    def __init__(self, max_bytes, cull_frequency=8):
+        self.max_bytes = max_bytes
+        self.cull_frequency = cull_frequency
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def get(self, key, compute):
+        """Return the entry of key, or if it is not cached, compute(key),
+        caching it. compute is called without the cache locked, so other
+        threads may use the cache meanwhile."""
+        with self._lock:
+            self._used[key] = next(_clock)
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return entry
+        entry = compute(key)
+        with self._lock:
+            # another thread may have computed it, or culled it, meanwhile
+            if key not in self._entries:
+                self._entries[key] = entry
+                self.bytes += self._entry_bytes(key, entry)
+            self._used[key] = next(_clock)
+            if self.bytes > self.max_bytes:
+                self._cull()
+        return entry
+
+    def _cull(self):
+        doomed = heapq.nsmallest(max(1, len(self._entries) // self.cull_frequency),
+                                 self._entries, key=self._used.get)
+        for key in doomed:
+            self.bytes -= self._entry_bytes(key, self._entries.pop(key))
+            del self._used[key]
+
+    def _entry_bytes(self, key, entry):
+        return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + _TERM_ENTRY_BYTES
+
+    def clear(self):
+        """Empty the cache, keeping its hit and miss counts."""
+        with self._lock:
+            self._entries = {}
+            self._used = {}
+            self.bytes = 0
+
+    def statistics(self):
+        """Return a dict of the cache's hits, misses, hit ratio, number of
+        entries and estimated size in bytes."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                    'entries': len(self._entries), 'bytes': self.bytes}
+
+
+class ImpactCache(TermCache):
+    """A TermCache of the postings of an index in impact order, mapping
+    (model name, term id) to a pair of arrays, article ids and scores, whose
+    size is that of the arrays."""
+    def _entry_bytes(self, key, entry):
+        return sys.getsizeof(key) + sum(sys.getsizeof(column) for column in entry)
+
+
+_term_cache = None
+
+def get_term_cache():
+    """Return the process's TermCache, of settings.PUBMED_TERM_CACHE_BYTES,
+    creating it on first use, or None if terms are not cached."""
+    global _term_cache
+    max_bytes = getattr(settings, 'PUBMED_TERM_CACHE_BYTES', None)
+    if not max_bytes:
+        return None
+    if _term_cache is None or _term_cache.max_bytes != max_bytes:
+        _term_cache = TermCache(max_bytes)
+    return _term_cache
+
+
+def get_search_cache():
+    """Return the cache named by settings.PUBMED_SEARCH_CACHE, or None if
+    search results are not cached."""
+    alias = getattr(settings, 'PUBMED_SEARCH_CACHE', None)
+    if alias is None:
+        return None
+    return get_cache(alias)
+
+
+def get_corpus_version():
+    """Return the (generation, modified) of the Corpus set by
+    set_corpus_version, or None if it is not cached. Use
+    Corpus.objects.get_version instead, which falls back to the database."""
+    cache = get_search_cache()
+    if cache is None:
+        return None
+    return cache.get(CORPUS_VERSION_KEY)
+
+
+def set_corpus_version(version):
+    cache = get_search_cache()
+    if cache is not None:
+        cache.set(CORPUS_VERSION_KEY, version, CORPUS_VERSION_TIMEOUT)
+
+
+def forget_corpus_version():
+    cache = get_search_cache()
+    if cache is not None:
+        cache.delete(CORPUS_VERSION_KEY)
+
+
+def _count(cache, kind, outcome):
+    key = 'pubmed_search:%s:%s' % (outcome, kind)
+    cache.add(key, 0, COUNTER_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # evicted since it was added
+        cache.set(key, 1, COUNTER_TIMEOUT)
+
+
+def cached_query(kind, generation, query, compute):
+    """Return the result of compute() for a query of the corpus generation,
+    from the search cache if it is there, and put it there otherwise. kind
+    names what compute does and query is a tuple of everything else its
+    result depends on, with terms normalized, for instance sorted."""
+    cache = get_search_cache()
+    if cache is None:
+        return compute()
+    key = 'pubmed_search:%s:%d:%s' % (kind, generation,
+                                      hashlib.sha1(repr(query)).hexdigest())
+    result = cache.get(key)
+    if result is None:
+        _count(cache, kind, 'misses')
+        result = compute()
+        cache.set(key, result)
+    else:
+        _count(cache, kind, 'hits')
+    return result
+
+
+def cache_statistics(kinds=('search', 'autosearch')):
+    """Return a dict mapping each kind of query to a dict of its cache hits,
+    misses and hit ratio."""
+    cache = get_search_cache()
+    statistics = {}
+    for kind in kinds:
+        hits = misses = 0
+        if cache is not None:
+            hits = cache.get('pubmed_search:hits:%s' % kind, 0)
+            misses = cache.get('pubmed_search:misses:%s' % kind, 0)
+        lookups = hits + misses
+        statistics[kind] = {'hits': hits, 'misses': misses,
+                            'hit_ratio': float(hits) / lookups if lookups else 0.0}
+    return statistics
@@ -0,0 +1,88 @@
+"""Set-up of database connections, and routing of searches' reads.
+
+Every SQLite connection runs the pragmas of settings.PUBMED_SQLITE_PRAGMAS
+as it opens. By default they turn on write-ahead logging, under which
+readers neither wait for the one writer nor hold it up, relax syncing to
+the end of each checkpoint, enlarge the page cache, memory-map the file,
+keep temporary tables in memory and wait for locks rather than fail.
+
+The reads of views wrapped in read_only, such as the search views, are
+routed by SearchRouter, which must be in settings.DATABASE_ROUTERS, to the
+database alias named by settings.PUBMED_SEARCH_DATABASE: a second
+connection to the same file, which is opened read-only. Searches then read
+the last committed state of the database while loadarticles writes to it,
+rather than waiting for its transactions.
+
+"""
+import threading
+from functools import wraps
+
+from django.conf import settings
+
+
+_local = threading.local()
+
+
+def configure_sqlite(connection, pragmas):
+    """Run PRAGMA name = value for each (name, value) of pragmas on a DB-API
+    connection to SQLite."""
+    for name, value in pragmas:
+        connection.execute('PRAGMA %s = %s' % (name, value))
+
+
+def _search_database():
+    return getattr(settings, 'PUBMED_SEARCH_DATABASE', None)
+
+
+def configure_connection(sender, connection, **kwargs):
+    """Run the pragmas of settings.PUBMED_SQLITE_PRAGMAS on a new SQLite
+    connection, and make it read-only if it is of the search database. A
+    receiver of connection_created, connected in models.py."""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = list(getattr(settings, 'PUBMED_SQLITE_PRAGMAS', ()))
+    if connection.alias == _search_database():
+        pragmas.append(('query_only', 'ON'))
+    configure_sqlite(connection.connection, pragmas)
+
+
+def read_only(view):
+    """Decorate a view so that its reads go to the database alias named by
+    settings.PUBMED_SEARCH_DATABASE. Its writes, such as those counting a
+    new corpus, still go to the default database."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        reading = getattr(_local, 'read_only', False)
+        _local.read_only = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _local.read_only = reading
+    return wrapper
+
+
+class SearchRouter(object):
+    """Routes the reads of views wrapped in read_only to the database alias
+    named by settings.PUBMED_SEARCH_DATABASE, if there is one, and leaves
+    everything else to the default database."""
+    def db_for_read(self, model, **hints):
+        if getattr(_local, 'read_only', False):
+            return _search_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # django.db imports this module, so it is imported here
+        from django.db import DEFAULT_DB_ALIAS
+        # the aliases are connections to the same database
+        databases = (DEFAULT_DB_ALIAS, _search_database())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db == _search_database():
+            return False
+        return None
@@ -1,5 +1,52 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
 from django import forms
+from django.conf import settings
+
+from pubmed_search.nlp import SCORING_MODELS
+
+
+def encode_cursor(score, doc_id):
+    """Return an opaque string for a (score, article id) entry of a search
+    ranking, from which the next page of results starts."""
+    return urlsafe_b64encode('%r:%d' % (score, doc_id))
+
+
+def decode_cursor(cursor):
+    """Return the (score, article id) entry encoded by encode_cursor, or
+    raise ValueError."""
+    try:
+        score, doc_id = urlsafe_b64decode(cursor.encode('ascii')).split(':')
+        return float(score), int(doc_id)
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+
+
+# the most results one request for a page of search results may ask for
+MAX_LIMIT = 1000
 
 
 class SearchForm(forms.Form):
     q = forms.CharField(max_length=255)
+    after = forms.CharField(max_length=100, required=False)
+    limit = forms.IntegerField(min_value=1, max_value=MAX_LIMIT, required=False)
+    operator = forms.ChoiceField(choices=[('OR', 'Any word'), ('AND', 'All words')],
+                                 required=False)
+    model = forms.ChoiceField(choices=sorted((name, model.label)
+                                             for name, model in SCORING_MODELS.iteritems()),
+                              required=False)
+
+    def clean_after(self):
+        after = self.cleaned_data['after']
+        if not after:
+            return None
+        try:
+            return decode_cursor(after)
+        except ValueError:
+            raise forms.ValidationError("Invalid page.")
+
+    def clean_operator(self):
+        return self.cleaned_data['operator'] or settings.PUBMED_SEARCH_DEFAULT_OPERATOR
+
+    def clean_model(self):
+        return self.cleaned_data['model'] or settings.PUBMED_SCORING_MODEL
@@ -0,0 +1,926 @@
+"""An in-memory inverted index over the Frequency table.
+
+The vocabulary is a sorted list of terms, so a term's id is its position in
+the list. The posting lists of all terms are stored end to end in two
+array('I') columns, doc_ids (article primary keys, ascending within each
+term) and frequencies, and offsets[term_id]:offsets[term_id + 1] is the slice
+belonging to each term. The positions of each posting's term in its article
+are stored end to end in a third column, positions, and
+position_offsets[posting]:position_offsets[posting + 1] is the slice
+belonging to each posting. Apart from the vocabulary, the index holds no
+Python object per posting.
+
+Besides ranking the articles containing any of a query's terms, the index
+matches articles containing all of them, by intersecting the terms' posting
+lists, and articles containing them as a phrase, by comparing their
+positions in the articles of that intersection. The intersection walks the
+shortest list and gallops through the others, so its cost grows with the
+number of articles containing the rarest term, not the most common.
+
+The database remains the source of truth: get_index rebuilds the index
+when Corpus.generation shows that articles have changed, but no sooner than
+settings.PUBMED_INDEX_REBUILD_INTERVAL seconds after it last did, serving
+the index it has until then, so that searches made while loadarticles
+writes batch after batch do not each read the Frequency table again. The
+index it returns looks query terms up through the process's TermCache,
+which it empties then, so that the id, document frequency and IDF of terms
+in common use are found without searching the vocabulary.
+
+An index can also be written to a snapshot file with write_snapshot, for
+instance by the buildindex command, and opened as a MappedIndex. Snapshots
+are memory-mapped rather than read, so opening one takes the same time
+whatever the size of the corpus, and every process on a host shares the
+same pages of the file through the page cache. The file holds a header
+followed by these sections, each aligned to 8 bytes and little-endian:
+
+    term offsets      uint32 x (terms + 1)   byte offsets into the vocabulary
+    vocabulary        UTF-8 terms, end to end, in sorted order
+    posting offsets   uint32 x (terms + 1)
+    doc ids           uint32 x postings
+    frequencies       uint32 x postings
+    idf               float64 x terms
+    norm doc ids      uint32 x documents     ascending
+    norms             float64 x documents    L2 norm of each TF-IDF vector
+    position offsets  uint32 x (postings + 1)
+    positions         uint32 x positions
+    lengths           uint32 x (highest article id + 1)   terms per article
+
+"""
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from itertools import chain, izip
+
+from django.conf import settings
+
+from pubmed_search.cache import ImpactCache, get_term_cache
+from pubmed_search.models import Article, Corpus, Frequency
+from pubmed_search.nlp import SCORING_MODELS, TFIDF, decode_positions, idf
+
+
+SNAPSHOT_MAGIC = 'PMIX'
+SNAPSHOT_VERSION = 3
+# magic, version, generation, total documents, terms, postings, documents,
+# vocabulary bytes, positions, lengths, total length
+_HEADER = struct.Struct('<4sI9Q')
+
+# terms of the vocabulary of which expand_prefix keeps the greatest document
+# frequency, to pass over those with none frequent enough
+PREFIX_BLOCK_SIZE = 128
+
+
+def _prefix_end(terms, prefix, start=0):
+    # the id past the last of the sorted terms beginning with prefix: they
+    # sort before prefix with its last character incremented
+    stem = prefix.rstrip(unichr(sys.maxunicode))
+    if not stem:
+        return len(terms)
+    return bisect_left(terms, stem[:-1] + unichr(ord(stem[-1]) + 1), start)
+
+
+class InvertedIndex(object):
+    def __init__(self, terms, offsets, doc_ids, frequencies, total_documents,
+                 generation=0, position_offsets=None, positions=None,
+                 lengths=None, total_length=None):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+        self.total_documents = total_documents
+        self.generation = generation
+        if position_offsets is None:
+            # no positions are known, so no phrase matches
+            position_offsets = array('I', [0]) * (len(doc_ids) + 1)
+            positions = array('I')
+        self.position_offsets = position_offsets
+        self.positions = positions
+        # the length of each article, by id, and of all of them, which
+        # document_lengths computes if they are not given
+        self.lengths = lengths
+        self.total_length = total_length
+        # a TermCache through which terms are looked up, if any
+        self.term_cache = None
+        # when the corpus reached the index's generation, set by get_index
+        self.modified = None
+        self._impacts = _impact_cache()
+        # the greatest document frequency of each block of PREFIX_BLOCK_SIZE
+        # terms, or 0 until expand_prefix has found it
+        self._block_maxima = array('I', [0]) * (len(terms) // PREFIX_BLOCK_SIZE + 1)
+
+    @classmethod
+    def build(cls):
+        """Return an InvertedIndex of the Frequency table."""
+        corpus = Corpus.objects.get_current()
+        terms = []
+        offsets = array('I', [0])
+        doc_ids = array('I')
+        frequencies = array('I')
+        position_offsets = array('I', [0])
+        positions = array('I')
+        # by article id, not by the article's own ordering, which is by title
+        rows = Frequency.objects.order_by('term__term', 'article__id').values_list(
+            'term__term', 'article', 'frequency', 'positions')
+        for term, doc_id, tf, term_positions in rows.iterator():
+            if not terms or term != terms[-1]:
+                if terms:
+                    offsets.append(len(doc_ids))
+                terms.append(term)
+            doc_ids.append(doc_id)
+            frequencies.append(tf)
+            positions.extend(decode_positions(term_positions))
+            position_offsets.append(len(positions))
+        if terms:
+            offsets.append(len(doc_ids))
+
+        # article lengths are counted when articles are loaded
+        lengths = array('I')
+        for doc_id, length in Article.objects.order_by('pk').values_list(
+                'pk', 'length').iterator():
+            lengths.extend([0] * (doc_id - len(lengths)))
+            lengths.append(length)
+
+        index = cls(terms, offsets, doc_ids, frequencies, corpus.documents,
+                    corpus.generation, position_offsets, positions,
+                    lengths, corpus.length)
+        if any(terms[i] > terms[i + 1] for i in xrange(len(terms) - 1)):
+            # the database collates some characters differently from Python
+            index = index._sorted()
+        return index
+
+    def _sorted(self):
+        order = sorted(xrange(len(self.terms)), key=self.terms.__getitem__)
+        offsets = array('I', [0])
+        doc_ids = array('I')
+        frequencies = array('I')
+        position_offsets = array('I', [0])
+        positions = array('I')
+        for term_id in order:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids.extend(self.doc_ids[start:end])
+            frequencies.extend(self.frequencies[start:end])
+            offsets.append(len(doc_ids))
+            first, last = self.position_offsets[start], self.position_offsets[end]
+            shift = len(positions) - first
+            positions.extend(self.positions[first:last])
+            position_offsets.extend(offset + shift for offset in
+                                    self.position_offsets[start + 1:end + 1])
+        return InvertedIndex([self.terms[term_id] for term_id in order], offsets,
+                             doc_ids, frequencies, self.total_documents,
+                             self.generation, position_offsets, positions,
+                             self.lengths, self.total_length)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def lookup(self, term):
+        """Return the id of term, or None if no article contains it."""
+        statistics = self.term_statistics(term)
+        if statistics is None:
+            return None
+        return statistics[0]
+
+    def term_statistics(self, term):
+        """Return the (term id, document frequency, IDF) of term, or None if
+        no article contains it, from the term_cache if there is one."""
+        if self.term_cache is None:
+            return self._term_statistics(term)
+        # the cache is shared with other indexes, which may be still in use
+        return self.term_cache.get((self.generation, term),
+                                   lambda key: self._term_statistics(term))
+
+    def _term_statistics(self, term):
+        term_id = bisect_left(self.terms, term)
+        if term_id < len(self.terms) and self.terms[term_id] == term:
+            return term_id, self.document_frequency(term_id), self.idf(term_id)
+        return None
+
+    def resolve(self, terms, model=None):
+        """Return a list of the (term id, IDF by model, TF-IDF by default)
+        of each of terms, which must be in the index."""
+        model = _model(model)
+        resolved = []
+        for term in terms:
+            term_id, document_frequency, term_idf = self.term_statistics(term)
+            if model.name != TFIDF.name:
+                term_idf = model.idf(document_frequency, self.total_documents)
+            resolved.append((term_id, term_idf))
+        return resolved
+
+    def expand_prefix(self, prefix, limit):
+        """Return up to limit terms beginning with prefix, those in the most
+        documents first, and of those, the first in the vocabulary. They are
+        a contiguous run of the vocabulary, found by binary search, which is
+        searched a block of PREFIX_BLOCK_SIZE terms at a time, from the block
+        with the most frequent term, until no block left can hold one of the
+        limit most frequent. Only the terms picked are read."""
+        if not prefix or limit < 1:
+            return []
+        terms = self.terms
+        start = bisect_left(terms, prefix)
+        end = _prefix_end(terms, prefix, start)
+        first_block = -(-start // PREFIX_BLOCK_SIZE)
+        last_block = end // PREFIX_BLOCK_SIZE
+        # the best limit terms so far, as (document frequency, -term id),
+        # best first
+        best = []
+        if first_block >= last_block:
+            self._add_expansions(best, limit, start, end)
+            blocks = []
+        else:
+            self._add_expansions(best, limit, start, first_block * PREFIX_BLOCK_SIZE)
+            self._add_expansions(best, limit, last_block * PREFIX_BLOCK_SIZE, end)
+            blocks = [(-self._block_maximum(block), block)
+                      for block in xrange(first_block, last_block)]
+            heapq.heapify(blocks)
+        while blocks and (len(best) < limit or
+                          (-blocks[0][0], -blocks[0][1] * PREFIX_BLOCK_SIZE) > best[-1]):
+            block = heapq.heappop(blocks)[1] * PREFIX_BLOCK_SIZE
+            self._add_expansions(best, limit, block, block + PREFIX_BLOCK_SIZE)
+        return [terms[-negative_id] for frequency, negative_id in best]
+
+    def _term_frequencies(self, start, end):
+        # the document frequencies of the terms with ids from start to end
+        offsets = self.offsets[start:end + 1]
+        return [next_offset - offset for offset, next_offset in izip(offsets, offsets[1:])]
+
+    def _add_expansions(self, best, limit, start, end):
+        # add the terms with ids from start to end to the best limit
+        # expansions
+        entries = izip(self._term_frequencies(start, end), xrange(-start, -end, -1))
+        best[:] = heapq.nlargest(limit, chain(best, entries))
+
+    def _block_maximum(self, block):
+        maximum = self._block_maxima[block]
+        if not maximum:
+            start = block * PREFIX_BLOCK_SIZE
+            maximum = max(self._term_frequencies(start, start + PREFIX_BLOCK_SIZE))
+            self._block_maxima[block] = maximum
+        return maximum
+
+    def document_frequency(self, term_id):
+        return self.offsets[term_id + 1] - self.offsets[term_id]
+
+    def idf(self, term_id):
+        return idf(self.document_frequency(term_id), self.total_documents)
+
+    def idf_array(self):
+        """Return an array('d') of the IDF of every term, by term id."""
+        return array('d', [self.idf(term_id) for term_id in xrange(len(self))])
+
+    def postings(self, term_id):
+        """Return the doc_ids and frequencies arrays of a term."""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.frequencies[start:end]
+
+    def frequency(self, term_id, doc_id):
+        """Return the frequency of a term in an article, 0 if it is not in
+        the article."""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        position = bisect_left(self.doc_ids, doc_id, start, end)
+        if position < end and self.doc_ids[position] == doc_id:
+            return self.frequencies[position]
+        return 0
+
+    def term_positions(self, posting):
+        """Return an array of the positions of the term of a posting, given
+        by its position in doc_ids, in the posting's article."""
+        return self.positions[self.position_offsets[posting]:
+                              self.position_offsets[posting + 1]]
+
+    def document_norms(self):
+        """Return an array of the ids of the articles in the index, ascending,
+        and an array of the L2 norms of their TF-IDF vectors."""
+        squares = {}
+        for term_id in xrange(len(self.terms)):
+            term_idf = self.idf(term_id)
+            doc_ids, frequencies = self.postings(term_id)
+            for doc_id, tf in izip(doc_ids, frequencies):
+                weight = tf*term_idf
+                squares[doc_id] = squares.get(doc_id, 0.0) + weight*weight
+        doc_ids = sorted(squares)
+        return (array('I', doc_ids),
+                array('d', [math.sqrt(squares[doc_id]) for doc_id in doc_ids]))
+
+    def norm(self, doc_id):
+        """Return the L2 norm of the TF-IDF vector of an article."""
+        if getattr(self, '_norms', None) is None:
+            self._norms = self.document_norms()
+        doc_ids, norms = self._norms
+        position = bisect_left(doc_ids, doc_id)
+        if position < len(doc_ids) and doc_ids[position] == doc_id:
+            return norms[position]
+        return 0.0
+
+    def document_vectors(self, limit, max_document_frequency=None):
+        """Return a dict mapping the id of each article in the index to its
+        TF-IDF vector, divided by its L2 norm, cut to the limit terms of
+        highest weight, as a list of (term id, weight) pairs, highest weight
+        first. Terms whose weight is not positive are left out, and so are
+        terms in more than max_document_frequency articles, if it is given:
+        they say little about what an article is about, and their long
+        posting lists would dominate the cost of similar."""
+        heaps = {}
+        for term_id in xrange(len(self.terms)):
+            term_idf = self.idf(term_id)
+            if term_idf <= 0 or (max_document_frequency is not None and
+                                 self.document_frequency(term_id) > max_document_frequency):
+                continue
+            doc_ids, frequencies = self.postings(term_id)
+            for doc_id, tf in izip(doc_ids, frequencies):
+                heap = heaps.get(doc_id)
+                if heap is None:
+                    heap = heaps[doc_id] = []
+                if len(heap) < limit:
+                    heapq.heappush(heap, (tf*term_idf, term_id))
+                elif (tf*term_idf, term_id) > heap[0]:
+                    heapq.heapreplace(heap, (tf*term_idf, term_id))
+        vectors = {}
+        for doc_id, heap in heaps.iteritems():
+            norm = self.norm(doc_id)
+            heap.sort(reverse=True)
+            vectors[doc_id] = [(term_id, weight / norm) for weight, term_id in heap]
+        return vectors
+
+    def similar(self, vector, k, exclude=None):
+        """Given a vector from document_vectors, return (cosine similarity,
+        article id) pairs for the k articles most similar to it, best first,
+        ties broken by article id, leaving out the article exclude. Only the
+        postings of the terms of the vector are read, so an article's
+        similarity counts only the terms it shares with them."""
+        if k <= 0:
+            return []
+        products = {}
+        get = products.get
+        for term_id, weight in vector:
+            term_weight = weight*self.idf(term_id)
+            doc_ids, frequencies = self.postings(term_id)
+            for doc_id, tf in izip(doc_ids, frequencies):
+                products[doc_id] = get(doc_id, 0.0) + term_weight*tf
+        products.pop(exclude, None)
+        if getattr(self, '_norms_by_id', None) is None:
+            # many articles are compared at a time, so norms are kept in a
+            # dict rather than searched for
+            self._norms_by_id = dict(izip(*self.document_norms()))
+        norms = self._norms_by_id
+        best = heapq.nsmallest(k, [(-product / norms[doc_id], doc_id)
+                                   for doc_id, product in products.iteritems()])
+        return [(-negative_similarity, doc_id) for negative_similarity, doc_id in best]
+
+    def _matching(self, terms):
+        doc_ids = set()
+        for term in terms:
+            term_id = self.lookup(term)
+            if term_id is not None:
+                doc_ids.update(self.postings(term_id)[0])
+        return doc_ids
+
+    def find(self, terms):
+        """Return a sorted list of the ids of the articles containing any of
+        terms."""
+        return sorted(self._matching(terms))
+
+    def count(self, terms):
+        """Return the number of articles containing any of terms."""
+        return len(self._matching(terms))
+
+    def term_run(self, term):
+        """Return the ids of the articles containing term as a run: a
+        (sequence, start, end) triple where sequence[start:end] is ascending.
+        The run is a slice of doc_ids, so positions in it are postings."""
+        term_id = self.lookup(term)
+        if term_id is None:
+            return (), 0, 0
+        return self.doc_ids, self.offsets[term_id], self.offsets[term_id + 1]
+
+    def match_any(self, runs):
+        """Return a sorted list of the article ids in any of runs."""
+        doc_ids = set()
+        for sequence, start, end in runs:
+            doc_ids.update(sequence[start:end])
+        return sorted(doc_ids)
+
+    def match_all(self, runs):
+        """Return a sorted list of the article ids in every one of runs."""
+        return [doc_id for doc_id, positions in _intersect(runs)]
+
+    def match_phrase(self, terms):
+        """Return a sorted list of the ids of the articles containing terms
+        one after another."""
+        runs = [self.term_run(term) for term in terms]
+        matches = []
+        for doc_id, postings in _intersect(runs):
+            # the positions at which the phrase would start, given each term
+            starts = set(self.term_positions(postings[0]))
+            for offset in xrange(1, len(postings)):
+                if not starts:
+                    break
+                starts.intersection_update(
+                    [position - offset for position in self.term_positions(postings[offset])])
+            if starts:
+                matches.append(doc_id)
+        return matches
+
+    def top_k_of(self, terms, doc_ids, k, after=None, model=None):
+        """Like top_k, but rank only the articles whose ids are in doc_ids,
+        such as the matches of a query that needs more than one of terms.
+        Each article is scored, so this costs time in proportion to the
+        number of ids rather than to the postings of terms."""
+        terms = self.known_terms(terms)
+        if k <= 0 or not terms:
+            return []
+        model = _model(model)
+        resolved = self.resolve(terms, model)
+        term_ids = [term_id for term_id, term_idf in resolved]
+        idfs = [term_idf for term_id, term_idf in resolved]
+        ranking = [(self._best_score(term_ids, idfs, doc_id, model), doc_id)
+                   for doc_id in doc_ids]
+        if after is not None:
+            ranking = [(score, doc_id) for score, doc_id in ranking
+                       if not _ranks_before(score, doc_id, after)]
+        return heapq.nsmallest(k, ranking, key=lambda result: (-result[0], result[1]))
+
+    def tfidf_batch(self, terms, doc_ids, model=None):
+        """Like nlp.tfidf_batch, but given term strings and article ids,
+        return a dict mapping (term, article id) to the TF-IDF of the term in
+        the article, or its score by model. Terms not in the index are left
+        out."""
+        doc_ids = set(doc_ids)
+        scores = {}
+        for term in terms:
+            term_id = self.lookup(term)
+            if term_id is None:
+                continue
+            for doc_id in doc_ids:
+                scores[(term, doc_id)] = 0
+            term_doc_ids, weights = self.posting_scores(term_id, model)
+            for doc_id, weight in izip(term_doc_ids, weights):
+                if doc_id in doc_ids:
+                    scores[(term, doc_id)] = weight
+        return scores
+
+    def known_terms(self, terms):
+        """Return the distinct terms of terms that are in the index, sorted."""
+        return sorted(set(term for term in terms if self.lookup(term) is not None))
+
+    def document_lengths(self):
+        """Return an array of the length in terms of every article, indexed
+        by article id. An index built without them sums the frequencies of
+        each article's postings on first use."""
+        if self.lengths is None:
+            lengths = array('I', [0]) * (max(self.doc_ids) + 1 if len(self.doc_ids) else 1)
+            for doc_id, tf in izip(self.doc_ids, self.frequencies):
+                lengths[doc_id] += tf
+            self.lengths = lengths
+        if self.total_length is None:
+            self.total_length = sum(self.lengths)
+        return self.lengths
+
+    def average_length(self):
+        """Return the average length of the articles in terms."""
+        self.document_lengths()
+        if not self.total_documents:
+            return 0.0
+        return float(self.total_length) / self.total_documents
+
+    def model_idf(self, term_id, model):
+        """Return the IDF of a term by a ScoringModel."""
+        return model.idf(self.document_frequency(term_id), self.total_documents)
+
+    def posting_scores(self, term_id, model=None):
+        """Return the doc_ids array of a term and a list of the score of the
+        term in each of their articles by model, TF-IDF by default, computed
+        for the whole posting list at once."""
+        model = _model(model)
+        doc_ids, frequencies = self.postings(term_id)
+        lengths = None
+        if model.uses_lengths:
+            document_lengths = self.document_lengths()
+            lengths = [document_lengths[doc_id] for doc_id in doc_ids]
+        return doc_ids, model.weights(frequencies, lengths, self.model_idf(term_id, model),
+                                      self.average_length())
+
+    def score(self, term_id, doc_id, model=None, term_idf=None):
+        """Return the score of a term in an article by model, TF-IDF by
+        default, 0 if it is not in the article."""
+        model = _model(model)
+        tf = self.frequency(term_id, doc_id)
+        if not tf:
+            return 0.0
+        if term_idf is None:
+            term_idf = self.model_idf(term_id, model)
+        lengths = None
+        if model.uses_lengths:
+            lengths = [self.document_lengths()[doc_id]]
+        return model.weights([tf], lengths, term_idf, self.average_length())[0]
+
+    def term_scores(self, terms, model=None):
+        """Return the terms of a query found in the index, sorted, and a dict
+        mapping the id of each article containing any of them to a list of
+        the score of each of those terms in the article by model, TF-IDF by
+        default."""
+        terms = self.known_terms(terms)
+        scores = {}
+        for position, term in enumerate(terms):
+            doc_ids, weights = self.posting_scores(self.lookup(term), model)
+            for doc_id, weight in izip(doc_ids, weights):
+                if doc_id not in scores:
+                    scores[doc_id] = [0] * len(terms)
+                scores[doc_id][position] = weight
+        return terms, scores
+
+    def rank(self, terms, model=None):
+        """Return a list of (score, article id) tuples for every article
+        containing any of terms, best first. An article's score is the
+        highest score by model, TF-IDF by default, of any query term in it,
+        counting terms it does not contain as 0; ties are broken by article
+        id."""
+        return rank_term_scores(self.term_scores(terms, model)[1])
+
+    def impact_ordered_postings(self, term_id, model=None):
+        """Return the doc_ids array of a term and an array of the term's
+        score in each of their articles by model, ordered by score, highest
+        first, then by article id. They are computed on first use and kept
+        in an ImpactCache of up to settings.PUBMED_IMPACT_CACHE_BYTES, which
+        evicts the least recently used."""
+        model = _model(model)
+
+        def compute(key):
+            doc_ids, scores = self.posting_scores(term_id, model)
+            # the sort is stable, so equal scores stay in article order
+            order = sorted(xrange(len(doc_ids)), key=scores.__getitem__, reverse=True)
+            return (array('I', [doc_ids[i] for i in order]),
+                    array('d', [scores[i] for i in order]))
+
+        if self._impacts is None:
+            return compute(None)
+        return self._impacts.get((model.name, term_id), compute)
+
+    def top_k(self, terms, k, after=None, model=None):
+        """Return the first k entries of rank(terms, model) without scoring
+        every article, or with after, a (score, article id) entry of the
+        ranking, the first k entries following it.
+
+        Each term's postings are walked in impact order, so the next posting
+        of a term is an upper bound on everything after it. Merging the terms
+        on those bounds yields (score, article id) pairs in ranking order, and
+        the first pair seen for an article is its best, so the walk stops as
+        soon as k articles have been seen. A walk following an entry starts
+        each term past it, found by binary search, and skips articles whose
+        best score ranks at or before it, so later pages cost about the same
+        as the first. If a term is in so many articles that its IDF is not
+        positive, absent terms can outscore it and the ranking is computed in
+        full instead.
+
+        """
+        if k <= 0:
+            return []
+        model = _model(model)
+        terms = self.known_terms(terms)
+        resolved = self.resolve(terms, model)
+        term_ids = [term_id for term_id, term_idf in resolved]
+        idfs = [term_idf for term_id, term_idf in resolved]
+        if any(term_idf <= 0 for term_idf in idfs):
+            ranking = self.rank(terms, model)
+            start = 0
+            if after is not None:
+                start = _count_before(len(ranking), ranking.__getitem__, after)
+            return ranking[start:start + k]
+
+        heap = []
+        postings = []
+        for term_id in term_ids:
+            doc_ids, scores = self.impact_ordered_postings(term_id, model)
+            position = 0
+            if after is not None:
+                position = _count_before(len(doc_ids),
+                                         lambda i: (scores[i], doc_ids[i]), after)
+            if position < len(doc_ids):
+                heap.append((-scores[position], doc_ids[position], len(postings), position))
+            postings.append((doc_ids, scores))
+        heapq.heapify(heap)
+
+        ranking = []
+        seen = set()
+        while heap and len(ranking) < k:
+            negative_score, doc_id, term, position = heap[0]
+            if doc_id not in seen:
+                seen.add(doc_id)
+                # an article whose best posting is before the entry was on
+                # an earlier page
+                if after is None or not _ranks_before(
+                        self._best_score(term_ids, idfs, doc_id, model), doc_id, after):
+                    ranking.append((-negative_score, doc_id))
+            doc_ids, scores = postings[term]
+            position += 1
+            if position < len(doc_ids):
+                heapq.heapreplace(heap, (-scores[position], doc_ids[position], term, position))
+            else:
+                heapq.heappop(heap)
+        return ranking
+
+    def _best_score(self, term_ids, idfs, doc_id, model):
+        return max(self.score(term_id, doc_id, model, term_idf)
+                   for term_id, term_idf in izip(term_ids, idfs))
+
+
+def _impact_cache():
+    # an ImpactCache of settings.PUBMED_IMPACT_CACHE_BYTES, or None if
+    # impact-ordered postings are not kept
+    max_bytes = getattr(settings, 'PUBMED_IMPACT_CACHE_BYTES', None)
+    if not max_bytes:
+        return None
+    return ImpactCache(max_bytes)
+
+
+def _model(model):
+    # the ScoringModel to score with: TF-IDF unless another is given
+    if model is None:
+        return SCORING_MODELS[TFIDF.name]
+    return model
+
+
+def _gallop(sequence, item, low, high):
+    # the position of the first of sequence[low:high], which is ascending,
+    # not less than item, found by probing 1, 2, 4... places ahead of low and
+    # then by binary search, so the cost grows with the distance moved
+    step = 1
+    bound = low
+    while bound < high and sequence[bound] < item:
+        low = bound + 1
+        bound += step
+        step *= 2
+    return bisect_left(sequence, item, low, min(bound, high))
+
+
+def _intersect(runs):
+    # Yield (article id, positions) for each id in every one of runs, where
+    # positions are those of the id in each run. The shortest run is walked
+    # and the others galloped through, each from where it last stopped.
+    if not runs:
+        return
+    order = sorted(xrange(len(runs)), key=lambda i: runs[i][2] - runs[i][1])
+    sequence, start, end = runs[order[0]]
+    starts = [run[1] for run in runs]
+    for position in xrange(start, end):
+        doc_id = sequence[position]
+        starts[order[0]] = position
+        for i in order[1:]:
+            other, other_start, other_end = runs[i]
+            found = _gallop(other, doc_id, starts[i], other_end)
+            if found == other_end:
+                return
+            starts[i] = found
+            if other[found] != doc_id:
+                break
+        else:
+            yield doc_id, list(starts)
+
+
+def _ranks_before(score, doc_id, entry):
+    # whether (score, doc_id) is at or before entry in ranking order
+    return (-score, doc_id) <= (-entry[0], entry[1])
+
+
+def _count_before(length, entry_at, entry):
+    # the number of entries at or before entry in a sequence in ranking
+    # order, where entry_at(i) is the (score, article id) at position i
+    low, high = 0, length
+    while low < high:
+        middle = (low + high) // 2
+        score, doc_id = entry_at(middle)
+        if _ranks_before(score, doc_id, entry):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def rank_term_scores(term_scores):
+    """Given a dict mapping article ids to lists of per-term scores, as
+    returned by term_scores, return the (score, article id) ranking."""
+    ranking = [(max(scores), doc_id) for doc_id, scores in term_scores.iteritems()]
+    ranking.sort(key=lambda result: (-result[0], result[1]))
+    return ranking
+
+
+def _section_layout(terms, postings, documents, vocabulary_bytes, positions,
+                    lengths):
+    # (typecode, length) of each section of a snapshot, in order; the
+    # vocabulary is a string of bytes, with no typecode
+    return [('I', terms + 1), (None, vocabulary_bytes), ('I', terms + 1),
+            ('I', postings), ('I', postings), ('d', terms),
+            ('I', documents), ('d', documents), ('I', postings + 1),
+            ('I', positions), ('I', lengths)]
+
+
+def _aligned(position):
+    return (position + 7) & ~7
+
+
+def _little_endian(section):
+    if not isinstance(section, array):
+        return section
+    if sys.byteorder != 'little':
+        section = array(section.typecode, section)
+        section.byteswap()
+    return section.tostring()
+
+
+def write_snapshot(index, path):
+    """Write index to a snapshot file at path. The file is written under a
+    temporary name and renamed into place, so processes that have the old
+    snapshot mapped keep a consistent view of it."""
+    encoded = [term.encode('utf-8') for term in index.terms]
+    term_offsets = array('I', [0])
+    for term in encoded:
+        term_offsets.append(term_offsets[-1] + len(term))
+    idfs = index.idf_array()
+    norm_doc_ids, norms = index.document_norms()
+    lengths = index.document_lengths()
+    sections = [term_offsets, ''.join(encoded), index.offsets, index.doc_ids,
+                index.frequencies, idfs, norm_doc_ids, norms,
+                index.position_offsets, index.positions, lengths]
+
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary_path, 'wb') as snapshot:
+        snapshot.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                    index.generation, index.total_documents,
+                                    len(index), len(index.doc_ids), len(norm_doc_ids),
+                                    len(sections[1]), len(index.positions),
+                                    len(lengths), index.total_length))
+        for section in sections:
+            snapshot.write('\0' * (_aligned(snapshot.tell()) - snapshot.tell()))
+            snapshot.write(_little_endian(section))
+    os.rename(temporary_path, path)
+
+
+class _MappedArray(object):
+    """A read-only sequence of numbers stored in a memory map. Items are
+    unpacked where they lie; slices are copied out as arrays."""
+    def __init__(self, buffer, position, typecode, length):
+        self.buffer = buffer
+        self.position = position
+        self.typecode = typecode
+        self.length = length
+        self.item = struct.Struct('<' + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            size = self.item.size
+            items = array(self.typecode)
+            if stop > start:
+                items.fromstring(self.buffer[self.position + start*size:
+                                             self.position + stop*size])
+                if sys.byteorder != 'little':
+                    items.byteswap()
+            return items[::step]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("index out of range")
+        return self.item.unpack_from(self.buffer, self.position + key*self.item.size)[0]
+
+
+class _MappedTerms(object):
+    """The sorted vocabulary of a snapshot, as a read-only sequence of
+    unicode terms that bisect can search."""
+    def __init__(self, buffer, position, offsets):
+        self.buffer = buffer
+        self.position = position
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id):
+        if not 0 <= term_id < len(self):
+            raise IndexError("index out of range")
+        start = self.position + self.offsets[term_id]
+        end = self.position + self.offsets[term_id + 1]
+        return self.buffer[start:end].decode('utf-8')
+
+
+class MappedIndex(InvertedIndex):
+    """An InvertedIndex read from a snapshot file written by write_snapshot.
+    Only the header is read when the snapshot is opened; everything else is
+    paged in from the memory-mapped file as it is used."""
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self.mmap = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('<4sI', self.mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.mmap.close()
+            raise ValueError("%s is not a version %d index snapshot" %
+                             (path, SNAPSHOT_VERSION))
+        (magic, version, generation, total_documents, terms, postings,
+         documents, vocabulary_bytes, positions, lengths,
+         total_length) = _HEADER.unpack_from(self.mmap, 0)
+
+        sections = []
+        position = _HEADER.size
+        for typecode, length in _section_layout(terms, postings, documents,
+                                                vocabulary_bytes, positions, lengths):
+            position = _aligned(position)
+            if typecode is None:
+                sections.append(position)
+                position += length
+            else:
+                sections.append(_MappedArray(self.mmap, position, typecode, length))
+                position += length * struct.calcsize('<' + typecode)
+        (term_offsets, vocabulary, offsets, doc_ids, frequencies, self.idfs,
+         norm_doc_ids, norms, position_offsets, positions, lengths) = sections
+
+        super(MappedIndex, self).__init__(
+            _MappedTerms(self.mmap, vocabulary, term_offsets), offsets, doc_ids,
+            frequencies, total_documents, generation, position_offsets, positions,
+            lengths, total_length)
+        self._norms = (norm_doc_ids, norms)
+
+    def idf(self, term_id):
+        return self.idfs[term_id]
+
+    def idf_array(self):
+        return self.idfs[:]
+
+    def document_norms(self):
+        return self._norms
+
+    def close(self):
+        self.mmap.close()
+
+
+_index = None
+# when _index was loaded, by time.time()
+_index_loaded = 0
+
+def _load_index(corpus):
+    # Prefer the snapshot, if there is one and it is up to date.
+    path = getattr(settings, 'PUBMED_INDEX_SNAPSHOT', None)
+    if path and os.path.exists(path):
+        try:
+            index = MappedIndex(path)
+        except ValueError:
+            # written by another version; buildindex replaces it
+            return InvertedIndex.build()
+        if (index.generation == corpus.generation and
+            index.total_documents == corpus.documents):
+            return index
+        index.close()
+    return InvertedIndex.build()
+
+
+def get_index():
+    """Return the index of the current corpus: the snapshot named by
+    settings.PUBMED_INDEX_SNAPSHOT if it is up to date, otherwise an
+    InvertedIndex built from the database. The index is kept until articles
+    change, and then for up to settings.PUBMED_INDEX_REBUILD_INTERVAL seconds
+    after it was loaded."""
+    global _index, _index_loaded
+    corpus = Corpus.objects.get_current()
+    if _is_due(corpus.generation):
+        index = _load_index(corpus)
+        # when the corpus reached the generation of the index
+        index.modified = corpus.modified
+        # what is cached of terms is of the index replaced
+        index.term_cache = get_term_cache()
+        if index.term_cache is not None:
+            index.term_cache.clear()
+        _index = index
+        _index_loaded = time.time()
+    return _index
+
+
+def _is_due(generation):
+    # whether the index is to be loaded, given the corpus generation
+    return _index is None or (_index.generation != generation and
+                              time.time() - _index_loaded >=
+                              getattr(settings, 'PUBMED_INDEX_REBUILD_INTERVAL', 0))
+
+
+def get_index_version():
+    """Return the (generation, modified) of the index get_index returns,
+    for HTTP validators of what is searched in it. While it is current, or
+    kept past a change of the corpus, the corpus version is read from the
+    search cache, so this takes no query."""
+    if _is_due(Corpus.objects.get_version()[0]):
+        get_index()
+    return _index.generation, _index.modified
+
+
+def clear_index():
+    """Discard the cached index, so that get_index rebuilds it."""
+    global _index
+    _index = None
+    term_cache = get_term_cache()
+    if term_cache is not None:
+        term_cache.clear()
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+from pubmed_search.benchmarks import BENCHMARKS
+
+class Command(BaseCommand):
+    args = '<benchmark benchmark ...>'
+    help = """Runs the named micro-benchmarks from pubmed_search.benchmarks, or
+    all of them if none are named, and prints the results."""
+
+    def handle(self, *args, **options):
+        for name in args or sorted(BENCHMARKS):
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: %s" % name)
+            for label, value, unit in BENCHMARKS[name]():
+                self.stdout.write("%s %s: %.1f %s\n" % (name, label, value, unit))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pubmed_search.index import InvertedIndex, write_snapshot
+
+class Command(BaseCommand):
+    args = '[filename]'
+    help = """Builds the search index from the database and writes it to a
+    snapshot file, by default settings.PUBMED_INDEX_SNAPSHOT, which web
+    processes memory-map instead of building the index themselves."""
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Expected at most one filename")
+        path = args[0] if args else settings.PUBMED_INDEX_SNAPSHOT
+        index = InvertedIndex.build()
+        write_snapshot(index, path)
+        self.stdout.write("Wrote %d terms and %d postings to %s\n" %
+                          (len(index), len(index.doc_ids), path))
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from pubmed_search.utils import build_related_articles
+
+class Command(NoArgsCommand):
+    help = """Finds the articles most similar to every article, by the cosine
+    similarity of their TF-IDF vectors, and stores them for the related
+    articles shown on each article's page."""
+    option_list = NoArgsCommand.option_list + (
+        make_option('--count', type='int', dest='count',
+                    default=settings.PUBMED_RELATED_ARTICLES,
+                    help='Number of related articles stored for each article.'),
+        make_option('--terms', type='int', dest='terms',
+                    default=settings.PUBMED_RELATED_TERMS,
+                    help="Number of each article's highest weighted terms compared."),
+        make_option('--max-share', type='float', dest='max_share',
+                    default=settings.PUBMED_RELATED_MAX_SHARE,
+                    help='Leave out terms in more than this share of all articles.'),
+    )
+
+    def handle_noargs(self, **options):
+        stored = build_related_articles(options['count'], options['terms'],
+                                        options['max_share'])
+        self.stdout.write("Stored %d related articles\n" % stored)
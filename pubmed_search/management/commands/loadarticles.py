@@ -1,11 +1,29 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
-from pubmed_search.utils import load_json_from_file
+from pubmed_search.utils import DEFAULT_BATCH_SIZE, load_json_from_file
 
 class Command(BaseCommand):
     args = '<filename filename ...>'
     help = """Parses the specified JSON files and loads the file contents into
     the database. Also calculates term frequency per document."""
+    option_list = BaseCommand.option_list + (
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+                    help='Write articles with batched bulk inserts.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=DEFAULT_BATCH_SIZE,
+                    help='Number of articles per transaction in bulk mode.'),
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of processes counting terms; implies --bulk.'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Continue an interrupted load from its last checkpoint; implies --bulk.'),
+    )
 
     def handle(self, *args, **options):
         for filename in args:
-            load_json_from_file(filename)
+            load_json_from_file(filename,
+                                bulk=(options['bulk'] or options['resume'] or
+                                      options['workers'] > 1),
+                                batch_size=options['batch_size'],
+                                workers=options['workers'],
+                                resume=options['resume'])
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from pubmed_search.utils import rebuild_statistics
+
+class Command(NoArgsCommand):
+    help = """Recalculates the number of documents in the corpus, the
+    document frequency of every term and the term frequency sums of every
+    author from scratch, and records the positions of terms in articles
+    loaded before they were recorded."""
+
+    def handle_noargs(self, **options):
+        rebuild_statistics()
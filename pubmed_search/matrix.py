@@ -0,0 +1,137 @@
+"""An optional scoring backend holding the index as a SciPy sparse matrix.
+
+Rows of the matrix are terms and columns are articles, and each entry is
+the score of a term in an article by a ScoringModel, so a query is one row
+slice of the matrix, and ranking it is a column-wise maximum and a sort, all
+done by NumPy rather than in Python. Rankings and scores are the same as
+those of the InvertedIndex the matrix is built from, by the same model.
+
+Select it with PUBMED_SEARCH_BACKEND = 'matrix' in settings.py. It needs NumPy
+and SciPy, which are not otherwise required.
+
+"""
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from pubmed_search.index import get_index
+from pubmed_search.nlp import SCORING_MODELS, TFIDF
+
+
+class MatrixScorer(object):
+    def __init__(self, index, model=None):
+        if numpy is None:
+            raise ImproperlyConfigured("The matrix search backend requires "
+                                       "NumPy and SciPy")
+        self.index = index
+        self.model = model or SCORING_MODELS[TFIDF.name]
+        self.generation = index.generation
+        self.total_documents = index.total_documents
+
+        doc_ids = _as_numpy(index.doc_ids, numpy.uint32)
+        self.doc_ids, columns = numpy.unique(doc_ids, return_inverse=True)
+        # every posting list is scored at once by the model, as the index
+        # does
+        scores = array('d')
+        for term_id in xrange(len(index)):
+            scores.extend(index.posting_scores(term_id, self.model)[1])
+        self.matrix = sparse.csr_matrix(
+            (numpy.frombuffer(scores, dtype=numpy.float64), columns,
+             _as_numpy(index.offsets, numpy.uint32)),
+            shape=(len(index), len(self.doc_ids)))
+
+    def _check_model(self, model):
+        if model is not None and model.name != self.model.name:
+            raise ValueError("this MatrixScorer scores by %s, not %s" %
+                             (self.model.name, model.name))
+
+    def _weighted_rows(self, terms):
+        # The known terms, sorted, the ids of the articles containing any of
+        # them, and a dense (terms x articles) array of their scores.
+        terms = self.index.known_terms(terms)
+        if not terms:
+            return terms, numpy.zeros(0, numpy.uint32), numpy.zeros((0, 0))
+        matrix = self.matrix
+        # rows are gathered from the arrays of the matrix, as slicing it
+        # would drop the postings whose score is 0
+        rows = [slice(matrix.indptr[row], matrix.indptr[row + 1])
+                for row in (self.index.lookup(term) for term in terms)]
+        columns = numpy.unique(numpy.concatenate([matrix.indices[row] for row in rows]))
+        weighted = numpy.zeros((len(rows), len(columns)))
+        for i, row in enumerate(rows):
+            weighted[i, numpy.searchsorted(columns, matrix.indices[row])] = matrix.data[row]
+        return terms, self.doc_ids[columns], weighted
+
+    def term_scores(self, terms, model=None):
+        """See InvertedIndex.term_scores. model, if given, must be the model
+        of the scorer, as for rank and top_k."""
+        self._check_model(model)
+        terms, doc_ids, weighted = self._weighted_rows(terms)
+        return terms, dict(izip(doc_ids.tolist(), weighted.T.tolist()))
+
+    def rank(self, terms, model=None):
+        """See InvertedIndex.rank."""
+        self._check_model(model)
+        terms, doc_ids, weighted = self._weighted_rows(terms)
+        if not terms:
+            return []
+        best = weighted.max(axis=0)
+        order = numpy.lexsort((doc_ids, -best))
+        return zip(best[order].tolist(), doc_ids[order].tolist())
+
+    def top_k(self, terms, k, after=None, model=None):
+        """See InvertedIndex.top_k. Every article is still scored, but only
+        those that can be in the top k are sorted."""
+        self._check_model(model)
+        terms, doc_ids, weighted = self._weighted_rows(terms)
+        if not terms or k <= 0:
+            return []
+        best = weighted.max(axis=0)
+        if after is not None:
+            score, doc_id = after
+            following = (best < score) | ((best == score) & (doc_ids > doc_id))
+            best, doc_ids = best[following], doc_ids[following]
+        if k < len(best):
+            # keep everything tied with the kth best score, so that ties are
+            # still broken by article id
+            kth_best = -numpy.partition(-best, k - 1)[k - 1]
+            candidates = numpy.flatnonzero(best >= kth_best)
+            best, doc_ids = best[candidates], doc_ids[candidates]
+        order = numpy.lexsort((doc_ids, -best))[:k]
+        return zip(best[order].tolist(), doc_ids[order].tolist())
+
+    def top_k_of(self, terms, doc_ids, k, after=None, model=None):
+        """See InvertedIndex.top_k_of, by which the articles are scored."""
+        self._check_model(model)
+        return self.index.top_k_of(terms, doc_ids, k, after, self.model)
+
+
+def _as_numpy(column, dtype):
+    # Arrays are wrapped without copying; mapped snapshot columns are copied
+    # out first.
+    if not isinstance(column, array):
+        column = column[:]
+    return numpy.frombuffer(column, dtype=dtype)
+
+
+# MatrixScorers of the current index, by model name
+_scorers = {}
+
+def get_matrix_scorer(model=None):
+    """Return a MatrixScorer of the current index by model, TF-IDF by
+    default, rebuilding it when the index changes."""
+    index = get_index()
+    model = model or SCORING_MODELS[TFIDF.name]
+    for name, scorer in _scorers.items():
+        if scorer.index is not index:
+            del _scorers[name]
+    if model.name not in _scorers:
+        _scorers[model.name] = MatrixScorer(index, model)
+    return _scorers[model.name]
@@ -1,4 +1,13 @@
-from django.db import models
+from datetime import datetime
+
+from django.db import connection, models
+from django.db.backends.signals import connection_created
+from django.db.models import F, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete
+
+from pubmed_search.cache import (forget_corpus_version, get_corpus_version,
+                                 set_corpus_version)
+from pubmed_search.db import configure_connection
 
 
 class Journal(models.Model):
@@ -23,11 +32,16 @@ class Author(models.Model):
 
 
 class Article(models.Model):
-    title = models.CharField(max_length=255)
+    # indexed for listing articles by title; SQLite indexes include the id
+    title = models.CharField(max_length=255, db_index=True)
     abstract = models.TextField(blank=True)
-    pubmed_url = models.URLField("PubMed URL", max_length=255)
+    pubmed_url = models.URLField("PubMed URL", max_length=255, unique=True)
     journal = models.ForeignKey(Journal)
     authors = models.ManyToManyField(Author, through='Order')
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
+    # number of terms in the title and abstract, for scoring models that
+    # normalize by length
+    length = models.IntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ["title", ]
@@ -55,6 +69,7 @@ class Order(models.Model):
 class Term(models.Model):
     term = models.CharField(max_length=255, unique=True)
     documents = models.ManyToManyField(Article, through='Frequency')
+    document_frequency = models.IntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ["term", ]
@@ -63,10 +78,39 @@ class Term(models.Model):
         return self.term
 
 
+class FrequencyManager(models.Manager):
+    def delete_articles(self, article_pks, chunk_size=500):
+        """Delete the Frequency rows of the articles, subtracting them from
+        the document frequencies of their terms, with two queries per chunk
+        of articles. Unlike deleting a queryset, this sends no signal for
+        each row, so the caller bumps the Corpus generation."""
+        quote = connection.ops.quote_name
+        tables = {'term': quote(Term._meta.db_table),
+                  'frequency': quote(self.model._meta.db_table)}
+        cursor = connection.cursor()
+        article_pks = list(article_pks)
+        for start in xrange(0, len(article_pks), chunk_size):
+            pks = article_pks[start:start + chunk_size]
+            tables['pks'] = ', '.join(['%s'] * len(pks))
+            cursor.execute(
+                "UPDATE %(term)s SET document_frequency = document_frequency - "
+                "(SELECT COUNT(*) FROM %(frequency)s f WHERE f.term_id = %(term)s.id "
+                "AND f.article_id IN (%(pks)s)) "
+                "WHERE id IN (SELECT term_id FROM %(frequency)s WHERE article_id IN (%(pks)s))"
+                % tables, pks + pks)
+            cursor.execute("DELETE FROM %(frequency)s WHERE article_id IN (%(pks)s)" % tables,
+                           pks)
+
+
 class Frequency(models.Model):
     term = models.ForeignKey(Term)
     article = models.ForeignKey(Article)
     frequency = models.IntegerField(max_length=255)
+    # where the term is among the terms of the article's title and abstract,
+    # encoded by nlp.encode_positions, for matching phrases
+    positions = models.TextField(blank=True, editable=False)
+
+    objects = FrequencyManager()
 
     class Meta:
         ordering = ["term", ]
@@ -74,3 +118,216 @@ class Frequency(models.Model):
 
     def __unicode__(self):
         return u"%s: %s for %s" % (self.term, self.frequency, self.article)
+
+
+class AuthorTermManager(models.Manager):
+    def _insert_sums(self, sign, where='', params=()):
+        # one row per (author, term) of the Order and Frequency rows matching
+        # where, holding sign times their sums
+        quote = connection.ops.quote_name
+        tables = {'author_term': quote(self.model._meta.db_table),
+                  'order': quote(Order._meta.db_table),
+                  'frequency': quote(Frequency._meta.db_table),
+                  'sign': int(sign), 'where': where}
+        connection.cursor().execute(
+            "INSERT INTO %(author_term)s (author_id, term_id, frequency, articles) "
+            "SELECT o.author_id, f.term_id, %(sign)d * SUM(f.frequency), %(sign)d * COUNT(*) "
+            "FROM %(order)s o INNER JOIN %(frequency)s f ON f.article_id = o.article_id "
+            "%(where)s GROUP BY o.author_id, f.term_id" % tables, params)
+
+    def add_articles(self, article_pks, sign=1, chunk_size=500):
+        """Add the term frequencies of the articles to the sums of their
+        authors, or with a sign of -1, remove them. Call it once the
+        articles' Order and Frequency rows exist, or before they are
+        deleted."""
+        article_pks = list(article_pks)
+        for start in xrange(0, len(article_pks), chunk_size):
+            pks = article_pks[start:start + chunk_size]
+            self._insert_sums(sign, "WHERE o.article_id IN (%s)" % ', '.join(['%s'] * len(pks)),
+                              pks)
+
+    def rebuild(self):
+        """Recompute every AuthorTerm from the Order and Frequency tables,
+        leaving one row per author and term. The old rows are deleted with
+        one query, loading none of them."""
+        connection.cursor().execute("DELETE FROM %s"
+                                    % connection.ops.quote_name(self.model._meta.db_table))
+        self._insert_sums(1)
+
+    def sums(self, terms):
+        """Return a list of (author id, term, frequency, articles) sums for
+        the authors of articles containing any of terms."""
+        sums = (self.filter(term__term__in=terms).values_list('author', 'term__term')
+                .annotate(total_frequency=Sum('frequency'), total_articles=Sum('articles'))
+                .filter(total_articles__gt=0).order_by())
+        return list(sums)
+
+
+class CorpusManager(models.Manager):
+    def get_current(self):
+        """Return the Corpus, creating it if need be."""
+        corpus, created = self.get_or_create(pk=1)
+        return corpus
+
+    def add_documents(self, count, length=0):
+        """Add count, which may be negative, to the number of documents, and
+        length to their total length."""
+        self.get_current()
+        self.filter(pk=1).update(documents=F('documents') + count,
+                                 length=F('length') + length)
+
+    def bump_generation(self):
+        """Record that articles, term frequencies or related articles have
+        changed."""
+        self.get_current()
+        self.filter(pk=1).update(generation=F('generation') + 1,
+                                 modified=datetime.utcnow())
+        forget_corpus_version()
+
+    def get_version(self):
+        """Return the generation of the Corpus and the time it last changed,
+        reading them from the search cache where possible, so that they can
+        be checked on every request without a query. Other processes see a
+        change within CORPUS_VERSION_TIMEOUT seconds."""
+        version = get_corpus_version()
+        if version is None:
+            corpus = self.get_current()
+            version = (corpus.generation, corpus.modified)
+            set_corpus_version(version)
+        return version
+
+
+class Corpus(models.Model):
+    """Statistics about the whole collection of articles, kept up to date as
+    articles are loaded and deleted. There is only ever one Corpus; use
+    Corpus.objects.get_current() to fetch it.
+
+    generation changes whenever articles or their term frequencies do, so
+    that anything derived from them, such as the search index, can tell when
+    it is out of date.
+
+    """
+    documents = models.IntegerField(default=0)
+    # total length of the documents in terms
+    length = models.BigIntegerField(default=0)
+    generation = models.IntegerField(default=0)
+    # when generation last changed, in UTC
+    modified = models.DateTimeField(null=True, editable=False)
+
+    objects = CorpusManager()
+
+    class Meta:
+        verbose_name_plural = "corpus"
+
+    def __unicode__(self):
+        return u"%s documents" % self.documents
+
+    def average_length(self):
+        """Return the average length of the documents in terms, or 0 if
+        there are none."""
+        if not self.documents:
+            return 0.0
+        return float(self.length) / self.documents
+
+
+class AuthorTerm(models.Model):
+    """The total frequency of a term in the articles of an author, and the
+    number of those articles containing it, so that authors can be scored
+    for a query without visiting their articles.
+
+    Loading and deleting articles appends rows of the changes, positive or
+    negative, rather than updating the row of each author and term; sum the
+    rows of an author and term, as AuthorTerm.objects.sums does, for their
+    totals. AuthorTerm.objects.rebuild() recomputes them and leaves one row
+    each.
+
+    """
+    author = models.ForeignKey(Author)
+    term = models.ForeignKey(Term)
+    frequency = models.IntegerField(default=0)
+    articles = models.IntegerField(default=0)
+
+    objects = AuthorTermManager()
+
+    def __unicode__(self):
+        return u"%s: %s in %s articles by %s" % (self.term, self.frequency,
+                                                self.articles, self.author)
+
+
+class RelatedArticleManager(models.Manager):
+    def delete_all(self):
+        """Delete every RelatedArticle with one query. Unlike deleting a
+        queryset, this loads no rows and sends no signal for each."""
+        connection.cursor().execute("DELETE FROM %s"
+                                    % connection.ops.quote_name(self.model._meta.db_table))
+
+
+class RelatedArticle(models.Model):
+    """One of the articles most similar to an article, by the cosine
+    similarity of their TF-IDF vectors, ranked from 0. The buildrelated
+    command stores them for every article at once."""
+    article = models.ForeignKey(Article, related_name='related_articles')
+    related = models.ForeignKey(Article, related_name='+')
+    rank = models.IntegerField()
+    similarity = models.FloatField()
+
+    objects = RelatedArticleManager()
+
+    class Meta:
+        ordering = ['article', 'rank']
+
+    def __unicode__(self):
+        return u"%s: %s for %s" % (self.related, self.rank, self.article)
+
+
+class Checkpoint(models.Model):
+    """How far loadarticles has got through a file, so that an interrupted
+    load can resume where it stopped."""
+    filename = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    records = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u"%s: %s records" % (self.filename, self.records)
+
+
+# Keep Corpus.documents and length, Term.document_frequency and AuthorTerm up
+# to date when rows are saved or deleted one at a time. Bulk loads update them
+# directly, and so does create_db_entries for AuthorTerm, whose rows are
+# computed once all of an article's rows exist, for the length of an article
+# that changes and, through Frequency.objects.delete_articles, for the term
+# frequencies it replaces.
+def _article_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        Corpus.objects.add_documents(1, instance.length)
+
+def _article_deleting(sender, instance, **kwargs):
+    AuthorTerm.objects.add_articles([instance.pk], -1)
+
+def _article_deleted(sender, instance, **kwargs):
+    Corpus.objects.add_documents(-1, -instance.length)
+    Corpus.objects.bump_generation()
+
+def _frequency_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        Term.objects.filter(pk=instance.term_id).update(
+            document_frequency=F('document_frequency') + 1)
+
+def _frequency_deleted(sender, instance, **kwargs):
+    Term.objects.filter(pk=instance.term_id).update(
+        document_frequency=F('document_frequency') - 1)
+    Corpus.objects.bump_generation()
+
+post_save.connect(_article_saved, sender=Article,
+                  dispatch_uid='pubmed_search.models._article_saved')
+pre_delete.connect(_article_deleting, sender=Article,
+                   dispatch_uid='pubmed_search.models._article_deleting')
+post_delete.connect(_article_deleted, sender=Article,
+                    dispatch_uid='pubmed_search.models._article_deleted')
+post_save.connect(_frequency_saved, sender=Frequency,
+                  dispatch_uid='pubmed_search.models._frequency_saved')
+post_delete.connect(_frequency_deleted, sender=Frequency,
+                    dispatch_uid='pubmed_search.models._frequency_deleted')
+# Set up new database connections; see pubmed_search.db
+connection_created.connect(configure_connection,
+                           dispatch_uid='pubmed_search.db.configure_connection')
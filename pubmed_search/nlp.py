@@ -1,8 +1,10 @@
 import math
+import re
+from itertools import izip
 
 from django.conf import settings
 
-from pubmed_search.models import Article, Frequency
+from pubmed_search.models import Corpus, Frequency
 
 
 def clean_term(raw_term, acceptable=settings.ACCEPTABLE_CHARACTERS):
@@ -15,17 +17,215 @@ def clean_term(raw_term, acceptable=settings.ACCEPTABLE_CHARACTERS):
     return cleaned_term
 
 
-def tfidf(term, article):
-    try:
-        frequency = Frequency.objects.get(term=term, article=article)
-        tf = frequency.frequency
+class Tokenizer(object):
+    """Splits text into normalized terms.
+
+    Produces the same terms as calling clean_term on each whitespace-separated
+    token of the text and dropping the stop words, but strips characters with
+    a precompiled regular expression and looks stop words up in a frozenset.
+
+    """
+    def __init__(self, acceptable=settings.ACCEPTABLE_CHARACTERS, stop_words=()):
+        self.strip = re.compile(u'[^%s]+' % re.escape(acceptable)).sub
+        self.stop_words = frozenset(stop_words)
+
+    @classmethod
+    def from_settings(cls):
+        """Return a Tokenizer for settings.ACCEPTABLE_CHARACTERS, dropping the
+        stop words if settings.USE_STOP_WORDS is set."""
+        from pubmed_search.utils import STOP_WORDS
+        stop_words = STOP_WORDS if settings.USE_STOP_WORDS else ()
+        return cls(settings.ACCEPTABLE_CHARACTERS, stop_words)
+
+    def tokenize(self, text):
+        """Return the list of terms in text, in order."""
+        strip = self.strip
+        terms = [strip(u'', token).lower() for token in text.split()]
+        if self.stop_words:
+            stop_words = self.stop_words
+            terms = [term for term in terms if term not in stop_words]
+        return terms
+
+    def tokenize_partial(self, text):
+        """Split text that may end in a partly typed word, as in a search box
+        being typed into. Return the terms of the words before it, as
+        tokenize would, and the normalized partial word, which is kept even
+        if it is a stop word (it may be the start of another word), or None if
+        text ends with whitespace."""
+        if not text or text[-1].isspace():
+            return self.tokenize(text), None
+        words = text.rsplit(None, 1)
+        terms = self.tokenize(words[0]) if len(words) > 1 else []
+        return terms, self.strip(u'', words[-1]).lower() or None
+
+
+_tokenizer = None
+
+def get_tokenizer():
+    """Return the Tokenizer built from settings, creating it on first use."""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer.from_settings()
+    return _tokenizer
+
 
-        total_documents = Article.objects.count()
-        term_appearance = Frequency.objects.filter(term=term).count()
+def term_positions(terms):
+    """Given the terms of a text, in order, return a dict mapping each
+    distinct term to the ascending list of its positions among them."""
+    positions = {}
+    for position, term in enumerate(terms):
+        positions.setdefault(term, []).append(position)
+    return positions
+
+
+def encode_positions(positions):
+    """Return the positions of a term, a list of numbers, as the string
+    stored in Frequency.positions."""
+    return ','.join([str(position) for position in positions])
+
+
+def decode_positions(text):
+    """Return the list of positions encoded by encode_positions."""
+    if not text:
+        return []
+    return [int(position) for position in text.split(',')]
+
+
+def idf(document_frequency, total_documents):
+    """Return the inverse document frequency of a term that appears in
+    document_frequency of total_documents documents."""
+    return math.log(total_documents / (1.0 + document_frequency))
+
+
+class ScoringModel(object):
+    """Scores a term in an article from its frequency there, the article's
+    length in terms and the term's IDF.
+
+    weights scores a term in a batch of articles at once, such as those of a
+    posting list, and every score is computed through it: by the index, the
+    matrix backend and tfidf_batch alike. Add an instance of a subclass to
+    SCORING_MODELS to make another model available.
+
+    """
+    name = None
+    # the name shown in the search form
+    label = None
+    # whether weights needs the lengths of the articles
+    uses_lengths = False
 
-        idf = math.log(total_documents / (1.0 + term_appearance))
+    def idf(self, document_frequency, total_documents):
+        """Return the inverse document frequency of a term that appears in
+        document_frequency of total_documents documents."""
+        return idf(document_frequency, total_documents)
 
-        return tf*idf
+    def weights(self, frequencies, lengths, term_idf, average_length):
+        """Given the frequencies of a term in some articles and, if
+        uses_lengths is set, the lengths of the articles, return a list of
+        the score of the term in each article."""
+        raise NotImplementedError
 
-    except Frequency.DoesNotExist:
-        return 0
+
+class TFIDF(ScoringModel):
+    """Term frequency times IDF. Long articles score higher, and terms in
+    most articles score below zero."""
+    name = 'tfidf'
+    label = 'TF-IDF'
+
+    def weights(self, frequencies, lengths, term_idf, average_length):
+        return [tf*term_idf for tf in frequencies]
+
+
+class LogTFIDF(ScoringModel):
+    """1 + log(term frequency), times IDF, so that a term repeated in an
+    article adds less and less to its score."""
+    name = 'logtfidf'
+    label = 'Log TF-IDF'
+
+    def weights(self, frequencies, lengths, term_idf, average_length):
+        return [(1 + math.log(tf))*term_idf for tf in frequencies]
+
+
+class BM25(ScoringModel):
+    """Okapi BM25: term frequency saturating with k1 and normalized by the
+    article's length relative to the average by b, times a probabilistic
+    IDF that is always positive."""
+    name = 'bm25'
+    label = 'BM25'
+    uses_lengths = True
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def idf(self, document_frequency, total_documents):
+        return math.log(1 + (total_documents - document_frequency + 0.5) /
+                        (document_frequency + 0.5))
+
+    def weights(self, frequencies, lengths, term_idf, average_length):
+        k1, b = self.k1, self.b
+        if not average_length:
+            # no lengths are known, so none are normalized
+            return [term_idf * tf * (k1 + 1) / (tf + k1) for tf in frequencies]
+        return [term_idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+                for tf, length in izip(frequencies, lengths)]
+
+
+SCORING_MODELS = dict((model.name, model) for model in (TFIDF(), LogTFIDF(), BM25()))
+
+
+def get_scoring_model(name=None):
+    """Return the ScoringModel named name, by default the one named by
+    settings.PUBMED_SCORING_MODEL."""
+    if name is None:
+        name = getattr(settings, 'PUBMED_SCORING_MODEL', TFIDF.name)
+    return SCORING_MODELS[name]
+
+
+def tfidf_batch(terms, articles, model=None, chunk_size=500):
+    """Given sequences of Terms and Articles, return a dict mapping (term pk,
+    article pk) to the TF-IDF of the term in the article for every pair; pairs
+    where the article does not contain the term score 0. Takes two queries,
+    however many pairs are scored, plus one per chunk_size articles beyond
+    the first when there are fewer articles than postings of the terms. With
+    a ScoringModel, return its scores instead of TF-IDF."""
+    if model is None:
+        model = SCORING_MODELS[TFIDF.name]
+    terms = list(terms)
+    lengths = dict((article.pk, article.length) for article in articles)
+    corpus = Corpus.objects.get_current()
+    average_length = corpus.average_length()
+
+    idfs = {}
+    scores = {}
+    for term in terms:
+        idfs[term.pk] = model.idf(term.document_frequency, corpus.documents)
+        for article_pk in lengths:
+            scores[(term.pk, article_pk)] = 0
+
+    postings = {}
+    frequencies = Frequency.objects.filter(term__in=list(idfs)).values_list(
+        'term', 'article', 'frequency')
+    if len(lengths) < sum(term.document_frequency for term in terms):
+        # fewer articles than postings, so read only the articles' rows, in
+        # chunks to stay within SQLite's parameter limit
+        article_pks = list(lengths)
+        querysets = [frequencies.filter(article__in=article_pks[start:start + chunk_size])
+                     for start in xrange(0, len(article_pks), chunk_size)]
+    else:
+        querysets = [frequencies]
+    for queryset in querysets:
+        for term_pk, article_pk, tf in queryset.iterator():
+            if article_pk in lengths:
+                postings.setdefault(term_pk, []).append((article_pk, tf))
+    for term_pk, term_postings in postings.iteritems():
+        article_pks = [article_pk for article_pk, tf in term_postings]
+        weights = model.weights([tf for article_pk, tf in term_postings],
+                                [lengths[article_pk] for article_pk in article_pks],
+                                idfs[term_pk], average_length)
+        scores.update(izip([(term_pk, article_pk) for article_pk in article_pks], weights))
+    return scores
+
+
+def tfidf(term, article):
+    """Return the TF-IDF of term in article."""
+    return tfidf_batch([term], [article])[(term.pk, article.pk)]
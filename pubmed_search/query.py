@@ -0,0 +1,210 @@
+"""Parsing and matching of search queries.
+
+A query is made of words and quoted phrases, combined with AND and OR,
+which must be written in capitals; AND binds more tightly than OR, and
+parentheses group. Words and phrases next to each other with no operator
+between them are combined with the default operator, OR unless AND is asked
+for, so that a query of words alone matches any article containing one of
+them, as it always has.
+
+Words and phrases are split into terms by the tokenizer, as the text of
+articles is, so stop words are dropped, from phrases too. An operator left
+with nothing to combine is ignored, so any text is a valid query.
+
+Queries are matched against an InvertedIndex as runs of article ids (see
+InvertedIndex.term_run): a conjunction intersects the runs of its parts,
+rarest first, and a phrase is the conjunction of its terms, less the
+articles in which they are not one after another.
+
+"""
+import re
+
+from pubmed_search.nlp import get_tokenizer
+
+
+OPERATORS = ('AND', 'OR')
+
+# a quoted phrase, whose closing quote may be missing, a parenthesis, or a
+# word
+_TOKENS = re.compile(r'"([^"]*)"?|([()])|([^\s"()]+)')
+
+_OPERAND_STARTS = ('query', '(')
+
+
+class Query(object):
+    # whether the query matches the articles containing any of its terms,
+    # which InvertedIndex.top_k ranks without matching them first
+    matches_any_term = False
+
+    def terms(self):
+        """Return the terms of the query, in order, by which matching
+        articles are ranked."""
+        raise NotImplementedError
+
+    def run(self, index):
+        """Return the ids of the articles of index matching the query, as a
+        run."""
+        raise NotImplementedError
+
+    def key(self):
+        """Return a value identifying the articles the query matches and
+        their ranking, for caching; equivalent queries may share a key."""
+        raise NotImplementedError
+
+    def doc_ids(self, index):
+        """Return the ids of the articles of index matching the query, as a
+        sorted sequence."""
+        sequence, start, end = self.run(index)
+        return sequence[start:end]
+
+
+class TermQuery(Query):
+    matches_any_term = True
+
+    def __init__(self, term):
+        self.term = term
+
+    def terms(self):
+        return [self.term]
+
+    def run(self, index):
+        return index.term_run(self.term)
+
+    def key(self):
+        return self.term
+
+
+class PhraseQuery(Query):
+    def __init__(self, terms):
+        self.phrase = terms
+
+    def terms(self):
+        return list(self.phrase)
+
+    def run(self, index):
+        doc_ids = index.match_phrase(self.phrase)
+        return doc_ids, 0, len(doc_ids)
+
+    def key(self):
+        return ('"',) + tuple(self.phrase)
+
+
+class AndQuery(Query):
+    def __init__(self, queries):
+        self.queries = queries
+
+    def terms(self):
+        return [term for query in self.queries for term in query.terms()]
+
+    def run(self, index):
+        doc_ids = index.match_all([query.run(index) for query in self.queries])
+        return doc_ids, 0, len(doc_ids)
+
+    def key(self):
+        return ('AND',) + tuple(sorted(set(query.key() for query in self.queries)))
+
+
+class OrQuery(Query):
+    def __init__(self, queries):
+        self.queries = queries
+        self.matches_any_term = all(query.matches_any_term for query in queries)
+
+    def terms(self):
+        return [term for query in self.queries for term in query.terms()]
+
+    def run(self, index):
+        doc_ids = index.match_any([query.run(index) for query in self.queries])
+        return doc_ids, 0, len(doc_ids)
+
+    def key(self):
+        return ('OR',) + tuple(sorted(set(query.key() for query in self.queries)))
+
+
+def _combine(cls, queries):
+    queries = [query for query in queries if query is not None]
+    if len(queries) > 1:
+        return cls(queries)
+    return queries[0] if queries else None
+
+
+def _phrase(terms):
+    if len(terms) > 1:
+        return PhraseQuery(terms)
+    return TermQuery(terms[0]) if terms else None
+
+
+class _Parser(object):
+    def __init__(self, text, tokenizer, default_operator):
+        self.default_operator = default_operator
+        self.tokens = []
+        for match in _TOKENS.finditer(text):
+            phrase, parenthesis, word = match.groups()
+            if parenthesis:
+                self.tokens.append((parenthesis, None))
+            elif word in OPERATORS:
+                self.tokens.append((word, None))
+            else:
+                # stop words and empty phrases are left out
+                query = _phrase([term for term in tokenizer.tokenize(word or phrase)
+                                 if term])
+                if query is not None:
+                    self.tokens.append(('query', query))
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def parse(self):
+        queries = []
+        while self.position < len(self.tokens):
+            queries.append(self._parse_or())
+            # skip a closing parenthesis that closes nothing
+            self.position += 1
+        return _combine(AndQuery if self.default_operator == 'AND' else OrQuery,
+                        queries)
+
+    def _operands(self, operator, parse_operand):
+        # operands joined by operator, or by nothing if it is the default
+        operands = [parse_operand()]
+        while True:
+            kind = self._peek()
+            if kind == operator:
+                self.position += 1
+            elif not (operator == self.default_operator and kind in _OPERAND_STARTS):
+                return operands
+            operands.append(parse_operand())
+
+    def _parse_or(self):
+        return _combine(OrQuery, self._operands('OR', self._parse_and))
+
+    def _parse_and(self):
+        return _combine(AndQuery, self._operands('AND', self._parse_operand))
+
+    def _parse_operand(self):
+        kind = self._peek()
+        if kind == '(':
+            self.position += 1
+            query = self._parse_or()
+            if self._peek() == ')':
+                self.position += 1
+            return query
+        if kind == 'query':
+            self.position += 1
+            return self.tokens[self.position - 1][1]
+        # an operator with nothing before it, a closing parenthesis or the
+        # end of the query
+        return None
+
+
+def parse_query(text, default_operator='OR', tokenizer=None):
+    """Return the Query of text typed into the search box. default_operator,
+    'AND' or 'OR', combines words and phrases with no operator between
+    them. A query with no terms at all matches nothing."""
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    query = _Parser(text, tokenizer, default_operator).parse()
+    if query is None:
+        return OrQuery([])
+    return query
@@ -0,0 +1,188 @@
+"""A search backend scoring queries on shards of the index in parallel.
+
+The articles of the index are partitioned into shards by article id, and
+each shard is an index of its own, with the postings of its articles and
+statistics of its own: the number of its articles containing each term,
+and their number and total length. Scores are computed from the statistics
+of the whole corpus, merged from those of every shard, so they are the same
+as those of the index.
+
+A ShardedSearcher holds a pool of one process per shard. A search is
+scattered to every shard, each of which finds its own best results, and the
+results are gathered by merging them on a heap, so the rankings are the same
+as those of the index.
+
+Select it with PUBMED_SEARCH_BACKEND = 'sharded' in settings.py, and set the
+number of shards with PUBMED_SEARCH_SHARDS. Queries needing more than one of
+their terms are still matched on the index, and their matches scored on the
+shards.
+
+"""
+import heapq
+from array import array
+from itertools import islice, izip
+from multiprocessing import Pool
+
+from django.conf import settings
+
+from pubmed_search.index import InvertedIndex, get_index
+
+
+class Shard(InvertedIndex):
+    """The postings of the articles of one shard of an index. Its own
+    statistics are documents, the number of its articles, and
+    local_document_frequency and length; merge_statistics sets those of the
+    whole corpus, by which it scores."""
+    def __init__(self, terms, offsets, doc_ids, frequencies, documents, generation=0):
+        super(Shard, self).__init__(terms, offsets, doc_ids, frequencies, documents,
+                                    generation)
+        self.documents = documents
+        self.length = sum(frequencies)
+        # the number of articles of the corpus containing each term, by term id
+        self.document_frequencies = None
+
+    def local_document_frequency(self, term_id):
+        return self.offsets[term_id + 1] - self.offsets[term_id]
+
+    def document_frequency(self, term_id):
+        if self.document_frequencies is None:
+            return self.local_document_frequency(term_id)
+        return self.document_frequencies[term_id]
+
+
+def split_index(index, count):
+    """Partition the articles of index into count Shards, article id modulo
+    count, with the statistics of the whole corpus merged from theirs.
+    Positions are left out, as shards only rank."""
+    terms = [[] for shard in xrange(count)]
+    offsets = [array('I', [0]) for shard in xrange(count)]
+    doc_ids = [array('I') for shard in xrange(count)]
+    frequencies = [array('I') for shard in xrange(count)]
+    for term_id, term in enumerate(index.terms):
+        term_doc_ids, term_frequencies = index.postings(term_id)
+        for doc_id, tf in izip(term_doc_ids, term_frequencies):
+            shard = doc_id % count
+            doc_ids[shard].append(doc_id)
+            frequencies[shard].append(tf)
+        for shard in xrange(count):
+            if len(doc_ids[shard]) > offsets[shard][-1]:
+                terms[shard].append(term)
+                offsets[shard].append(len(doc_ids[shard]))
+
+    # each shard counts the articles whose ids are its own; articles with no
+    # terms, which no shard holds, are counted by the first
+    lengths = index.document_lengths()
+    documents = [0] * count
+    for doc_id in xrange(len(lengths)):
+        if lengths[doc_id]:
+            documents[doc_id % count] += 1
+    documents[0] += index.total_documents - sum(documents)
+
+    shards = [Shard(terms[shard], offsets[shard], doc_ids[shard], frequencies[shard],
+                    documents[shard], index.generation)
+              for shard in xrange(count)]
+    merge_statistics(shards, lengths)
+    return shards
+
+
+def merge_statistics(shards, lengths=None):
+    """Set the statistics by which every shard scores to those of the whole
+    corpus: the sum over the shards of the number of articles containing
+    each term, and of the number and length of the articles. lengths, the
+    lengths of all articles by id, is shared by the shards if it is
+    given."""
+    document_frequencies = {}
+    for shard in shards:
+        for term_id, term in enumerate(shard.terms):
+            document_frequencies[term] = (document_frequencies.get(term, 0) +
+                                          shard.local_document_frequency(term_id))
+    total_documents = sum(shard.documents for shard in shards)
+    total_length = sum(shard.length for shard in shards)
+    for shard in shards:
+        shard.document_frequencies = array('I', [document_frequencies[term]
+                                                 for term in shard.terms])
+        shard.total_documents = total_documents
+        shard.total_length = total_length
+        if lengths is not None:
+            shard.lengths = lengths
+        if shard._impacts is not None:
+            shard._impacts.clear()
+
+
+# the shards of the ShardedSearcher that started the process
+_shards = None
+
+def _start_worker(shards):
+    global _shards
+    _shards = shards
+
+def _call_shard(call):
+    shard, method, args = call
+    return getattr(_shards[shard], method)(*args)
+
+
+def _merge(rankings, k=None):
+    # merge (score, article id) rankings, each best first, into one
+    merged = heapq.merge(*[[(-score, doc_id) for score, doc_id in ranking]
+                           for ranking in rankings])
+    if k is not None:
+        merged = islice(merged, k)
+    return [(-negative_score, doc_id) for negative_score, doc_id in merged]
+
+
+class ShardedSearcher(object):
+    """Searches the shards of an index, each in a process of its own."""
+    def __init__(self, index, shards):
+        self.index = index
+        self.generation = index.generation
+        self.total_documents = index.total_documents
+        self.shards = split_index(index, shards)
+        # worker processes are forked with the shards
+        self.pool = Pool(shards, _start_worker, (self.shards,))
+
+    def _scatter(self, method, shard_args):
+        return self.pool.map(_call_shard, [(shard, method, args)
+                                           for shard, args in enumerate(shard_args)])
+
+    def rank(self, terms, model=None):
+        """See InvertedIndex.rank."""
+        return _merge(self._scatter('rank', [(terms, model)] * len(self.shards)))
+
+    def top_k(self, terms, k, after=None, model=None):
+        """See InvertedIndex.top_k. Each shard finds its best k, of which
+        the best k are kept."""
+        if k <= 0:
+            return []
+        return _merge(self._scatter('top_k', [(terms, k, after, model)] * len(self.shards)),
+                      k)
+
+    def top_k_of(self, terms, doc_ids, k, after=None, model=None):
+        """See InvertedIndex.top_k_of. Each shard scores the articles of
+        doc_ids it holds."""
+        if k <= 0:
+            return []
+        shard_doc_ids = [array('I') for shard in self.shards]
+        for doc_id in doc_ids:
+            shard_doc_ids[doc_id % len(self.shards)].append(doc_id)
+        return _merge(self._scatter('top_k_of', [(terms, shard_ids, k, after, model)
+                                                 for shard_ids in shard_doc_ids]), k)
+
+    def close(self):
+        """Stop the worker processes."""
+        self.pool.terminate()
+        self.pool.join()
+
+
+_searcher = None
+
+def get_sharded_searcher():
+    """Return a ShardedSearcher of the current index with
+    settings.PUBMED_SEARCH_SHARDS shards, replacing it when the index
+    changes."""
+    global _searcher
+    index = get_index()
+    if _searcher is None or _searcher.index is not index:
+        if _searcher is not None:
+            _searcher.close()
+        _searcher = ShardedSearcher(index, settings.PUBMED_SEARCH_SHARDS)
+    return _searcher
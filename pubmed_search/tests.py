@@ -1,17 +1,45 @@
+import gzip
 import math
+import os
+import shutil
+import tempfile
+from array import array
+from random import Random
+from StringIO import StringIO
 
+from django.db import load_backend
+from django.db.utils import DatabaseError
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import unittest
 from django.utils import simplejson as json
 
-from pubmed_search.models import Article, Author, Frequency, Journal, Order, Term
-from pubmed_search.nlp import clean_term, tfidf
-from pubmed_search.utils import create_db_entries
+from pubmed_search.cache import (LRUCache, TermCache, cache_statistics, get_search_cache,
+                                 get_term_cache)
+from pubmed_search.db import SearchRouter, read_only
+from pubmed_search.forms import decode_cursor, encode_cursor
+from pubmed_search.index import (InvertedIndex, MappedIndex, clear_index, get_index,
+                                 write_snapshot)
+from pubmed_search.matrix import MatrixScorer, numpy
+from pubmed_search.models import (Article, Author, AuthorTerm, Checkpoint, Corpus,
+                                  Frequency, Journal, Order, RelatedArticle, Term)
+from pubmed_search.nlp import (SCORING_MODELS, Tokenizer, clean_term, decode_positions,
+                               get_scoring_model, tfidf, tfidf_batch)
+from pubmed_search.query import parse_query
+from pubmed_search.shards import ShardedSearcher, split_index
+from pubmed_search.utils import (STOP_WORDS, BulkLoader, RecordReader, build_related_articles,
+                                  create_db_entries, iter_json_array, iter_records,
+                                  load_json_from_file, rebuild_statistics)
 from pubmed_search.views import autosearch, search
 
 
-# Test pubmed_search.utils, .nlp and .views
+# Test pubmed_search.utils, .nlp, .index and .views
+@override_settings(PUBMED_INDEX_SNAPSHOT=None, PUBMED_SEARCH_DATABASE=None,
+                   PUBMED_INDEX_REBUILD_INTERVAL=0)
 class ArticleBaseTest(TestCase):
     def setUp(self):
+        clear_index()
+        get_search_cache().clear()
         self.raw_record = r"""[
     {
         "abstract": "Current practices of reporting critical laboratory values make it challenging to measure and assess the timeliness of receipt by the treating physician as required by The Joint Commission's 2008 National Patient Safety Goals.\nA multidisciplinary team of laboratorians, clinicians, and information technology experts developed an electronic ALERTS system that reports critical values via the laboratory and hospital information systems to alphanumeric pagers of clinicians and ensures failsafe notification, instant documentation, automatic tracking, escalation, and reporting of critical value alerts. A method for automated acknowledgment of message receipt was incorporated into the system design.\nThe ALERTS system has been applied to inpatients and eliminated approximately 9000 phone calls a year made by medical technologists. Although a small number of phone calls were still made as a result of pages not acknowledged by clinicians within 10 min, they were made by telephone operators, who either contacted the same physician who was initially paged by the automated system or identified and contacted alternate physicians or the patient's nurse. Overall, documentation of physician acknowledgment of receipt in the electronic medical record increased to 95% of critical values over 9 months, while the median time decreased to <3 min.\nWe improved laboratory efficiency and physician communication by developing an electronic system for reporting of critical values that is in compliance with The Joint Commission's goals.",
@@ -52,6 +80,186 @@ class TermsTest(ArticleBaseTest):
         impl_freq = Frequency.objects.get(term=implementation)
         self.assertEqual(1, impl_freq.frequency)
 
+class BulkLoaderTest(ArticleBaseTest):
+    def _rows(self):
+        articles = set(Article.objects.values_list('pubmed_url', 'title', 'abstract',
+                                                   'journal__name'))
+        orders = set(Order.objects.values_list('article__pubmed_url', 'author__last_name',
+                                               'author__initials', 'order'))
+        frequencies = set(Frequency.objects.values_list('article__pubmed_url',
+                                                        'term__term', 'frequency'))
+        return articles, orders, frequencies
+
+    def test_bulk_matches_create_db_entries(self):
+        create_db_entries(self.records[0])
+        expected = self._rows()
+        for model in (Frequency, Order, Article, Term, Author, Journal):
+            model.objects.all().delete()
+
+        BulkLoader(batch_size=1).load(self.records)
+        self.assertEqual(expected, self._rows())
+        self.assertEqual(Term.objects.count(), Frequency.objects.count())
+
+    def test_bulk_load_with_workers(self):
+        BulkLoader().load(self.records)
+        expected = self._rows()
+        for model in (Frequency, Order, Article, Term, Author, Journal):
+            model.objects.all().delete()
+
+        BulkLoader(batch_size=1).load(self.records * 3, workers=2)
+        self.assertEqual(expected, self._rows())
+
+    def test_bulk_load_with_workers_repeated_url(self):
+        # the last version of an article in the input is stored, however
+        # many processes count terms
+        edited = dict(self.records[0], abstract=u'Notes.')
+        for workers in (1, 2):
+            BulkLoader().load(self.records)
+            BulkLoader(batch_size=1).load([edited, self.records[0]], workers=workers)
+            self.assertEqual(self.records[0]['abstract'], Article.objects.get().abstract)
+            self.assertEqual(1, Frequency.objects.filter(term__term=u'laboratory').count())
+            Article.objects.all().delete()
+
+    def test_bulk_load_is_repeatable(self):
+        BulkLoader().load(self.records)
+        BulkLoader().load(self.records + self.records)
+        self.assertEqual(1, Article.objects.count())
+        self.assertEqual(1, Journal.objects.count())
+        self.assertEqual(6, Author.objects.count())
+        self.assertEqual(6, Order.objects.count())
+
+class IncrementalLoadTest(ArticleBaseTest):
+    def setUp(self):
+        super(IncrementalLoadTest, self).setUp()
+        self.edited = dict(self.records[0], abstract=u"Implementation of paging.")
+
+    def _assert_edited(self):
+        self.assertEqual(1, Article.objects.count())
+        article = Article.objects.get()
+        self.assertEqual(self.edited['abstract'], article.abstract)
+        self.assertEqual(6, article.order_set.count())
+        frequencies = dict(article.frequency_set.values_list('term__term', 'frequency'))
+        self.assertEqual(2, frequencies['implementation'])
+        self.assertNotIn('laboratory', frequencies)
+
+    def test_create_db_entries_replaces_changed_article(self):
+        create_db_entries(self.records[0])
+        # an unchanged article is found and left alone
+        with self.assertNumQueries(1):
+            create_db_entries(self.records[0])
+        create_db_entries(self.edited)
+        self._assert_edited()
+
+    def test_bulk_replaces_changed_article(self):
+        BulkLoader().load(self.records)
+        loader = BulkLoader()
+        self.assertFalse(loader.needs_loading(self.records[0]))
+        self.assertTrue(loader.needs_loading(self.edited))
+        loader.load([self.edited])
+        self._assert_edited()
+
+    def _write_records(self, path, records):
+        with open(path, 'w') as json_file:
+            if path.endswith('.jsonl'):
+                json_file.write('\n'.join(json.dumps(record) for record in records))
+            else:
+                json.dump(records, json_file, indent=4)
+
+    def test_resume_from_checkpoint(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for filename in ('articles.json', 'articles.jsonl'):
+                records = [dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i)
+                           for i in range(3)]
+                records[2]['authors'] = [u'Unparseable']
+                path = os.path.join(directory, filename)
+                self._write_records(path, records)
+                self.assertRaises(ValueError, load_json_from_file, path,
+                                  bulk=True, batch_size=1)
+
+                checkpoint = Checkpoint.objects.get(filename=path)
+                self.assertEqual(2, checkpoint.records)
+                resumed = RecordReader(path, offset=checkpoint.offset)
+                self.assertEqual(records[2:], list(resumed))
+
+                records[2]['authors'] = self.records[0]['authors']
+                self._write_records(path, records)
+                Article.objects.filter(pubmed_url=records[0]['pubmedUrl']).delete()
+                load_json_from_file(path, resume=True, bulk=True)
+                self.assertEqual([records[1]['pubmedUrl'], records[2]['pubmedUrl']],
+                                 list(Article.objects.order_by('pk').values_list(
+                                     'pubmed_url', flat=True)))
+                self.assertFalse(Checkpoint.objects.exists())
+                Article.objects.all().delete()
+        finally:
+            shutil.rmtree(directory)
+
+class ReaderTest(ArticleBaseTest):
+    def setUp(self):
+        super(ReaderTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iter_json_array_small_chunks(self):
+        stream = StringIO(self.raw_record.encode('utf-8'))
+        self.assertEqual(self.records, list(iter_json_array(stream, chunk_size=7)))
+        self.assertEqual([], list(iter_json_array(StringIO(' [ ] '))))
+        self.assertRaises(ValueError, list, iter_json_array(StringIO('[{"a": 1}, ')))
+
+    def test_iter_records_gzipped_json_lines(self):
+        path = os.path.join(self.directory, 'articles.jsonl.gz')
+        gz = gzip.open(path, 'wb')
+        try:
+            for record in self.records * 3:
+                gz.write(json.dumps(record) + '\n\n')
+        finally:
+            gz.close()
+        self.assertEqual(self.records * 3, list(iter_records(path)))
+
+@override_settings(PUBMED_SEARCH_DATABASE='readonly')
+class DatabaseTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _connect(self, alias):
+        backend = load_backend('django.db.backends.sqlite3')
+        return backend.DatabaseWrapper({'ENGINE': 'django.db.backends.sqlite3',
+                                        'NAME': os.path.join(self.directory, 'test.db'),
+                                        'OPTIONS': {}, 'TIME_ZONE': None}, alias)
+
+    def test_connection_pragmas(self):
+        writer = self._connect('default')
+        cursor = writer.cursor()
+        for pragma, expected in (('journal_mode', 'wal'), ('synchronous', 1),
+                                 ('temp_store', 2), ('busy_timeout', 20000),
+                                 ('query_only', 0)):
+            cursor.execute('PRAGMA %s' % pragma)
+            self.assertEqual(expected, cursor.fetchone()[0])
+        cursor.execute('CREATE TABLE numbers (number INTEGER)')
+        cursor.execute('INSERT INTO numbers VALUES (1)')
+        writer.connection.commit()
+
+        reader = self._connect('readonly')
+        cursor = reader.cursor()
+        cursor.execute('SELECT number FROM numbers')
+        self.assertEqual([(1,)], cursor.fetchall())
+        self.assertRaises(DatabaseError, cursor.execute, 'INSERT INTO numbers VALUES (2)')
+        reader.close()
+        writer.close()
+
+    def test_search_router(self):
+        router = SearchRouter()
+        self.assertEqual(None, router.db_for_read(Article))
+        self.assertEqual('readonly', read_only(router.db_for_read)(Article))
+        self.assertEqual(None, read_only(router.db_for_write)(Article))
+        self.assertEqual(False, router.allow_syncdb('readonly', Article))
+        self.assertEqual(None, router.allow_syncdb('default', Article))
+
 class CleanTermTest(TestCase):
     def test_clean_term(self):
         words = ('Clin.', 'Chem.', 'Implementation', 'closed-loop', 'commission.')
@@ -62,6 +270,109 @@ class CleanTermTest(TestCase):
         self.assertIn('closed-loop', cleaned_words)
         self.assertIn('commission', cleaned_words)
 
+class TokenizerTest(ArticleBaseTest):
+    def test_tokenize_matches_clean_term(self):
+        text = u' '.join((self.records[0]['title'], self.records[0]['abstract'],
+                          u'& <3 Caf\xe9 \u212a-RAS x.y.z --'))
+        expected = [clean_term(term) for term in text.split()]
+        self.assertEqual(expected, Tokenizer().tokenize(text))
+
+        tokenizer = Tokenizer(stop_words=STOP_WORDS)
+        expected = [term for term in expected if term not in STOP_WORDS]
+        self.assertEqual(expected, tokenizer.tokenize(text))
+        self.assertIn(u'', expected)
+
+    def test_tokenize_partial(self):
+        tokenizer = Tokenizer(stop_words=STOP_WORDS)
+        self.assertEqual(([u'critical'], u'the'), tokenizer.tokenize_partial(u'Critical, The'))
+        self.assertEqual(([u'critical'], None), tokenizer.tokenize_partial(u'the critical '))
+        self.assertEqual(([], u'lab'), tokenizer.tokenize_partial(u'Lab'))
+        self.assertEqual(([], None), tokenizer.tokenize_partial(u''))
+
+class StatisticsTest(ArticleBaseTest):
+    def setUp(self):
+        super(StatisticsTest, self).setUp()
+        self.other = dict(self.records[0], pubmedUrl=u'http://example.com/1',
+                          abstract=u'Implementation notes.')
+
+    def _statistics(self):
+        terms = Term.objects.values_list('term', flat=True)
+        corpus = Corpus.objects.get_current()
+        return (corpus.documents, corpus.length,
+                dict(Article.objects.values_list('pk', 'length')),
+                dict(Term.objects.values_list('term', 'document_frequency')),
+                sorted(AuthorTerm.objects.sums(terms)))
+
+    def _assert_statistics(self, documents, implementation, laboratory):
+        statistics = self._statistics()
+        total, length, lengths, frequencies, author_sums = statistics
+        self.assertEqual(documents, total)
+        for article in Article.objects.all():
+            self.assertEqual(sum(article.frequency_set.values_list('frequency', flat=True)),
+                             lengths[article.pk])
+        self.assertEqual(sum(lengths.values()), length)
+        self.assertEqual(implementation, frequencies['implementation'])
+        self.assertEqual(laboratory, frequencies['laboratory'])
+        # every article is by Parl FF
+        parl = Author.objects.get(last_name=u'Parl').pk
+        total = sum(Frequency.objects.filter(term__term=u'implementation')
+                    .values_list('frequency', flat=True))
+        self.assertTrue((parl, u'implementation', total, implementation) in author_sums)
+        rebuild_statistics()
+        self.assertEqual(statistics, self._statistics())
+        self.assertEqual(len(author_sums), AuthorTerm.objects.count())
+
+    def test_create_db_entries_statistics(self):
+        create_db_entries(self.records[0])
+        create_db_entries(self.other)
+        self._assert_statistics(2, 2, 1)
+        Article.objects.get(pubmed_url=self.other['pubmedUrl']).delete()
+        self._assert_statistics(1, 1, 1)
+
+    def test_rebuild_author_terms_queries(self):
+        BulkLoader().load(self.records)
+        expected = sorted(AuthorTerm.objects.values_list('author', 'term', 'frequency',
+                                                         'articles'))
+        self.assertTrue(len(expected) > 1)
+        # the old rows deleted and the sums inserted, none of them loaded
+        with self.assertNumQueries(2):
+            AuthorTerm.objects.rebuild()
+        self.assertEqual(expected, sorted(AuthorTerm.objects.values_list(
+            'author', 'term', 'frequency', 'articles')))
+
+    def test_rebuild_records_missing_positions(self):
+        create_db_entries(self.records[0])
+        expected = dict(Frequency.objects.values_list('term__term', 'positions'))
+        self.assertEqual([1], decode_positions(expected[u'closed-loop']))
+        Frequency.objects.update(positions='')
+        rebuild_statistics()
+        self.assertEqual(expected, dict(Frequency.objects.values_list('term__term', 'positions')))
+
+    def test_replace_statistics(self):
+        create_db_entries(self.records[0])
+        create_db_entries(self.other)
+        create_db_entries(dict(self.other, abstract=u'Laboratory notes.'))
+        self._assert_statistics(2, 2, 2)
+
+    def test_bulk_replace_queries(self):
+        records = [dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i)
+                   for i in range(20)]
+        BulkLoader().load(records)
+        loader = BulkLoader()
+        # an update of each changed article, the stored articles looked up
+        # together, and the term frequencies they replace deleted together
+        # rather than row by row
+        with self.assertNumQueries(len(records) + 18):
+            loader.load([dict(record, abstract=u'Laboratory notes.') for record in records])
+        self._assert_statistics(20, 20, 20)
+
+    def test_bulk_statistics(self):
+        BulkLoader().load(self.records)
+        BulkLoader().load([self.other])
+        self._assert_statistics(2, 2, 1)
+        BulkLoader().load([dict(self.other, abstract=u'Laboratory notes.')])
+        self._assert_statistics(2, 2, 2)
+
 class TFIDFTest(ArticleBaseTest):
     def test_tfidf(self):
         record = self.records[0]
@@ -74,6 +385,695 @@ class TFIDFTest(ArticleBaseTest):
 
         self.assertEqual(idf, tfidf(implementation, article))
 
+    def test_tfidf_batch(self):
+        create_db_entries(self.records[0])
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1',
+                               title=u'Laboratory notes.', abstract=u'Notes.'))
+        articles = list(Article.objects.all())
+        terms = list(Term.objects.filter(term__in=['implementation', 'laboratory',
+                                                   'notes']))
+        with self.assertNumQueries(2):
+            scores = tfidf_batch(terms, articles)
+        self.assertEqual(len(terms) * len(articles), len(scores))
+        for term in terms:
+            for article in articles:
+                self.assertEqual(tfidf(term, article), scores[(term.pk, article.pk)])
+        laboratory = Term.objects.get(term='laboratory')
+        notes = Article.objects.get(pubmed_url=u'http://example.com/1')
+        self.assertEqual(math.log(2.0/3.0), scores[(laboratory.pk, notes.pk)])
+        # fewer articles than postings are read in chunks of articles
+        with self.assertNumQueries(3):
+            self.assertEqual(scores, tfidf_batch(terms, articles, chunk_size=1))
+        with self.assertNumQueries(2):
+            self.assertEqual(tfidf(laboratory, notes), scores[(laboratory.pk, notes.pk)])
+
+class IndexBaseTest(ArticleBaseTest):
+    def setUp(self):
+        super(IndexBaseTest, self).setUp()
+        create_db_entries(self.records[0])
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1',
+                               title=u'Laboratory notes.', abstract=u'Notes.'))
+
+class IndexTest(IndexBaseTest):
+
+    def test_postings_match_frequencies(self):
+        index = InvertedIndex.build()
+        self.assertEqual(Term.objects.filter(document_frequency__gt=0).count(), len(index))
+        self.assertEqual(list(index.terms), sorted(index.terms))
+        for term in Term.objects.all():
+            term_id = index.lookup(term.term)
+            self.assertEqual(term.document_frequency, index.document_frequency(term_id))
+            doc_ids, frequencies = index.postings(term_id)
+            self.assertEqual(sorted(set(doc_ids)), list(doc_ids))
+            expected = list(term.frequency_set.order_by('article__id').values_list(
+                'article', 'frequency'))
+            self.assertEqual(expected, zip(doc_ids, frequencies))
+        self.assertEqual(None, index.lookup(u'absent'))
+
+    def test_tfidf_batch_matches_nlp(self):
+        index = InvertedIndex.build()
+        articles = list(Article.objects.all())
+        terms = list(Term.objects.filter(term__in=['implementation', 'notes']))
+        expected = tfidf_batch(terms, articles)
+        scores = index.tfidf_batch([term.term for term in terms] + [u'absent'],
+                                   index.find([u'implementation', u'notes']))
+        self.assertEqual(len(expected), len(scores))
+        for term in terms:
+            for article in articles:
+                self.assertEqual(expected[(term.pk, article.pk)],
+                                 scores[(term.term, article.pk)])
+
+    def test_expand_prefix(self):
+        index = InvertedIndex.build()
+        # ties go to the first term of the vocabulary
+        self.assertEqual([u'clinical', u'clinicians'], index.expand_prefix(u'clini', 5))
+        self.assertEqual([u'clinical'], index.expand_prefix(u'clini', 1))
+        self.assertEqual([u'notes'], index.expand_prefix(u'notes', 5))
+        self.assertEqual([], index.expand_prefix(u'zz', 5))
+        self.assertEqual([], index.expand_prefix(u'', 5))
+
+    def test_expand_prefix_most_frequent(self):
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/2',
+                               title=u'Clinicians.', abstract=u'Notes.'))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'index')
+            write_snapshot(InvertedIndex.build(), path)
+            for index in (InvertedIndex.build(), MappedIndex(path)):
+                # clinicians is in more articles, though clinical sorts first
+                self.assertEqual([u'clinicians'], index.expand_prefix(u'clini', 1))
+                self.assertEqual([u'clinicians', u'clinical'],
+                                 index.expand_prefix(u'clini', 5))
+                expansions = index.expand_prefix(u'c', 3)
+                self.assertEqual(u'clinicians', expansions[0])
+                self.assertTrue(all(term.startswith(u'c') for term in expansions))
+                frequencies = [index.document_frequency(index.lookup(term))
+                               for term in expansions]
+                self.assertEqual(sorted(frequencies, reverse=True), frequencies)
+                self.assertEqual([], index.expand_prefix(u'clinicz', 5))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_get_index_follows_generation(self):
+        index = get_index()
+        self.assertTrue(get_index() is index)
+        Article.objects.get(pubmed_url=u'http://example.com/1').delete()
+        rebuilt = get_index()
+        self.assertFalse(rebuilt is index)
+        self.assertEqual([], rebuilt.find([u'notes']))
+
+    def test_get_index_rebuild_interval(self):
+        index = get_index()
+        Article.objects.get(pubmed_url=u'http://example.com/1').delete()
+        with self.settings(PUBMED_INDEX_REBUILD_INTERVAL=60):
+            self.assertTrue(get_index() is index)
+        self.assertEqual([], get_index().find([u'notes']))
+
+class TopKTest(IndexBaseTest):
+    def setUp(self):
+        super(TopKTest, self).setUp()
+        for i, abstract in enumerate([u'Notes, notes.', u'Critical notes.',
+                                      u'Laboratory values.', u'Notes.']):
+            create_db_entries(dict(self.records[0], title=u'Notes.', abstract=abstract,
+                                   pubmedUrl=u'http://example.com/top/%d' % i))
+
+    def test_top_k_matches_rank(self):
+        index = InvertedIndex.build()
+        for query in ([u'notes'], [u'critical', u'laboratory'],
+                      [u'critical', u'laboratory', u'notes'], [u'values', u'absent'],
+                      [u'absent'], []):
+            ranking = index.rank(query)
+            for k in range(len(ranking) + 2):
+                self.assertEqual(ranking[:k], index.top_k(query, k))
+
+    def test_top_k_after(self):
+        index = InvertedIndex.build()
+        for query in ([u'notes'], [u'critical', u'laboratory'],
+                      [u'critical', u'laboratory', u'notes']):
+            ranking = index.rank(query)
+            for position, entry in enumerate(ranking):
+                self.assertEqual(ranking[position + 1:position + 3],
+                                 index.top_k(query, 2, entry))
+
+    def test_top_k_with_common_terms(self):
+        # 'notes' is in five of the six articles, so its IDF is not positive
+        index = InvertedIndex.build()
+        self.assertTrue(index.idf(index.lookup(u'notes')) <= 0)
+        query = [u'notes', u'laboratory']
+        self.assertEqual(index.rank(query)[:2], index.top_k(query, 2))
+
+class ShuffledIndexTest(ArticleBaseTest):
+    """An index of articles whose titles, by which articles are ordered, are
+    in the reverse order of their ids."""
+    words = [u'cancer', u'lung', u'gene', u'patients', u'cells', u'therapy']
+
+    def setUp(self):
+        super(ShuffledIndexTest, self).setUp()
+        random = Random(0)
+        for i in range(40):
+            abstract = u' '.join(random.choice(self.words)
+                                 for j in range(random.randint(1, 8)))
+            create_db_entries(dict(self.records[0], title=u'Study %02d.' % (40 - i),
+                                   abstract=abstract, authors=[u'Author %d' % (i % 4)],
+                                   pubmedUrl=u'http://example.com/shuffled/%d' % i))
+        pks = list(Article.objects.values_list('pk', flat=True))
+        self.assertEqual(sorted(pks, reverse=True), pks)
+
+    def test_postings_ascend(self):
+        index = InvertedIndex.build()
+        for term in self.words:
+            term_id = index.lookup(term)
+            doc_ids, frequencies = index.postings(term_id)
+            self.assertEqual(sorted(set(doc_ids)), list(doc_ids))
+            for doc_id, tf in Frequency.objects.filter(term__term=term).values_list(
+                    'article', 'frequency'):
+                self.assertEqual(tf, index.frequency(term_id, doc_id))
+
+    def test_top_k_pages(self):
+        index = InvertedIndex.build()
+        for model in SCORING_MODELS.values():
+            for query in ([u'patients'], [u'cancer', u'lung', u'gene']):
+                ranking = index.rank(query, model)
+                pages = [index.top_k(query, 3, model=model)]
+                while pages[-1]:
+                    pages.append(index.top_k(query, 3, pages[-1][-1], model))
+                self.assertEqual(ranking, [entry for page in pages for entry in page])
+
+                doc_ids = index.find(query)
+                pages = [index.top_k_of(query, doc_ids, 3, model=model)]
+                while pages[-1]:
+                    pages.append(index.top_k_of(query, doc_ids, 3, pages[-1][-1], model))
+                self.assertEqual(ranking, [entry for page in pages for entry in page])
+
+    def _brute_force(self, terms, phrase=False):
+        # the ids of the articles containing every one of terms, or the
+        # terms as a phrase, from their Frequency rows
+        positions = {}
+        for term in terms:
+            for doc_id, term_positions in Frequency.objects.filter(
+                    term__term=term).values_list('article', 'positions'):
+                positions.setdefault(doc_id, []).append(set(decode_positions(term_positions)))
+        matches = [doc_id for doc_id, term_positions in positions.iteritems()
+                   if len(term_positions) == len(terms)]
+        if phrase:
+            matches = [doc_id for doc_id in matches
+                       if any(all(start + offset in positions[doc_id][offset]
+                                  for offset in range(len(terms)))
+                              for start in positions[doc_id][0])]
+        return sorted(matches)
+
+    def test_match_all_and_phrase(self):
+        index = InvertedIndex.build()
+        for terms in ([u'cancer', u'lung'], [u'gene', u'patients', u'cells'],
+                      [u'therapy', u'therapy']):
+            expected = self._brute_force(terms)
+            self.assertEqual(expected,
+                             index.match_all([index.term_run(term) for term in terms]))
+            self.assertEqual(self._brute_force(terms, phrase=True), index.match_phrase(terms))
+        self.assertTrue(self._brute_force([u'cancer', u'lung'], phrase=True))
+
+    def test_author_averages_of_matches(self):
+        index = get_index()
+        terms = [u'cancer', u'lung']
+        doc_ids = self._brute_force(terms)
+        expected = {}
+        for doc_id in doc_ids:
+            scores = [index.idf(index.lookup(term)) * Frequency.objects.get(
+                term__term=term, article=doc_id).frequency for term in terms]
+            for author in Article.objects.get(pk=doc_id).authors.all():
+                expected.setdefault(unicode(author), []).extend(scores)
+        data = json.loads(self.client.get('/api/search/', {'q': 'cancer lung',
+                                                           'operator': 'AND'}).content)
+        self.assertEqual(len(doc_ids), data['total_results'])
+        averages = dict((author['name'], author['average']) for author in data['authors'])
+        self.assertEqual(sorted(expected), sorted(averages))
+        for name, scores in expected.iteritems():
+            self.assertAlmostEqual(math.fsum(scores) / (2 * len(doc_ids)), averages[name])
+
+class ScoringModelTest(IndexBaseTest):
+    def test_models_match_nlp(self):
+        index = InvertedIndex.build()
+        articles = list(Article.objects.all())
+        terms = list(Term.objects.filter(term__in=['implementation', 'laboratory', 'notes']))
+        for model in SCORING_MODELS.values():
+            expected = tfidf_batch(terms, articles, model)
+            scores = index.tfidf_batch([term.term for term in terms],
+                                       [article.pk for article in articles], model)
+            for term in terms:
+                for article in articles:
+                    self.assertEqual(expected[(term.pk, article.pk)],
+                                     scores[(term.term, article.pk)])
+
+    def test_top_k_matches_rank(self):
+        index = InvertedIndex.build()
+        for model in SCORING_MODELS.values():
+            for query in ([u'notes'], [u'laboratory', u'critical'], [u'notes', u'closed-loop']):
+                ranking = index.rank(query, model)
+                for k in range(4):
+                    self.assertEqual(ranking[:k], index.top_k(query, k, model=model))
+                for position, entry in enumerate(ranking):
+                    self.assertEqual(ranking[position + 1:position + 3],
+                                     index.top_k(query, 2, entry, model))
+
+    def test_bm25(self):
+        index = InvertedIndex.build()
+        bm25 = get_scoring_model('bm25')
+        long_article = Article.objects.get(pubmed_url=self.records[0]['pubmedUrl'])
+        short_article = Article.objects.get(pubmed_url=u'http://example.com/1')
+        # laboratory is three times in the long article and once in the short
+        # one, which BM25 ranks first for its length
+        self.assertEqual([3, 1], [index.frequency(index.lookup(u'laboratory'), article.pk)
+                                  for article in (long_article, short_article)])
+        self.assertEqual([short_article.pk, long_article.pk],
+                         [doc_id for score, doc_id in index.rank([u'laboratory'], bm25)])
+        # a term in every article still scores above zero
+        self.assertTrue(all(score > 0 for score, doc_id in index.rank([u'notes'], bm25)))
+        self.assertEqual(float(long_article.length + short_article.length) / 2,
+                         index.average_length())
+
+class QueryTest(IndexBaseTest):
+    def test_parse_query(self):
+        self.assertEqual(('OR', u'critical', u'values'), parse_query(u'critical values').key())
+        self.assertEqual(('AND', u'critical', u'values'),
+                         parse_query(u'critical values', 'AND').key())
+        self.assertEqual(('OR', ('AND', u'critical', u'values'), u'notes'),
+                         parse_query(u'notes OR critical AND values').key())
+        self.assertEqual(('AND', ('OR', u'laboratory', u'notes'), u'critical'),
+                         parse_query(u'(notes OR Laboratory) critical', 'AND').key())
+        # stop words are dropped from phrases, as from articles
+        self.assertEqual(('OR', ('"', u'reporting', u'critical', u'values'), u'notes'),
+                         parse_query(u'"reporting of critical values" notes').key())
+        self.assertEqual(u'notes', parse_query(u'AND the notes OR )').key())
+        self.assertEqual([], parse_query(u'"the" OR').terms())
+        self.assertTrue(parse_query(u'critical values').matches_any_term)
+        self.assertFalse(parse_query(u'critical values', 'AND').matches_any_term)
+
+    def test_match_query(self):
+        index = InvertedIndex.build()
+        article = Article.objects.get(pubmed_url=self.records[0]['pubmedUrl']).pk
+        notes = Article.objects.get(pubmed_url=u'http://example.com/1').pk
+        for query, expected in [(u'laboratory notes', [article, notes]),
+                                (u'laboratory AND notes', [notes]),
+                                (u'laboratory AND (notes OR critical)', [article, notes]),
+                                (u'"critical values"', [article]),
+                                (u'"reporting of critical values"', [article]),
+                                (u'"values critical"', []),
+                                (u'"laboratory notes" OR absent', [notes]),
+                                (u'notes AND absent', [])]:
+            self.assertEqual(expected, list(parse_query(query).doc_ids(index)))
+
+    def test_match_all(self):
+        random = Random(0)
+        doc_ids = array('I')
+        runs = []
+        for length in (0, 3, 50, 400):
+            start = len(doc_ids)
+            doc_ids.extend(sorted(random.sample(xrange(500), length)))
+            runs.append((doc_ids, start, len(doc_ids)))
+        index = InvertedIndex([], array('I', [0]), array('I'), array('I'), 0)
+        for count in range(1, 4):
+            for chosen in (runs[-count:], runs[:count]):
+                expected = set(doc_ids[chosen[0][1]:chosen[0][2]])
+                for sequence, start, end in chosen[1:]:
+                    expected.intersection_update(sequence[start:end])
+                self.assertEqual(sorted(expected), index.match_all(chosen))
+
+    def test_top_k_of(self):
+        index = InvertedIndex.build()
+        query = [u'laboratory', u'notes', u'absent']
+        ranking = index.rank(query)
+        doc_ids = index.find(query)
+        self.assertEqual(ranking[:1], index.top_k_of(query, doc_ids, 1))
+        self.assertEqual(ranking[1:], index.top_k_of(query, doc_ids, 2, ranking[0]))
+        self.assertEqual([entry for entry in ranking if entry[1] == doc_ids[0]],
+                         index.top_k_of(query, doc_ids[:1], 2))
+
+class RelatedTest(IndexBaseTest):
+    def setUp(self):
+        super(RelatedTest, self).setUp()
+        for i, abstract in enumerate([u'Critical laboratory values.', u'Paging notes.',
+                                      u'Critical paging.', u'Alerts.']):
+            create_db_entries(dict(self.records[0], title=u'Values.', abstract=abstract,
+                                   pubmedUrl=u'http://example.com/related/%d' % i))
+
+    def test_similar_is_cosine(self):
+        index = InvertedIndex.build()
+        weights = {}
+        for term in index.terms:
+            term_id = index.lookup(term)
+            for doc_id, tf in zip(*index.postings(term_id)):
+                weights.setdefault(doc_id, {})[term_id] = tf*index.idf(term_id)
+        vectors = index.document_vectors(len(index))
+        self.assertEqual(sorted(weights), sorted(vectors))
+        for doc_id, vector in vectors.iteritems():
+            expected = []
+            for other, other_weights in weights.iteritems():
+                product = sum(weight*other_weights.get(term_id, 0)
+                              for term_id, weight in weights[doc_id].iteritems()
+                              if weight > 0)
+                if other != doc_id and any(term_id in other_weights for term_id, weight
+                                           in vector):
+                    expected.append((product / index.norm(doc_id) / index.norm(other), other))
+            expected.sort(key=lambda entry: (-entry[0], entry[1]))
+            similar = index.similar(vector, 3, doc_id)
+            self.assertEqual([doc_id for similarity, doc_id in expected[:3]],
+                             [doc_id for similarity, doc_id in similar])
+            for (expected_similarity, other), (similarity, other) in zip(expected, similar):
+                self.assertAlmostEqual(expected_similarity, similarity)
+
+        for vector in index.document_vectors(len(index), 1).itervalues():
+            self.assertTrue(all(index.document_frequency(term_id) == 1
+                                for term_id, weight in vector))
+
+        # cut to its best term, a vector only finds articles sharing it
+        vector = index.document_vectors(1)[doc_id]
+        self.assertEqual(1, len(vector))
+        for similarity, other in index.similar(vector, 10):
+            self.assertTrue(index.frequency(vector[0][0], other))
+
+    def test_related_articles_page(self):
+        stored = build_related_articles(2, 5)
+        self.assertEqual(RelatedArticle.objects.count(), stored)
+        critical = Article.objects.get(abstract=u'Critical paging.')
+        related = critical.related_articles.all()
+        self.assertEqual([0, 1], [entry.rank for entry in related])
+        self.assertEqual(u'Paging notes.', related[0].related.abstract)
+        self.client.get('/articles/')
+        with self.assertNumQueries(3):
+            response = self.client.get(critical.get_absolute_url())
+        self.assertContains(response, 'Related articles')
+        self.assertContains(response, related[0].related.get_absolute_url())
+
+    def test_related_articles_revalidated(self):
+        build_related_articles(1, 5)
+        critical = Article.objects.get(abstract=u'Critical paging.')
+        stale = self.client.get(critical.get_absolute_url())
+        response = self.client.get(critical.get_absolute_url(),
+                                   HTTP_IF_NONE_MATCH=stale['ETag'])
+        self.assertEqual(304, response.status_code)
+        build_related_articles(2, 5)
+        response = self.client.get(critical.get_absolute_url(),
+                                   HTTP_IF_NONE_MATCH=stale['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, critical.related_articles.get(rank=1)
+                            .related.get_absolute_url())
+
+class SnapshotTest(IndexBaseTest):
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_matches_index(self):
+        index = InvertedIndex.build()
+        write_snapshot(index, self.path)
+        mapped = MappedIndex(self.path)
+        self.assertEqual(index.generation, mapped.generation)
+        self.assertEqual(index.total_documents, mapped.total_documents)
+        self.assertEqual(list(index.terms), list(mapped.terms))
+        self.assertEqual(index.offsets, mapped.offsets[:])
+        self.assertEqual(index.doc_ids, mapped.doc_ids[:])
+        self.assertEqual(index.frequencies, mapped.frequencies[:])
+        self.assertEqual(index.position_offsets, mapped.position_offsets[:])
+        self.assertEqual(index.positions, mapped.positions[:])
+        self.assertEqual(index.document_lengths(), mapped.document_lengths()[:])
+        self.assertEqual(index.average_length(), mapped.average_length())
+        for term in index.terms:
+            term_id = mapped.lookup(term)
+            self.assertEqual(index.lookup(term), term_id)
+            self.assertEqual(index.idf(term_id), mapped.idf(term_id))
+            self.assertEqual(index.postings(term_id), mapped.postings(term_id))
+        for doc_id in index.find(index.terms):
+            self.assertEqual(index.norm(doc_id), mapped.norm(doc_id))
+        self.assertEqual(None, mapped.lookup(u'absent'))
+        mapped.close()
+
+    def test_get_index_uses_current_snapshot(self):
+        write_snapshot(InvertedIndex.build(), self.path)
+        with self.settings(PUBMED_INDEX_SNAPSHOT=self.path):
+            self.assertTrue(isinstance(get_index(), MappedIndex))
+            Article.objects.get(pubmed_url=u'http://example.com/1').delete()
+            self.assertFalse(isinstance(get_index(), MappedIndex))
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write('\0' * 64)
+        self.assertRaises(ValueError, MappedIndex, self.path)
+
+@unittest.skipIf(numpy is None, "NumPy and SciPy are not installed")
+class MatrixTest(IndexBaseTest):
+    def setUp(self):
+        super(MatrixTest, self).setUp()
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/2',
+                               title=u'Notes on notes.', abstract=u'Critical notes.'))
+
+    def test_matrix_matches_index(self):
+        index = InvertedIndex.build()
+        scorer = MatrixScorer(index)
+        for query in ([u'notes'], [u'implementation', u'notes', u'absent'],
+                      [u'critical', u'laboratory', u'notes'], [u'absent'], []):
+            self.assertEqual(index.rank(query), scorer.rank(query))
+            for k in range(5):
+                self.assertEqual(index.top_k(query, k), scorer.top_k(query, k))
+            for entry in index.rank(query):
+                self.assertEqual(index.top_k(query, 2, entry),
+                                 scorer.top_k(query, 2, entry))
+            self.assertEqual(index.term_scores(query), scorer.term_scores(query))
+
+    def test_matrix_matches_index_by_model(self):
+        index = InvertedIndex.build()
+        for model in SCORING_MODELS.values():
+            scorer = MatrixScorer(index, model)
+            for query in ([u'notes'], [u'critical', u'laboratory', u'notes']):
+                self.assertEqual(index.rank(query, model), scorer.rank(query))
+                self.assertEqual(index.top_k(query, 2, model=model),
+                                 scorer.top_k(query, 2, model=model))
+        self.assertRaises(ValueError, scorer.rank, [u'notes'], get_scoring_model('tfidf'))
+
+    def test_search_with_matrix_backend(self):
+        responses = []
+        for backend in ('index', 'matrix'):
+            with self.settings(PUBMED_SEARCH_BACKEND=backend, PUBMED_SEARCH_CACHE=None):
+                responses.append(self.client.post('/', {'q': 'notes laboratory'}))
+        index_context, matrix_context = [response.context for response in responses]
+        self.assertEqual(3, len(matrix_context['articles']))
+        self.assertEqual(index_context['articles'], matrix_context['articles'])
+        self.assertEqual(index_context['author_averages'],
+                         matrix_context['author_averages'])
+
+class ShardTest(IndexBaseTest):
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        for i in range(4):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % (i + 2),
+                                   title=u'Notes %d.' % i, abstract=u'Critical notes ' * i))
+
+    def test_split_index(self):
+        index = InvertedIndex.build()
+        shards = split_index(index, 3)
+        self.assertEqual(sorted(index.doc_ids), sorted(doc_id for shard in shards
+                                                       for doc_id in shard.doc_ids))
+        self.assertEqual(index.total_documents, sum(shard.documents for shard in shards))
+        for shard in shards:
+            self.assertEqual(index.total_documents, shard.total_documents)
+            self.assertEqual(index.average_length(), shard.average_length())
+            for term_id, term in enumerate(shard.terms):
+                self.assertEqual(index.document_frequency(index.lookup(term)),
+                                 shard.document_frequency(term_id))
+
+    def test_sharded_search_matches_index(self):
+        index = InvertedIndex.build()
+        searcher = ShardedSearcher(index, 3)
+        try:
+            doc_ids = index.find([u'critical'])
+            for model in SCORING_MODELS.values():
+                for query in ([u'notes'], [u'critical', u'laboratory', u'notes'], [u'absent']):
+                    ranking = index.rank(query, model)
+                    self.assertEqual(ranking, searcher.rank(query, model))
+                    for k in range(4):
+                        self.assertEqual(ranking[:k], searcher.top_k(query, k, model=model))
+                    for position, entry in enumerate(ranking):
+                        self.assertEqual(ranking[position + 1:position + 3],
+                                         searcher.top_k(query, 2, entry, model))
+                    self.assertEqual(index.top_k_of(query, doc_ids, 3, model=model),
+                                     searcher.top_k_of(query, doc_ids, 3, model=model))
+        finally:
+            searcher.close()
+
+    def test_search_with_sharded_backend(self):
+        contexts = []
+        for backend in ('index', 'sharded'):
+            with self.settings(PUBMED_SEARCH_BACKEND=backend, PUBMED_SEARCH_SHARDS=2,
+                               PUBMED_SEARCH_CACHE=None):
+                for q in ('notes laboratory', 'notes AND critical'):
+                    contexts.append(self.client.post('/', {'q': q}).context)
+        for index_context, sharded_context in zip(contexts[:2], contexts[2:]):
+            self.assertEqual(index_context['articles'], sharded_context['articles'])
+            self.assertEqual(index_context['author_averages'],
+                             sharded_context['author_averages'])
+
+class CacheTest(ArticleBaseTest):
+    def test_lru_eviction(self):
+        cache = LRUCache('test', {'OPTIONS': {'MAX_ENTRIES': 3, 'CULL_FREQUENCY': 3}})
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key)
+        cache.get('a')
+        cache.set('d', 'd')
+        self.assertEqual(['a', None, 'c', 'd'],
+                         [cache.get(key) for key in ('a', 'b', 'c', 'd')])
+        cache.clear()
+
+    def test_search_cache(self):
+        create_db_entries(self.records[0])
+        first = self.client.post('/', {'q': 'implementation critical'})
+        with self.assertNumQueries(3):
+            second = self.client.post('/', {'q': 'Critical implementation'})
+        self.assertEqual(first.context['articles'], second.context['articles'])
+        self.assertEqual(first.context['author_averages'], second.context['author_averages'])
+        self.client.get('/autosearch/', {'q': 'impl'})
+        statistics = json.loads(self.client.get('/stats/cache/').content)
+        self.assertEqual(get_term_cache().statistics(), statistics.pop('terms'))
+        self.assertEqual({'search': {'hits': 1, 'misses': 1, 'hit_ratio': 0.5},
+                          'autosearch': {'hits': 0, 'misses': 1, 'hit_ratio': 0.0}},
+                         statistics)
+
+        # loading articles changes the corpus generation
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1'))
+        third = self.client.post('/', {'q': 'implementation critical'})
+        self.assertEqual(2, len(third.context['articles']))
+        self.assertEqual(2, cache_statistics()['search']['misses'])
+
+    def test_term_cache_eviction(self):
+        cache = TermCache(1000000)
+        cache.get((0, u'a'), lambda key: (0, 1, 0.0))
+        # room for three entries of one-letter terms
+        cache.max_bytes = 3 * cache.bytes
+        for term in (u'b', u'c', u'a', u'd'):
+            cache.get((0, term), lambda key: (0, 1, 0.0))
+        self.assertEqual({'hits': 1, 'misses': 4, 'hit_ratio': 0.2, 'entries': 3,
+                          'bytes': cache.max_bytes}, cache.statistics())
+        computed = []
+        # b was least recently used
+        for term in (u'a', u'b'):
+            cache.get((0, term), computed.append)
+        self.assertEqual([(0, u'b')], computed)
+
+    def test_term_cache_follows_generation(self):
+        create_db_entries(self.records[0])
+        index = get_index()
+        self.assertTrue(index.term_cache is get_term_cache())
+        hits = index.term_cache.hits
+        self.assertEqual(None, index.lookup(u'notes'))
+        self.assertEqual(index.lookup(u'critical'), index.lookup(u'critical'))
+        self.assertEqual(hits + 1, index.term_cache.hits)
+        term_id, document_frequency, term_idf = index.term_statistics(u'critical')
+        self.assertEqual((1, index.idf(term_id)), (document_frequency, term_idf))
+
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1',
+                               abstract=u'Notes.'))
+        old_index, index = index, get_index()
+        self.assertEqual(0, index.term_cache.statistics()['entries'])
+        # an index still in use after it is replaced does not fill the cache
+        # with its own term ids
+        self.assertEqual(None, old_index.lookup(u'notes'))
+        old_index.lookup(u'implementation')
+        self.assertEqual(2, index.term_statistics(u'critical')[1])
+        self.assertTrue(index.lookup(u'notes') is not None)
+        self.assertEqual(list(index.terms).index(u'implementation'),
+                         index.lookup(u'implementation'))
+
+    def test_impact_cache_is_bounded(self):
+        # terms in one article of three are searched in impact order
+        create_db_entries(self.records[0])
+        for i in range(2):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   abstract=u'Notes.'))
+        terms = list(Term.objects.values_list('term', flat=True))
+        with self.settings(PUBMED_IMPACT_CACHE_BYTES=None):
+            expected = [InvertedIndex.build().top_k([term], 5) for term in terms]
+        with self.settings(PUBMED_IMPACT_CACHE_BYTES=1000):
+            index = InvertedIndex.build()
+        self.assertEqual(expected, [index.top_k([term], 5) for term in terms])
+        statistics = index._impacts.statistics()
+        self.assertTrue(statistics['bytes'] <= 1000)
+        self.assertTrue(0 < statistics['entries'] < len(terms))
+
+class ConditionalGetTest(ArticleBaseTest):
+    def test_conditional_get(self):
+        create_db_entries(self.records[0])
+        article = Article.objects.get()
+        for url in (article.get_absolute_url(), '/articles/', '/autosearch/?q=impl',
+                    '/api/search/?q=implementation'):
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertIn('max-age=60', response['Cache-Control'])
+            self.assertTrue(response.has_header('Last-Modified'))
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(304, response.status_code)
+
+    def test_etag_follows_generation(self):
+        create_db_entries(self.records[0])
+        article = Article.objects.get()
+        etag = self.client.get(article.get_absolute_url())['ETag']
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1'))
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_etag_follows_index(self):
+        create_db_entries(self.records[0])
+        for url in ('/autosearch/?q=telephone', '/api/search/?q=telephone'):
+            clear_index()
+            new = dict(self.records[0], pubmedUrl=u'http://example.com/%s' % url,
+                       abstract=u'Notes by telephone.')
+            with self.settings(PUBMED_INDEX_REBUILD_INTERVAL=60):
+                self.client.get(url)
+                create_db_entries(new)
+                # the index searched is kept, and its results are tagged
+                # with its generation rather than the corpus's
+                stale = self.client.get(url)
+                with self.assertNumQueries(0):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=stale['ETag'])
+                self.assertEqual(304, response.status_code)
+            # once the index is rebuilt, so are the results
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=stale['ETag'])
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(stale.content, response.content)
+            Article.objects.get(pubmed_url=new['pubmedUrl']).delete()
+
+class ArticleViewTest(ArticleBaseTest):
+    def test_article_list_pages(self):
+        for i in range(5):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Notes %d.' % (i % 2)))
+        expected = list(Article.objects.order_by('title', 'pk').values_list('pk', flat=True))
+        listed = []
+        url = '/articles/'
+        with self.settings(PUBMED_ARTICLES_PER_PAGE=2):
+            while url:
+                response = self.client.get(url)
+                articles = response.context['object_list']
+                self.assertTrue(all(article._deferred for article in articles))
+                listed.extend(article.pk for article in articles)
+                url = None
+                if response.context['next_article']:
+                    url = '/articles/?after=%d' % response.context['next_article'].pk
+        self.assertEqual(expected, listed)
+        self.assertEqual(404, self.client.get('/articles/?after=x').status_code)
+
+    def test_article_detail_queries(self):
+        create_db_entries(self.records[0])
+        article = Article.objects.get()
+        self.client.get('/articles/')
+        with self.assertNumQueries(3):
+            response = self.client.get(article.get_absolute_url())
+        self.assertContains(response, 'Paulett JM,')
+        self.assertContains(response, 'Clin. Chem.')
+
 class AutosearchTest(ArticleBaseTest):
     def test_autosearch(self):
         record = self.records[0]
@@ -84,6 +1084,19 @@ class AutosearchTest(ArticleBaseTest):
         self.assertTemplateNotUsed(response, 'pubmed_search/article_detail.html')
         self.assertTemplateNotUsed(response, 'pubmed_search/search.html')
 
+    def test_autosearch_prefix(self):
+        create_db_entries(self.records[0])
+        create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/1',
+                               title=u'Telephone notes.', abstract=u'Telephone.'))
+        response = self.client.get('/autosearch/', {'q': 'notes Tele'})
+        self.assertEqual(sorted([u'Telephone notes.', self.records[0]['title']]),
+                         sorted(result['title'] for result in json.loads(response.content)))
+        with self.settings(PUBMED_AUTOSEARCH_RESULTS=1):
+            response = self.client.get('/autosearch/', {'q': 'tele'})
+        self.assertEqual(1, len(json.loads(response.content)))
+        response = self.client.get('/autosearch/', {'q': 'tele '})
+        self.assertEqual([], json.loads(response.content))
+
 class SearchTest(ArticleBaseTest):
     def test_search(self):
         record = self.records[0]
@@ -95,3 +1108,158 @@ class SearchTest(ArticleBaseTest):
         self.assertEqual('implementation', response.context['query_terms'][0])
         self.assertEqual(1, response.context['total_documents'])
 
+    def test_search_author_averages(self):
+        create_db_entries(self.records[0])
+        for i in range(3):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Laboratory notes.', abstract=u'Notes.',
+                                   authors=[u'Author %d' % i, u'Parl FF']))
+        response = self.client.post('/', {'q': 'notes implementation'})
+        terms, term_scores = get_index().term_scores([u'notes', u'implementation'])
+        expected = {}
+        for article in Article.objects.all():
+            for author in article.authors.all():
+                expected.setdefault(author, []).extend(term_scores[article.pk])
+        averages = dict(response.context['author_averages'])
+        self.assertEqual(len(expected), len(averages))
+        for author, scores in expected.iteritems():
+            self.assertEqual(math.fsum(scores) / (2 * 4), averages[author])
+        self.assertEqual(Author.objects.get(last_name=u'Parl'),
+                         response.context['author_averages'][0][0])
+
+        with self.settings(PUBMED_SEARCH_AUTHORS=2):
+            top = self.client.post('/', {'q': 'notes implementation'})
+        self.assertEqual(response.context['author_averages'][:2],
+                         top.context['author_averages'])
+
+    def test_search_query_count(self):
+        create_db_entries(self.records[0])
+        for i in range(20):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Notes.', abstract=u'Notes.',
+                                   authors=[u'Author %d' % i]))
+        get_index()
+        for query in ('implementation', 'notes', 'notes implementation'):
+            with self.assertNumQueries(4):
+                self.client.post('/', {'q': query})
+
+    def test_search_query_count_of_many_results(self):
+        BulkLoader().load([dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                title=u'Notes %d.' % i, abstract=u'Laboratory notes.',
+                                authors=[u'Author %d' % (i % 50)])
+                           for i in range(600)])
+        get_index()
+        for data in ({'q': 'notes laboratory', 'model': 'bm25'},
+                     {'q': 'notes laboratory', 'operator': 'AND'},
+                     {'q': '"laboratory notes"'}):
+            with self.assertNumQueries(4):
+                response = self.client.post('/', data)
+            self.assertEqual(600, response.context['total_results'])
+            self.assertEqual(50, len(response.context['author_averages']))
+
+    def test_cursor(self):
+        entry = (math.log(7.0/3.0) * 3, 12)
+        self.assertEqual(entry, decode_cursor(encode_cursor(*entry)))
+        self.assertRaises(ValueError, decode_cursor, u'not a cursor')
+        response = self.client.get('/', {'q': 'notes', 'after': 'not a cursor'})
+        self.assertFalse('articles' in response.context)
+
+    def test_search_pages(self):
+        create_db_entries(self.records[0])
+        for i in range(6):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Notes.', abstract=u' '.join([u'notes'] * (i % 3)),
+                                   authors=[u'Author %d' % i]))
+        expected = [doc_id for score, doc_id in get_index().rank([u'notes'])]
+        self.assertEqual(6, len(expected))
+        pages = []
+        with self.settings(PUBMED_SEARCH_RESULTS=4):
+            response = self.client.post('/', {'q': 'notes'})
+            pages.append(response.context['articles'])
+            self.assertEqual(6, response.context['total_results'])
+            with self.assertNumQueries(2):
+                response = self.client.get('/', {'q': 'notes',
+                                                 'after': response.context['next_cursor']})
+            pages.append(response.context['articles'])
+            self.assertEqual(None, response.context['next_cursor'])
+            self.assertFalse('author_averages' in response.context)
+        self.assertEqual([4, 2], [len(page) for page in pages])
+        self.assertEqual(expected, [article.pk for page in pages for article in page])
+
+    def test_search_boolean(self):
+        create_db_entries(self.records[0])
+        for i in range(3):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Notes %d.' % i, abstract=u'Laboratory notes.',
+                                   authors=[u'Author %d' % i]))
+        with_and = self.client.get('/api/search/', {'q': 'implementation laboratory',
+                                                    'operator': 'AND'})
+        data = json.loads(with_and.content)
+        self.assertEqual(1, data['total_results'])
+        self.assertEqual(6, len(data['authors']))
+        data = json.loads(self.client.get('/api/search/', {'q': '"laboratory notes"',
+                                                           'limit': 2}).content)
+        self.assertEqual(3, data['total_results'])
+        self.assertEqual([u'Notes 0.', u'Notes 1.'],
+                         [result['title'] for result in data['results']])
+        # the author's article, with notes twice and laboratory once, is one
+        # of three matches scored on two terms
+        averages = dict((author['name'], author['average']) for author in data['authors'])
+        index = get_index()
+        idfs = [index.idf(index.lookup(term)) for term in (u'notes', u'laboratory')]
+        self.assertAlmostEqual((2 * idfs[0] + idfs[1]) / (2 * 3), averages[u'Author 0'])
+        rest = json.loads(self.client.get('/api/search/', {'q': '"laboratory notes"',
+                                                           'after': data['next']}).content)
+        self.assertEqual([u'Notes 2.'], [result['title'] for result in rest['results']])
+
+        response = self.client.post('/', {'q': 'implementation laboratory', 'operator': 'AND'})
+        self.assertEqual(1, len(response.context['articles']))
+        self.assertContains(response, 'value="AND" selected')
+        self.assertContains(response, 'value="tfidf" selected')
+        response = self.client.get('/', {'q': 'notes', 'model': 'bm25'})
+        self.assertContains(response, 'value="bm25" selected')
+        for name, model in SCORING_MODELS.iteritems():
+            self.assertContains(response, '<option value="%s"' % name, count=1)
+            self.assertContains(response, '>%s</option>' % model.label, count=1)
+        response = self.client.post('/', {'q': 'notes', 'operator': 'NOT'})
+        self.assertFalse('articles' in response.context)
+
+    def test_search_api(self):
+        create_db_entries(self.records[0])
+        for i in range(3):
+            create_db_entries(dict(self.records[0], pubmedUrl=u'http://example.com/%d' % i,
+                                   title=u'Notes %d.' % i, abstract=u'Notes.'))
+        page = self.client.post('/', {'q': 'notes implementation'}).context
+        response = self.client.get('/api/search/', {'q': 'notes implementation', 'limit': 3})
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertTrue(response.has_header('ETag'))
+        data = json.loads(response.content)
+        self.assertEqual([u'notes', u'implementation'], data['terms'])
+        self.assertEqual([article.pk for article in page['articles']][:3],
+                         [result['pk'] for result in data['results']])
+        self.assertEqual(4, data['total_results'])
+        self.assertEqual([(unicode(author), average) for author, average in page['author_averages']],
+                         [(author['name'], author['average']) for author in data['authors']])
+
+        response = self.client.get('/api/search/', {'q': 'notes implementation',
+                                                    'after': data['next']})
+        rest = json.loads(response.content)
+        self.assertEqual(None, rest['next'])
+        self.assertFalse('authors' in rest)
+        self.assertEqual([page['articles'][3].title], [result['title'] for result in rest['results']])
+
+        response = self.client.get('/api/search/', {'q': 'notes implementation',
+                                                    'model': 'bm25'})
+        ranking = get_index().top_k([u'notes', u'implementation'], 4,
+                                    model=get_scoring_model('bm25'))
+        self.assertEqual([list(entry) for entry in ranking],
+                         [[result['score'], result['pk']]
+                          for result in json.loads(response.content)['results']])
+
+        response = self.client.get('/api/search/', {'q': 'notes', 'model': 'absent'})
+        self.assertEqual(400, response.status_code)
+
+        response = self.client.get('/api/search/', {'q': 'notes', 'limit': 0})
+        self.assertEqual(400, response.status_code)
+        self.assertIn('limit', json.loads(response.content))
+
@@ -1,12 +1,11 @@
 from django.conf.urls.defaults import patterns, url
-from django.views.generic import ListView, DetailView
-from pubmed_search.models import Article
 
 urlpatterns = patterns('',
     url(r'^autosearch/', 'pubmed_search.views.autosearch', name='autosearch'),
-    url(r'^article/(?P<pk>\d+)/$',
-        DetailView.as_view(model=Article),
+    url(r'^api/search/$', 'pubmed_search.views.search_api', name='search_api'),
+    url(r'^stats/cache/$', 'pubmed_search.views.cache_stats', name='cache_stats'),
+    url(r'^article/(?P<pk>\d+)/$', 'pubmed_search.views.article_detail',
         name='article_detail'),
-    url(r'^articles/$', ListView.as_view(model=Article), name='article_list'),
+    url(r'^articles/$', 'pubmed_search.views.article_list', name='article_list'),
     url(r'^$', 'pubmed_search.views.search', name='search'),
 )
@@ -867,27 +867,117 @@ STOP_WORDS = ('a',
               'z',
               'zero')
 
+import bz2
+import gzip
+import hashlib
 import os.path
+import re
+from contextlib import closing
+from itertools import islice, izip, repeat
+from multiprocessing import Pool
 try:
     from collections import Counter
 except ImportError:
     from pubmed_search.utils import Counter
 
-from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Max, Sum
 from django.utils import simplejson as json
 
-from pubmed_search.models import Article, Author, Journal, Term, Frequency, Order
-from pubmed_search.nlp import clean_term
+from pubmed_search.index import get_index
+from pubmed_search.models import (Article, Author, AuthorTerm, Checkpoint, Corpus,
+                                  Journal, RelatedArticle, Term, Frequency, Order)
+from pubmed_search.nlp import encode_positions, get_tokenizer, term_positions
+
+
+DEFAULT_BATCH_SIZE = 500
+READ_CHUNK_SIZE = 64 * 1024
+
+COMPRESSED_OPENERS = {'.gz': gzip.open,
+                      '.bz2': bz2.BZ2File}
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+
+_ARRAY_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def _record_terms(record):
+    raw_terms = ' '.join((record['title'],
+                          record['abstract']))
+    return get_tokenizer().tokenize(raw_terms)
+
+
+def count_terms(record):
+    """Given a JSON article, return a Counter of the cleaned terms in its
+    title and abstract."""
+    return Counter(_record_terms(record))
+
+
+def record_positions(record):
+    """Given a JSON article, return a dict mapping each cleaned term in its
+    title and abstract to the list of its positions among them."""
+    return term_positions(_record_terms(record))
+
+
+def term_counts(record):
+    """Given a JSON article, return a sorted list of (term, frequency,
+    positions) tuples, positions encoded as for Frequency.positions. This is
+    the compact form in which worker processes hand counted terms back to the
+    loader."""
+    return sorted((term, len(positions), encode_positions(positions))
+                  for term, positions in record_positions(record).iteritems())
+
+
+def record_hash(record):
+    """Given a JSON article, return a SHA-1 hex digest of its title, abstract,
+    journal and authors, used to tell whether a stored article has changed."""
+    fields = [record['title'], record['abstract'], record['journal']]
+    fields.extend(record['authors'])
+    return hashlib.sha1(u'\x00'.join(fields).encode('utf-8')).hexdigest()
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def create_db_entries(record):
-    """Given a JSON article, create DB model objects."""
-    journal, journal_created = Journal.objects.get_or_create(name=record['journal'])
+    """Given a JSON article, create DB model objects. Articles are identified
+    by their PubMed URL: an unchanged article is left alone, while a changed
+    one is updated and has its authors and term frequencies replaced."""
+    content_hash = record_hash(record)
+    try:
+        article = Article.objects.get(pubmed_url=record['pubmedUrl'])
+    except Article.DoesNotExist:
+        article = None
+    else:
+        if article.content_hash == content_hash:
+            return
 
-    article, article_created = Article.objects.get_or_create(pubmed_url=record['pubmedUrl'],
-                                                             title=record['title'],
-                                                             abstract=record['abstract'],
-                                                             journal=journal)
+    journal, journal_created = Journal.objects.get_or_create(name=record['journal'])
+    term_positions = record_positions(record)
+    length = sum(len(positions) for positions in term_positions.itervalues())
+    if article is None:
+        article = Article.objects.create(pubmed_url=record['pubmedUrl'],
+                                         title=record['title'],
+                                         abstract=record['abstract'],
+                                         journal=journal,
+                                         content_hash=content_hash,
+                                         length=length)
+    else:
+        Corpus.objects.add_documents(0, length - article.length)
+        article.title = record['title']
+        article.abstract = record['abstract']
+        article.journal = journal
+        article.content_hash = content_hash
+        article.length = length
+        article.save()
+        AuthorTerm.objects.add_articles([article.pk], -1)
+        article.order_set.all().delete()
+        Frequency.objects.delete_articles([article.pk])
 
     author_order = 0
     for item in record['authors']:
@@ -899,26 +989,439 @@ def create_db_entries(record):
                                                            order=author_order)
         author_order += 1
 
-    raw_terms = ' '.join((record['title'],
-                          record['abstract']))
-    clean_terms = [clean_term(term) for term in raw_terms.split()]
-    if settings.USE_STOP_WORDS:
-        clean_terms = [term for term in clean_terms if term not in STOP_WORDS]
-    cnt = Counter(clean_terms)
-    for key, frequency in cnt.iteritems():
+    for key, positions in term_positions.iteritems():
         term, term_created = Term.objects.get_or_create(term=key)
-        freq, freq_created = Frequency.objects.get_or_create(term=term,
-                                                             article=article,
-                                                             frequency=frequency)
+        freq, freq_created = Frequency.objects.get_or_create(
+            term=term, article=article, frequency=len(positions),
+            defaults={'positions': encode_positions(positions)})
+    AuthorTerm.objects.add_articles([article.pk])
+    Corpus.objects.bump_generation()
+
+
+class BulkLoader(object):
+    """Loads JSON articles into the database with batched bulk inserts.
+
+    Produces the same rows as calling create_db_entries on each record, but
+    keeps journals, authors and terms in memory instead of looking each one up
+    in the database, looks up the stored articles of each batch together, and
+    writes one transaction per batch of records. Unchanged articles are
+    skipped before their terms are counted. Primary keys are allocated by the
+    loader, so only one loader should write to the database at a time.
+
+    Terms can be counted by a pool of worker processes while the loader
+    writes; the rows written do not depend on the number of workers.
+
+    If a Checkpoint is given, it is saved in the same transaction as each
+    batch, recording how far through the input the load has got.
+
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None):
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.records_read = checkpoint.records if checkpoint else 0
+        self.journals = dict(Journal.objects.values_list('name', 'pk'))
+        self.authors = dict(((last_name, initials), pk) for pk, last_name, initials
+                            in Author.objects.values_list('pk', 'last_name', 'initials'))
+        self.terms = dict(Term.objects.values_list('term', 'pk'))
+        self.next_pks = {}
+        for model in (Journal, Author, Article, Term):
+            self.next_pks[model] = (model.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+
+    def _allocate_pk(self, model):
+        pk = self.next_pks[model]
+        self.next_pks[model] = pk + 1
+        return pk
+
+    def _stored_articles(self, pubmed_urls, chunk_size=500):
+        # pubmed_url -> (pk, content_hash) of the stored articles among
+        # pubmed_urls, looked up in chunks rather than kept for every article
+        articles = {}
+        for urls in _chunks(set(pubmed_urls), chunk_size):
+            articles.update((pubmed_url, (pk, content_hash))
+                            for pk, pubmed_url, content_hash in Article.objects.filter(
+                                pubmed_url__in=urls).values_list('pk', 'pubmed_url',
+                                                                 'content_hash'))
+        return articles
+
+    def needs_loading(self, record):
+        """Return True if record is a new article or differs from the stored
+        one."""
+        return bool(self._needing_loading([record]))
+
+    def _needing_loading(self, records):
+        stored = self._stored_articles(record['pubmedUrl'] for record in records)
+        needing = []
+        for record in records:
+            known = stored.get(record['pubmedUrl'])
+            if known is None or known[1] != record_hash(record):
+                needing.append(record)
+        return needing
+
+    def load(self, records, workers=1):
+        """Load every record in an iterable of JSON articles, counting terms
+        in a pool of worker processes if workers is more than one. If records
+        has an offset attribute, as a RecordReader does, it is recorded in the
+        checkpoint after each batch."""
+        batches = self._batches(records)
+        if workers > 1:
+            pool = Pool(workers)
+            try:
+                self._load_with_pool(batches, pool)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for batch, position in batches:
+                self.write_batch(batch, position=position)
+
+    def _batches(self, records):
+        for batch in _chunks(records, self.batch_size):
+            self.records_read += len(batch)
+            yield batch, (getattr(records, 'offset', 0), self.records_read)
+
+    def _load_with_pool(self, batches, pool):
+        # Count the terms of the next batch of records while the current one
+        # is written. Only two batches are read ahead of the writer, so memory
+        # use stays bounded however large the input is. Records stored
+        # unchanged are not counted; as the current batch may yet change
+        # them, they are checked again as they are written, and counted then
+        # if need be.
+        previous = None
+        for batch, position in batches:
+            needing = self._needing_loading(batch)
+            result = pool.map_async(term_counts, needing)
+            if previous is not None:
+                self._write_counted(*previous)
+            previous = (batch, needing, result, position)
+        if previous is not None:
+            self._write_counted(*previous)
+
+    def _write_counted(self, batch, counted, result, position):
+        counts = dict(izip([id(record) for record in counted], result.get()))
+        self.write_batch(batch, [counts.get(id(record)) for record in batch], position)
+
+    def write_batch(self, records, counts=None, position=None):
+        """Write records in a single transaction. counts is a list of the
+        term_counts of each record, or None for records whose terms have not
+        been counted, and position the (offset, records read) of the input
+        after the batch."""
+        if counts is None:
+            counts = repeat(None)
+        with transaction.commit_on_success():
+            self._write_batch(izip(records, counts))
+            Corpus.objects.bump_generation()
+            if self.checkpoint is not None and position is not None:
+                self.checkpoint.offset, self.checkpoint.records = position
+                self.checkpoint.save()
 
+    def _write_batch(self, batch):
+        batch = list(batch)
+        stored = self._stored_articles(record['pubmedUrl'] for record, counts in batch)
+        journals, authors, terms = [], [], []
+        # pubmed_url -> (article, orders, frequencies), so that an article
+        # appearing twice in one batch is only written once, in its last form
+        rows = {}
+        changed = set()
+        for record, counts in batch:
+            journal_pk = self.journals.get(record['journal'])
+            if journal_pk is None:
+                journal_pk = self._allocate_pk(Journal)
+                self.journals[record['journal']] = journal_pk
+                journals.append(Journal(pk=journal_pk, name=record['journal']))
 
-def load_json_from_file(filename):
-    """Given a JSON file path, parses the file and loads the articles into the
-    database."""
+            pubmed_url = record['pubmedUrl']
+            content_hash = record_hash(record)
+            known = stored.get(pubmed_url)
+            if known is None:
+                article_pk = self._allocate_pk(Article)
+            elif known[1] == content_hash:
+                continue
+            else:
+                article_pk = known[0]
+                if pubmed_url not in rows:
+                    changed.add(article_pk)
+            stored[pubmed_url] = (article_pk, content_hash)
+            if counts is None:
+                counts = term_counts(record)
+            article = Article(pk=article_pk,
+                              pubmed_url=pubmed_url,
+                              title=record['title'],
+                              abstract=record['abstract'],
+                              journal_id=journal_pk,
+                              content_hash=content_hash,
+                              length=sum(frequency for key, frequency, positions in counts))
+
+            orders = []
+            for author_order, item in enumerate(record['authors']):
+                lname, initials = item.split()
+                author_pk = self.authors.get((lname, initials))
+                if author_pk is None:
+                    author_pk = self._allocate_pk(Author)
+                    self.authors[(lname, initials)] = author_pk
+                    authors.append(Author(pk=author_pk, initials=initials,
+                                          last_name=lname))
+                orders.append(Order(author_id=author_pk, article_id=article_pk,
+                                    order=author_order))
+
+            frequencies = []
+            for key, frequency, positions in counts:
+                term_pk = self.terms.get(key)
+                if term_pk is None:
+                    term_pk = self._allocate_pk(Term)
+                    self.terms[key] = term_pk
+                    terms.append(Term(pk=term_pk, term=key))
+                frequencies.append(Frequency(term_id=term_pk, article_id=article_pk,
+                                             frequency=frequency, positions=positions))
+            rows[pubmed_url] = (article, orders, frequencies)
+
+        # the lengths of changed articles are replaced
+        length = 0
+        for pks in _chunks(changed, self.batch_size):
+            length -= sum(Article.objects.filter(pk__in=pks).values_list('length', flat=True))
+        articles, orders, frequencies = [], [], []
+        for article, article_orders, article_frequencies in rows.itervalues():
+            length += article.length
+            if article.pk in changed:
+                Article.objects.filter(pk=article.pk).update(title=article.title,
+                                                             abstract=article.abstract,
+                                                             journal=article.journal_id,
+                                                             content_hash=article.content_hash,
+                                                             length=article.length)
+            else:
+                articles.append(article)
+            orders.extend(article_orders)
+            frequencies.extend(article_frequencies)
+        AuthorTerm.objects.add_articles(changed, -1)
+        for pks in _chunks(changed, self.batch_size):
+            Order.objects.filter(article__in=pks).delete()
+        Frequency.objects.delete_articles(changed, self.batch_size)
+
+        self._add_document_frequencies(terms, frequencies)
+        for model, objs in ((Journal, journals), (Author, authors),
+                            (Article, articles), (Order, orders),
+                            (Term, terms), (Frequency, frequencies)):
+            model.objects.bulk_create(objs)
+        AuthorTerm.objects.add_articles(article.pk for article, article_orders,
+                                        article_frequencies in rows.itervalues())
+        Corpus.objects.add_documents(len(articles), length)
+
+    def _add_document_frequencies(self, new_terms, frequencies):
+        # bulk_create sends no signals, so count the new Frequency rows of
+        # each term: new terms are created with their count, existing terms
+        # are updated with one query per distinct count.
+        counts = Counter(frequency.term_id for frequency in frequencies)
+        for term in new_terms:
+            term.document_frequency = counts.pop(term.pk, 0)
+        term_pks_by_count = {}
+        for term_pk, count in counts.iteritems():
+            term_pks_by_count.setdefault(count, []).append(term_pk)
+        for count, term_pks in term_pks_by_count.iteritems():
+            for pks in _chunks(term_pks, self.batch_size):
+                Term.objects.filter(pk__in=pks).update(
+                    document_frequency=F('document_frequency') + count)
+
+
+def _record_missing_positions(chunk_size=DEFAULT_BATCH_SIZE):
+    # Frequency rows written before positions were recorded have none; find
+    # them again in the title and abstract of their articles.
+    article_pks = list(Frequency.objects.filter(positions='')
+                       .values_list('article', flat=True).distinct())
+    for pks in _chunks(article_pks, chunk_size):
+        for article in Article.objects.filter(pk__in=pks).only('title', 'abstract'):
+            positions = record_positions({'title': article.title,
+                                          'abstract': article.abstract})
+            rows = article.frequency_set.filter(positions='').values_list('pk', 'term__term')
+            for pk, term in list(rows):
+                Frequency.objects.filter(pk=pk).update(
+                    positions=encode_positions(positions.get(term, [])))
+
+
+@transaction.commit_on_success
+def rebuild_statistics():
+    """Recompute Corpus.documents, Corpus.length, every Article.length and
+    every Term.document_frequency from the Article and Frequency tables, and
+    every AuthorTerm from the Order and Frequency tables, and record the
+    positions of terms in articles loaded before positions were."""
+    tables = {'article': connection.ops.quote_name(Article._meta.db_table),
+              'term': connection.ops.quote_name(Term._meta.db_table),
+              'frequency': connection.ops.quote_name(Frequency._meta.db_table)}
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %(term)s SET document_frequency = "
+                   "(SELECT COUNT(*) FROM %(frequency)s "
+                   "WHERE %(frequency)s.term_id = %(term)s.id)" % tables)
+    cursor.execute("UPDATE %(article)s SET length = "
+                   "(SELECT COALESCE(SUM(frequency), 0) FROM %(frequency)s "
+                   "WHERE %(frequency)s.article_id = %(article)s.id)" % tables)
+    corpus = Corpus.objects.get_current()
+    AuthorTerm.objects.rebuild()
+    _record_missing_positions()
+    corpus.documents = Article.objects.count()
+    corpus.length = Article.objects.aggregate(Sum('length'))['length__sum'] or 0
+    corpus.save()
+    Corpus.objects.bump_generation()
+
+
+@transaction.commit_on_success
+def build_related_articles(count, terms, max_share=None):
+    """Find the count articles most similar to every article, comparing the
+    TF-IDF vectors of articles on the terms of highest weight in each, out
+    of those in no more than max_share of all articles, and store them as
+    RelatedArticles, replacing those stored before, and bump the Corpus
+    generation so article pages are not revalidated against the old ones.
+    Return the number of RelatedArticles stored."""
+    index = get_index()
+    max_document_frequency = None
+    if max_share is not None:
+        max_document_frequency = int(max_share * index.total_documents)
+    vectors = index.document_vectors(terms, max_document_frequency)
+    RelatedArticle.objects.delete_all()
+    stored = 0
+    for doc_ids in _chunks(sorted(vectors), DEFAULT_BATCH_SIZE):
+        related = []
+        for doc_id in doc_ids:
+            for rank, (similarity, related_id) in enumerate(
+                    index.similar(vectors[doc_id], count, doc_id)):
+                related.append(RelatedArticle(article_id=doc_id, related_id=related_id,
+                                              rank=rank, similarity=similarity))
+        RelatedArticle.objects.bulk_create(related)
+        stored += len(related)
+    Corpus.objects.bump_generation()
+    return stored
+
+
+def _scan_json_array(stream, start=0, chunk_size=READ_CHUNK_SIZE):
+    # Yields (offset, item) for each item of a JSON array, where offset is
+    # the position in stream just past the item. If start is not zero, the
+    # stream is positioned just past an item, inside the array.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    buffer_offset = start
+    position = 0
+    opened = start > 0
+    while True:
+        position = _ARRAY_SEPARATORS.match(buffer, position).end()
+        if position == len(buffer):
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                if opened:
+                    raise ValueError("Unterminated JSON array")
+                return
+            buffer_offset += len(buffer)
+            buffer, position = chunk, 0
+            continue
+
+        if not opened:
+            if buffer[position] != '[':
+                raise ValueError("Expected a JSON array")
+            opened = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, position = decoder.raw_decode(buffer, idx=position)
+        except ValueError:
+            # the item is incomplete; drop what has been consumed and read on
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise
+            buffer_offset += position
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield buffer_offset + position, item
+
+
+def _scan_json_lines(stream, start=0):
+    # Yields (offset, object) for each non-blank line of stream.
+    offset = start
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        offset += len(line)
+        line = line.strip()
+        if line:
+            yield offset, json.loads(line)
+
+
+def iter_json_array(stream, chunk_size=READ_CHUNK_SIZE):
+    """Given a file-like object containing a JSON array, yield the items of
+    the array one at a time. Only the item being decoded and one chunk of the
+    file are held in memory."""
+    for offset, item in _scan_json_array(stream, chunk_size=chunk_size):
+        yield item
+
+
+def iter_json_lines(stream):
+    """Given a file-like object with one JSON object per line, yield the
+    objects one at a time, skipping blank lines."""
+    for offset, item in _scan_json_lines(stream):
+        yield item
+
+
+class RecordReader(object):
+    """Iterates over the JSON articles in a file one at a time.
+
+    Files ending in .gz or .bz2 are decompressed on the fly. Files ending in
+    .jsonl or .ndjson (before any compression extension) are read as JSON
+    lines, anything else as a single JSON array of articles.
+
+    offset is the position in the decompressed file just past the last
+    article read. A reader created with that offset resumes with the next
+    article.
+
+    """
+    def __init__(self, filename, offset=0, chunk_size=READ_CHUNK_SIZE):
+        self.filename = filename
+        self.offset = offset
+        self.chunk_size = chunk_size
+        root, extension = os.path.splitext(filename)
+        self.opener = COMPRESSED_OPENERS.get(extension.lower())
+        if self.opener is None:
+            self.opener, root = open, filename
+        self.json_lines = os.path.splitext(root)[1].lower() in JSON_LINES_EXTENSIONS
+
+    def __iter__(self):
+        with closing(self.opener(self.filename, 'rb')) as json_file:
+            if self.offset:
+                json_file.seek(self.offset)
+            if self.json_lines:
+                scan = _scan_json_lines(json_file, self.offset)
+            else:
+                scan = _scan_json_array(json_file, self.offset, self.chunk_size)
+            for offset, record in scan:
+                self.offset = offset
+                yield record
+
+
+def iter_records(filename):
+    """Given a file path, yield the JSON articles in the file one at a time.
+    See RecordReader for the formats understood."""
+    return iter(RecordReader(filename))
+
+
+def load_json_from_file(filename, bulk=False, batch_size=DEFAULT_BATCH_SIZE,
+                        workers=1, resume=False):
+    """Given a JSON file path, streams the articles in the file into the
+    database.
+
+    With bulk=True, the articles are written in batches of batch_size by a
+    BulkLoader, with terms counted by workers processes. Progress through the
+    file is checkpointed after each batch; with resume=True, loading starts
+    from the last checkpoint of an interrupted load of the same file.
+
+    """
     file_path = os.path.normpath(filename)
     if os.path.exists(file_path) and os.path.isfile(file_path):
-        with open(file_path) as json_file:
-            records = json.loads(json_file.read())
-            for record in records:
+        if bulk:
+            checkpoint, created = Checkpoint.objects.get_or_create(
+                filename=os.path.abspath(file_path))
+            if not resume:
+                checkpoint.offset = checkpoint.records = 0
+            reader = RecordReader(file_path, offset=checkpoint.offset)
+            BulkLoader(batch_size, checkpoint).load(reader, workers=workers)
+            checkpoint.delete()
+        else:
+            for record in iter_records(file_path):
                 create_db_entries(record)
-
@@ -1,45 +1,144 @@
+import heapq
+from itertools import izip
 from math import fsum
 
+from django.conf import settings
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render
 from django.utils import simplejson as json
-from django.views.decorators.http import require_http_methods, require_GET
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_http_methods, require_GET
+from django.views.generic import DetailView, ListView
 
-from pubmed_search.forms import SearchForm
-from pubmed_search.models import Article, Author, Term
-from pubmed_search.nlp import tfidf
+from pubmed_search.cache import cache_statistics, cached_query, get_term_cache
+from pubmed_search.db import read_only
+from pubmed_search.forms import SearchForm, encode_cursor
+from pubmed_search.index import get_index, get_index_version
+from pubmed_search.models import Article, Author, AuthorTerm, Corpus, Order, RelatedArticle
+from pubmed_search.nlp import TFIDF, get_scoring_model, get_tokenizer
+from pubmed_search.query import parse_query
 
 
-def _deduplicate_articles(articles):
-    """Given a sequence of (TF-IDF, article) tuples, remove duplicate articles
-    from the list, and remove the TF-IDF score. Returns a list of articles."""
-    visited = []
-    for item in articles:
-        if item[1] in visited:
-            continue
-        else:
-            visited.append(item[1])
-    return visited
-
-
-def _find_articles(query_terms):
-    """Given a list of query terms, find all articles that contain those
-    terms."""
-    q = Q()
-    for term in query_terms:
-        #q = q | Q(frequency__term__term__icontains=term)
-        q = q | Q(frequency__term__term__iexact=term)
-    articles = Article.objects.filter(q).distinct()
+def _fetch_articles(pks, chunk_size=500):
+    """Given a sequence of article primary keys, return a dict mapping them to
+    Articles, querying in chunks to stay within SQLite's parameter limit."""
+    pks = list(pks)
+    articles = {}
+    for start in xrange(0, len(pks), chunk_size):
+        articles.update(Article.objects.in_bulk(pks[start:start + chunk_size]))
     return articles
 
 
+def _author_averages(index, terms, total_results, limit, doc_ids=None, model=None):
+    """Return (author id, average TF-IDF) pairs for the limit authors with
+    the highest averages over the total_results articles containing any of
+    terms, best first, or if doc_ids is given, over those articles. With a
+    ScoringModel other than TF-IDF, average its scores instead.
+
+    Average TF-IDF includes scores of zero for documents that match term A,
+    but not term B. That is, a doc that matches A will have a TF-IDF of some
+    positive float, but if that same doc does *not* match term B, it will have
+    a TF-IDF of 0 for term B. So an author's average is the sum of the TF-IDF
+    of each term in each of their results, divided by the number of scores of
+    all results; the sum is the IDF of each term times the total frequency
+    of the term in the author's articles, which AuthorTerm holds. Only some
+    of the articles containing the terms match a query needing more than one
+    of them, so then the authors of each of doc_ids are looked up instead,
+    as they are for other models, whose scores are not proportional to
+    frequencies.
+
+    """
+    model = model or get_scoring_model(TFIDF.name)
+    term_ids = index.resolve(terms, model)
+    idfs = dict((term, term_idf) for term, (term_id, term_idf) in izip(terms, term_ids))
+    if doc_ids is None and model.name != TFIDF.name:
+        doc_ids = index.find(terms)
+    author_scores = {}
+    if doc_ids is None:
+        for author_pk, term, frequency, articles in AuthorTerm.objects.sums(terms):
+            author_scores.setdefault(author_pk, []).append(frequency*idfs[term])
+    else:
+        # the authors of every article containing any of the terms, in one
+        # query whatever the number of results, of which those of doc_ids
+        # are kept
+        matches = set(doc_ids)
+        orders = (Order.objects.filter(article__frequency__term__term__in=terms)
+                  .values_list('author', 'article').distinct().order_by())
+        for author_pk, doc_id in orders.iterator():
+            if doc_id in matches:
+                author_scores.setdefault(author_pk, []).extend(
+                    index.score(term_id, doc_id, model, term_idf)
+                    for term_id, term_idf in term_ids)
+
+    scores_count = len(terms) * total_results
+    best = heapq.nlargest(limit, ((fsum(scores) / scores_count, -author_pk)
+                                  for author_pk, scores in author_scores.iteritems()))
+    return [(-negative_pk, average) for average, negative_pk in best]
+
+
+def _get_scorer(model):
+    """Return the search backend chosen by settings.PUBMED_SEARCH_BACKEND:
+    the index itself, a MatrixScorer of it by the ScoringModel model, or a
+    ShardedSearcher of it."""
+    backend = getattr(settings, 'PUBMED_SEARCH_BACKEND', 'index')
+    if backend == 'matrix':
+        from pubmed_search.matrix import get_matrix_scorer
+        return get_matrix_scorer(model)
+    if backend == 'sharded':
+        from pubmed_search.shards import get_sharded_searcher
+        return get_sharded_searcher()
+    return get_index()
+
+
+# ETags and Last-Modified times of pages that only change with the corpus,
+# checked without a database query
+def _corpus_etag(request, *args, **kwargs):
+    return 'corpus-%d' % Corpus.objects.get_version()[0]
+
+def _article_etag(request, pk):
+    return 'corpus-%d-article-%s' % (Corpus.objects.get_version()[0], pk)
+
+def _corpus_modified(request, *args, **kwargs):
+    return Corpus.objects.get_version()[1]
+
+# and of search results, which are those of the index a process searches,
+# kept for a while after the corpus changes
+def _index_etag(request, *args, **kwargs):
+    return 'corpus-%d' % get_index_version()[0]
+
+def _index_modified(request, *args, **kwargs):
+    return get_index_version()[1]
+
+_cacheable = cache_control(public=True, max_age=settings.PUBMED_HTTP_MAX_AGE)
+
+
+@read_only
 @require_GET
+@_cacheable
+@condition(_index_etag, _index_modified)
 def autosearch(request):
     form = SearchForm(request.GET)
     if form.is_valid():
-        query_terms = form.cleaned_data['q'].split()
-        results = _find_articles(query_terms)
+        # the last word may still be being typed, so it is expanded to the
+        # terms it begins, and articles are ranked as for a search on all of
+        # them
+        query_terms, partial = get_tokenizer().tokenize_partial(form.cleaned_data['q'])
+        index = get_index()
+        model = get_scoring_model(form.cleaned_data['model'])
+
+        def rank():
+            terms = list(query_terms)
+            if partial is not None:
+                terms.extend(index.expand_prefix(partial, settings.PUBMED_AUTOSEARCH_TERMS))
+            return index.top_k(terms, settings.PUBMED_AUTOSEARCH_RESULTS, model=model)
+
+        ranking = cached_query('autosearch', index.generation,
+                               (sorted(set(query_terms)), partial, model.name,
+                                settings.PUBMED_AUTOSEARCH_TERMS,
+                                settings.PUBMED_AUTOSEARCH_RESULTS), rank)
+        articles = _fetch_articles(doc_id for score, doc_id in ranking)
+        results = [articles[doc_id] for score, doc_id in ranking if doc_id in articles]
 
         c = []
         for article in results:
@@ -48,59 +147,193 @@ def autosearch(request):
         return HttpResponse(content, content_type='application/json')
 
 
+class ArticleListView(ListView):
+    """Lists articles by title, then id, a page at a time. A page follows the
+    article whose id is given as after, found through the index on title, so
+    a late page costs as much as the first. Abstracts are not fetched."""
+    model = Article
+
+    def get_queryset(self):
+        articles = Article.objects.defer('abstract').order_by('title', 'pk')
+        if self.request.GET.get('after'):
+            try:
+                after = int(self.request.GET['after'])
+                title = Article.objects.filter(pk=after).values_list('title', flat=True)[0]
+            except (ValueError, IndexError):
+                raise Http404
+            articles = articles.filter(Q(title__gt=title) | Q(title=title, pk__gt=after))
+        # one more than a page, to know whether there is a next page
+        return articles[:settings.PUBMED_ARTICLES_PER_PAGE + 1]
+
+    def get_context_data(self, **kwargs):
+        context = super(ArticleListView, self).get_context_data(**kwargs)
+        articles = list(context['object_list'])
+        page_size = settings.PUBMED_ARTICLES_PER_PAGE
+        context['object_list'] = articles[:page_size]
+        context['next_article'] = articles[page_size - 1] if len(articles) > page_size else None
+        return context
+
+
+class ArticleDetailView(DetailView):
+    """Shows an article with its journal, its authors in order and the
+    articles most like it, stored by the buildrelated command, in three
+    queries."""
+    queryset = Article.objects.select_related('journal')
+
+    def get_context_data(self, **kwargs):
+        context = super(ArticleDetailView, self).get_context_data(**kwargs)
+        context['orders'] = (Order.objects.filter(article=self.object)
+                             .select_related('author').order_by('order'))
+        context['related_articles'] = (RelatedArticle.objects.filter(article=self.object)
+                                       .order_by('rank').values('related', 'related__title'))
+        return context
+
+
+article_list = require_GET(_cacheable(condition(_corpus_etag, _corpus_modified)(
+    ArticleListView.as_view())))
+
+article_detail = require_GET(_cacheable(condition(_article_etag, _corpus_modified)(
+    ArticleDetailView.as_view())))
+
+
+def _search_page(query, after, page_size, model):
+    """Rank the articles matching a Query by a ScoringModel and return a
+    dict of one page of results: 'results', a list of (score, Article)
+    pairs, best first, following the ranking entry after if it is given;
+    'next_cursor', the cursor of the next page or None; and
+    'total_documents'. The first page also has 'total_results', the number
+    of matching articles, and 'author_averages', (Author, average score)
+    pairs for the authors with the highest averages."""
+    scorer = _get_scorer(model)
+
+    # Order results by their best score, then by article id, and take one
+    # more than a page to know whether there is a next page. The first page
+    # also has the number of results and the authors with the highest
+    # average TF-IDF, which are found from the index and AuthorTerm sums;
+    # later pages only score the results they show. Queries that need more
+    # than one of their terms are matched first, and only their matches
+    # ranked.
+    def rank():
+        # a MatrixScorer or ShardedSearcher wraps the index
+        index = getattr(scorer, 'index', scorer)
+        terms = index.known_terms(query.terms())
+        doc_ids = None
+        if query.matches_any_term:
+            page = {'ranking': scorer.top_k(terms, page_size + 1, after, model)}
+        else:
+            doc_ids = query.doc_ids(index)
+            page = {'ranking': scorer.top_k_of(terms, doc_ids, page_size + 1, after,
+                                               model)}
+        if after is None:
+            if doc_ids is None:
+                page['total_results'] = index.count(terms)
+            else:
+                page['total_results'] = len(doc_ids)
+            page['author_averages'] = _author_averages(
+                index, terms, page['total_results'], settings.PUBMED_SEARCH_AUTHORS,
+                doc_ids, model)
+        return page
+
+    page = cached_query('search', scorer.generation,
+                        (query.key(), after, page_size, model.name,
+                         settings.PUBMED_SEARCH_AUTHORS), rank)
+    ranking = page['ranking']
+    next_cursor = None
+    if len(ranking) > page_size:
+        ranking = ranking[:page_size]
+        next_cursor = encode_cursor(*ranking[-1])
+    articles = _fetch_articles(doc_id for score, doc_id in ranking)
+
+    result = {'results': [(score, articles[doc_id]) for score, doc_id in ranking
+                          if doc_id in articles],
+              'next_cursor': next_cursor,
+              # calculate total number of articles for "X of Y documents"
+              'total_documents': scorer.total_documents}
+    if after is None:
+        authors = Author.objects.in_bulk(
+            [author_pk for author_pk, average in page['author_averages']])
+        result['total_results'] = page['total_results']
+        result['author_averages'] = [(authors[author_pk], average)
+                                     for author_pk, average in page['author_averages']
+                                     if author_pk in authors]
+    return result
+
+
+def _search_context(context):
+    # the scoring models of the search form, the default one chosen unless
+    # the search chose another
+    context.setdefault('model', settings.PUBMED_SCORING_MODEL)
+    context['model_choices'] = SearchForm.base_fields['model'].choices
+    return context
+
+
+@read_only
 @require_http_methods(["GET", "POST"])
 def search(request):
-    if request.method == 'POST':
-        form = SearchForm(request.POST)
+    # the form is posted; later pages of results are linked with GET
+    data = request.POST if request.method == 'POST' else request.GET
+    if 'q' in data:
+        form = SearchForm(data)
         if form.is_valid():
-            query_terms = form.cleaned_data['q'].split()
-            query_terms = [term.lower() for term in query_terms]
-            intermediate_results = _find_articles(query_terms)
-
-            # calculate the TF-IDF of each term per document,
-            # order results by TF-IDF
-            terms = Term.objects.filter(term__in=query_terms)
-            ordered_results = []
-            for term in terms:
-                for doc in intermediate_results:
-                    ordered_results.append((tfidf(term, doc), doc))
-            ordered_results.sort(reverse=True)
-
-            # strip out duplicate articles without changing the order
-            results = _deduplicate_articles(ordered_results)
-
-            # calculate total number of articles for "X of Y documents"
-            total_docs = Article.objects.count()
-
-            # Calculate the average TF-IDF for each author in search results.
-            # Average TF-IDF includes scores of zero for documents that match
-            # term A, but not term B. That is, a doc that matches A will have a
-            # TF-IDF of some positive float, but if that same doc does *not*
-            # match term B, it will have a TF-IDF of 0 for term B.
-            # ordered_results has a list of (TF-IDF, article) tuples of all
-            # results, so start with that and create a dictionary with authors
-            # as keys and lists of (TF-IDF, article) tuples as values.
-            author_totals = {}
-            for score, doc in ordered_results:
-                for author in doc.authors.all():
-                    scores = author_totals.setdefault(author.pk, [])
-                    scores.append(score)
-
-            # average the scores per author
-            author_averages = []
-            total_results = len(ordered_results)
-            for author_pk, scores in author_totals.items():
-                scores_sum = fsum(scores)
-                average = scores_sum / total_results
-                author = Author.objects.get(pk=author_pk)
-                author_averages.append((author, average))
-
-
-            return render(request, 'pubmed_search/search.html', {'articles': results,
-                                                                 'query_terms': query_terms,
-                                                                 'total_documents': total_docs,
-                                                                 'author_averages': author_averages})
+            query = parse_query(form.cleaned_data['q'], form.cleaned_data['operator'])
+            page = _search_page(query, form.cleaned_data['after'],
+                                settings.PUBMED_SEARCH_RESULTS,
+                                get_scoring_model(form.cleaned_data['model']))
+            context = {'articles': [article for score, article in page.pop('results')],
+                       'query_terms': query.terms(),
+                       'q': form.cleaned_data['q'],
+                       'operator': form.cleaned_data['operator'],
+                       'model': form.cleaned_data['model']}
+            context.update(page)
+            return render(request, 'pubmed_search/search.html', _search_context(context))
         else:
-            return render(request, 'pubmed_search/search.html', {'query_terms': request.POST})
+            return render(request, 'pubmed_search/search.html',
+                          _search_context({'query_terms': data}))
     else:
-        return render(request, 'pubmed_search/search.html')
+        return render(request, 'pubmed_search/search.html', _search_context({}))
+
+
+@read_only
+@require_GET
+@_cacheable
+@condition(_index_etag, _index_modified)
+def search_api(request):
+    """Return a page of ranked search results as JSON: the query terms, the
+    results with their scores, the cursor of the next page, and on the first
+    page the number of results and the authors with the highest average
+    TF-IDF. Takes the query q, and optionally the number of results, limit,
+    the cursor of the page, after, and the operator combining words of q
+    with none between them, 'AND' or 'OR', and the scoring model, model."""
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(json.dumps(form.errors),
+                                      content_type='application/json')
+    query = parse_query(form.cleaned_data['q'], form.cleaned_data['operator'])
+    page = _search_page(query, form.cleaned_data['after'],
+                        form.cleaned_data['limit'] or settings.PUBMED_SEARCH_RESULTS,
+                        get_scoring_model(form.cleaned_data['model']))
+
+    c = {'terms': query.terms(),
+         'results': [{'pk': article.pk, 'title': article.title,
+                      'url': article.get_absolute_url(), 'score': score}
+                     for score, article in page['results']],
+         'next': page['next_cursor'],
+         'total_documents': page['total_documents']}
+    if 'author_averages' in page:
+        c['total_results'] = page['total_results']
+        c['authors'] = [{'pk': author.pk, 'name': unicode(author), 'average': average}
+                        for author, average in page['author_averages']]
+    return HttpResponse(json.dumps(c), content_type='application/json')
+
+
+@require_GET
+def cache_stats(request):
+    """Report the hits, misses and hit ratio of the search result cache, and
+    of this process's term cache with its size, as JSON, for monitoring."""
+    statistics = cache_statistics()
+    term_cache = get_term_cache()
+    if term_cache is not None:
+        statistics['terms'] = term_cache.statistics()
+    content = json.dumps(statistics)
+    return HttpResponse(content, content_type='application/json')
+
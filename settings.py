@@ -20,7 +20,54 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # The same database, opened read-only for searches (see
+    # PUBMED_SEARCH_DATABASE). Tests use the default database.
+    'readonly': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(DIRNAME, 'pubmedsearch.db'),
+        'TEST_MIRROR': 'default',
+    },
+}
+
+# Routes the reads of search views to PUBMED_SEARCH_DATABASE.
+DATABASE_ROUTERS = ['pubmed_search.db.SearchRouter']
+
+# Database alias that search views read from, opened read-only, so that
+# searches are served while loadarticles writes; None to read from the
+# default database.
+PUBMED_SEARCH_DATABASE = 'readonly'
+
+# Pragmas run on every SQLite connection as it opens: write-ahead logging,
+# so that readers and the writer do not wait for each other; syncing only at
+# checkpoints, which WAL keeps safe from corruption; a 64 MB page cache; up
+# to 256 MB of the file memory-mapped; temporary tables in memory; and up to
+# 20 seconds' wait for a lock before giving up.
+PUBMED_SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 20000),
+]
+
+# Search results are cached in the 'search' cache, which keeps the results of
+# the MAX_ENTRIES most recently used queries. With several web processes, use
+# a shared cache such as memcached, which also evicts least recently used
+# entries.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'pubmed_search.cache.LRUCache',
+        'LOCATION': 'pubmed-search',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
 }
 
 # Local time zone for this installation. Choices can be found here:
@@ -154,3 +201,66 @@ from string import letters, digits
 ACCEPTABLE_CHARACTERS = ''.join((letters, digits, '-'))
 
 USE_STOP_WORDS = True
+
+# Index snapshot written by the buildindex management command and memory-mapped
+# by each process serving searches.
+PUBMED_INDEX_SNAPSHOT = os.path.join(DIRNAME, 'pubmedsearch.index')
+
+# Seconds for which a process keeps searching the index it has after articles
+# change, before rebuilding it from the database or reopening the snapshot, so
+# that searches made during loadarticles do not rebuild it after every batch.
+# 0 rebuilds it on the first search after every change.
+PUBMED_INDEX_REBUILD_INTERVAL = 60
+
+# Search backend: 'index' scores queries in Python from the inverted index,
+# 'matrix' with NumPy and SciPy from a sparse term-document matrix, and
+# 'sharded' in a process for each of PUBMED_SEARCH_SHARDS shards of the index.
+PUBMED_SEARCH_BACKEND = 'index'
+PUBMED_SEARCH_SHARDS = 4
+
+# How words of a search query with no AND or OR between them are combined:
+# 'OR' matches articles containing any of them, 'AND' only those containing
+# all of them. Searches may ask for either.
+PUBMED_SEARCH_DEFAULT_OPERATOR = 'OR'
+
+# How search results are scored when a search does not ask: 'tfidf' (term
+# frequency times IDF), 'logtfidf' (log-scaled term frequency times IDF) or
+# 'bm25' (Okapi BM25, normalized by article length).
+PUBMED_SCORING_MODEL = 'tfidf'
+
+# Number of top-ranked articles listed on the search page.
+PUBMED_SEARCH_RESULTS = 100
+
+# Number of authors with the highest average score charted on the search page.
+PUBMED_SEARCH_AUTHORS = 50
+
+# Number of terms the partly typed last word of an autosearch query expands
+# to, and number of articles autosearch returns.
+PUBMED_AUTOSEARCH_TERMS = 20
+PUBMED_AUTOSEARCH_RESULTS = 10
+
+# Name of the cache holding search results, or None not to cache them.
+PUBMED_SEARCH_CACHE = 'search'
+
+# Roughly how many bytes each process may spend caching the ids, document
+# frequencies and IDF of query terms, or None not to cache them.
+PUBMED_TERM_CACHE_BYTES = 16 * 1024 * 1024
+
+# Roughly how many bytes each index may spend keeping the postings of query
+# terms in impact order, about 12 bytes a posting, for top-k searches, or None
+# to sort them again for every search.
+PUBMED_IMPACT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Seconds browsers and proxies may reuse autosearch results and article pages
+# without revalidating them.
+PUBMED_HTTP_MAX_AGE = 60
+
+# Number of articles listed per page at /articles/.
+PUBMED_ARTICLES_PER_PAGE = 100
+
+# Number of related articles the buildrelated command stores for each article,
+# and number of an article's highest weighted terms it compares them on.
+PUBMED_RELATED_ARTICLES = 10
+PUBMED_RELATED_TERMS = 20
+# Terms in more than this share of all articles are not compared.
+PUBMED_RELATED_MAX_SHARE = 0.1